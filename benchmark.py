@@ -0,0 +1,370 @@
+"""Benchmark del motore su partiture sintetiche: tempi per fase, salvati in JSON.
+
+    python benchmark.py --misure 10 100 1000 --strumenti 1 4 8 -o risultati.json
+    python benchmark.py --riferimento risultati.json --soglia 0.25
+    python benchmark.py --lettura brano.mxl altro.xml
+    python benchmark.py --sarto
+    python benchmark.py --misure 100 --strumenti 8 12 20 31
+    python benchmark.py --collocazione
+    python benchmark.py --anteprima --misure 100 1000 5000
+
+Ogni caso (misure x strumenti) viene eseguito più volte e se ne tiene l'esecuzione più veloce,
+con il picco di memoria (RSS) del processo; con --finestra le partiture si orchestrano a finestre
+di misure (memoria limitata: il picco non deve crescere con la lunghezza).
+Il tempo di avvio (import dell'interfaccia, import del motore, prima orchestrazione) si misura
+in interpreti nuovi, come dopo l'avvio di un container.
+Con --riferimento il benchmark esce con codice 1 se un caso, o una sua fase, è più lento del
+riferimento oltre la soglia (relativa) e oltre un minimo assoluto, che assorbe il rumore delle
+fasi brevi.
+Con --lettura si confrontano invece, sui file indicati, i tempi di lettura di converter.parse,
+di leggi_partitura e della lettura diretta delle mani (leggi_mani_diretta), e si controlla che
+la lettura diretta dia al motore le stesse misure (tabelle delle mani, dinamiche e indicazioni).
+Con --sarto si misura solo il rendimento dell'assegnazione delle note scartate su problemi
+casuali, da 1 a 8 strumenti liberi e da 1 a 12 note: in assegnazioni al secondo per un offset
+(sarto.assegna) e in misure al secondo per misure di OFFSET_SARTO offset (sarto.assegna_misura),
+anche offset per offset (fascio e candidati 1) per confronto.
+Con --collocazione si misura solo il costo per nota dello spostamento d'ottava nelle estensioni,
+dalle tabelle precalcolate di strumenti.Estensione e ricalcolato, per ogni dimensione di formazione;
+ogni caso completo riporta anche i microsecondi per nota inserita (us_per_nota).
+Con --anteprima si misura solo la latenza di motore.anteprima (MISURE_ANTEPRIMA misure in MIDI)
+all'inizio e alla fine di partiture di ogni lunghezza, con 8 strumenti.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import music21
+from music21 import converter, stream
+
+import motore
+from eventi import TabellaMano
+from formato_mxl import LetturaNonSupportata, leggi_mani_diretta, leggi_partitura
+from partiture_sintetiche import TESSITURE, genera_mxl
+from griglia import TICK_PER_QUARTO
+from sarto import Precedenti, assegna, assegna_misura
+from strumenti import ESTENSIONI, ORDINE_PARTITURA, spostamento_ottave
+
+# Formazione usata per ogni numero di strumenti: i ruoli (melodia, basso, raddoppi) cambiano
+# con la dimensione come nell'uso reale; oltre gli 8 strumenti, legni e archi a due con gli
+# ottoni, fino all'orchestra completa della libreria
+_ORCHESTRA_DA_CAMERA = ["Flauto", "Oboe", "Clarinetto in Sib", "Fagotto", "Violino I", "Violino II", "Viola", "Violoncello"]
+ENSEMBLE_PER_DIMENSIONE = {
+    1: ["Violino I"],
+    2: ["Violino I", "Violoncello"],
+    3: ["Violino I", "Viola", "Violoncello"],
+    4: ["Violino I", "Violino II", "Viola", "Violoncello"],
+    5: ["Flauto", "Violino I", "Violino II", "Viola", "Violoncello"],
+    6: ["Flauto", "Fagotto", "Violino I", "Violino II", "Viola", "Violoncello"],
+    7: ["Flauto", "Oboe", "Fagotto", "Violino I", "Violino II", "Viola", "Violoncello"],
+    8: _ORCHESTRA_DA_CAMERA,
+    12: _ORCHESTRA_DA_CAMERA + ["Corno in Fa I", "Tromba in Sib I", "Trombone I", "Contrabbasso"],
+    20: _ORCHESTRA_DA_CAMERA + ["Flauto II", "Oboe II", "Clarinetto in Sib II", "Fagotto II", "Corno in Fa I", "Corno in Fa II",
+                                "Tromba in Sib I", "Tromba in Sib II", "Trombone I", "Trombone basso", "Tuba", "Contrabbasso"],
+    len(ORDINE_PARTITURA): list(ORDINE_PARTITURA),
+}
+
+SOGLIA_PREDEFINITA = 0.25
+MINIMO_ASSOLUTO_S = 0.05
+OFFSET_SARTO = 8
+
+
+# Eseguito in un interprete nuovo: stampa i tempi di avvio in JSON
+_CODICE_AVVIO = """
+import json, time
+inizio = time.perf_counter()
+import strumenti
+interfaccia = time.perf_counter()
+import motore
+importato = time.perf_counter()
+from partiture_sintetiche import genera_mxl
+dati = genera_mxl(10)
+inizio_orchestrazione = time.perf_counter()
+motore.orchestra(dati, ["Violino I"])
+print(json.dumps({"interfaccia_s": interfaccia - inizio, "motore_s": importato - interfaccia,
+                  "prima_orchestrazione_s": time.perf_counter() - inizio_orchestrazione}))
+"""
+
+
+def misura_avvio(ripetizioni=3):
+    """Tempi di avvio a freddo (il minimo su più interpreti nuovi) di ogni fase."""
+    cartella = os.path.dirname(os.path.abspath(__file__))
+    migliori = {}
+    for _ in range(ripetizioni):
+        uscita = subprocess.run([sys.executable, "-c", _CODICE_AVVIO], cwd=cartella, check=True,
+                                capture_output=True, text=True).stdout
+        for nome, secondi in json.loads(uscita.strip().splitlines()[-1]).items():
+            migliori[nome] = min(secondi, migliori.get(nome, secondi))
+    return migliori
+
+
+def esegui_caso(dati, ensemble, ripetizioni=3, processi=1, keep_original=True, finestra=None):
+    """Tempi dell'esecuzione più veloce su ripetizioni esecuzioni (lettura compresa), con il
+    picco di memoria più alto tra le esecuzioni."""
+    migliore, picco_mb = None, None
+    for _ in range(ripetizioni):
+        motore.svuota_cache()
+        statistiche = {}
+        inizio = time.perf_counter()
+        motore.orchestra(dati, ensemble, keep_original=keep_original, processi=processi, statistiche=statistiche, finestra=finestra)
+        totale = time.perf_counter() - inizio
+        picco = statistiche["memoria"]["picco_rss_mb"]
+        if picco is not None: picco_mb = max(picco_mb or 0.0, picco)
+        if migliore is None or totale < migliore["totale_s"]:
+            migliore = {"totale_s": totale, "fasi_s": statistiche["fasi_s"], "contatori": statistiche["contatori"],
+                        "copie_profonde": statistiche["copie_profonde"]}
+    migliore["picco_memoria_mb"] = picco_mb
+    return migliore
+
+
+def esegui(misure, strumenti, tessiture=None, ripetizioni=3, processi=1, keep_original=True, seme=0, notifica=None, finestra=None):
+    notifica = notifica or (lambda messaggio: None)
+    casi = {}
+    for n_misure in misure:
+        dati = genera_mxl(n_misure, tessiture, seme)
+        for n_strumenti in strumenti:
+            nome = f"{n_misure}x{n_strumenti}"
+            caso = esegui_caso(dati, ENSEMBLE_PER_DIMENSIONE[n_strumenti], ripetizioni, processi, keep_original, finestra)
+            caso.update({"misure": n_misure, "strumenti": n_strumenti,
+                         "misure_al_secondo": n_misure / caso["totale_s"],
+                         "us_per_nota": caso["totale_s"] / max(1, sum(caso["contatori"].get("note_inserite", {}).values())) * 1e6})
+            casi[nome] = caso
+            memoria = f"{caso['picco_memoria_mb']:8.0f} MB" if caso["picco_memoria_mb"] is not None else ""
+            notifica(f"{nome:>10}  {caso['totale_s']:8.3f} s  {caso['misure_al_secondo']:8.1f} misure/s  "
+                     f"{caso['us_per_nota']:6.1f} us/nota  {memoria}")
+    avvio = misura_avvio(ripetizioni)
+    notifica("     avvio  " + "  ".join(f"{nome} {secondi:.3f}" for nome, secondi in avvio.items()))
+    return {
+        "ambiente": {"python": platform.python_version(), "music21": music21.__version__,
+                     "piattaforma": platform.platform(), "data": datetime.now(timezone.utc).isoformat(timespec="seconds")},
+        "parametri": {"tessiture": list(tessiture or TESSITURE), "ripetizioni": ripetizioni, "processi": processi,
+                      "keep_original": keep_original, "seme": seme, "finestra": finestra},
+        "avvio_s": avvio,
+        "casi": casi,
+    }
+
+
+def _dati_delle_mani(partitura):
+    # Ciò che il motore legge delle due mani, misura per misura, in forma confrontabile
+    dati = []
+    for parte in partitura.getElementsByClass(stream.Part)[:2]:
+        for m in parte.getElementsByClass(stream.Measure):
+            tab = TabellaMano(m)
+            dati.append((m.number, float(m.offset), float(m.quarterLength), tab.offset, [float(d) for d in tab.durata],
+                         tab.grazia, tab.altezze, tab.legatura, [[type(a).__name__ for a in arts] for arts in tab.articolazioni],
+                         [repr(el) for el in motore.dinamiche_e_testi(m).coppie()]))
+        dati.append(sorted((num, repr(voce["armature"]), repr(voce["tempi"]), repr(voce["indicazioni"]))
+                           for num, voce in motore.indicizza_misure(parte).items()))
+    return dati
+
+
+def _piu_veloce(funzione, ripetizioni):
+    migliore, risultato = None, None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        risultato = funzione()
+        secondi = time.perf_counter() - inizio
+        migliore = secondi if migliore is None else min(migliore, secondi)
+    return migliore, risultato
+
+
+def confronta_letture(percorsi, ripetizioni=3, notifica=None):
+    """Per file: secondi (i migliori su ripetizioni) di converter.parse, leggi_partitura e
+    lettura diretta, accelerazione rispetto a converter.parse, "stesse_mani" (o "non_supportata")."""
+    notifica = notifica or (lambda messaggio: None)
+    casi = {}
+    for percorso in percorsi:
+        with open(percorso, "rb") as f: dati = f.read()
+        estensione = os.path.splitext(percorso)[1].lower()
+        caso = {"converter_parse_s": _piu_veloce(lambda: converter.parse(percorso, forceSource=True), ripetizioni)[0]}
+        caso["leggi_partitura_s"], completa = _piu_veloce(lambda: leggi_partitura(dati, estensione), ripetizioni)
+        try:
+            caso["lettura_diretta_s"], mani = _piu_veloce(lambda: leggi_mani_diretta(dati, estensione), ripetizioni)
+        except LetturaNonSupportata as e:
+            caso["non_supportata"] = str(e)
+            notifica(f"{os.path.basename(percorso):>32}  {caso['converter_parse_s']:8.3f} s  lettura diretta non supportata: {e}")
+        else:
+            caso["accelerazione"] = caso["converter_parse_s"] / caso["lettura_diretta_s"]
+            caso["stesse_mani"] = _dati_delle_mani(completa) == _dati_delle_mani(mani)
+            notifica(f"{os.path.basename(percorso):>32}  {caso['converter_parse_s']:8.3f} s  {caso['leggi_partitura_s']:8.3f} s  "
+                     f"{caso['lettura_diretta_s']:8.3f} s  x{caso['accelerazione']:.1f}  " + ("stesse mani" if caso["stesse_mani"] else "MANI DIVERSE"))
+        casi[os.path.basename(percorso)] = caso
+    return casi
+
+
+def rendimento_sarto(strumenti=range(1, 9), note=(1, 4, 12), problemi=2000, seme=0, notifica=None):
+    """Per (strumenti liberi, note scartate): microsecondi per assegnazione e assegnazioni al
+    secondo di sarto.assegna, e microsecondi per misura e misure al secondo di sarto.assegna_misura
+    (problemi // 10 misure di OFFSET_SARTO crome), su problemi casuali con strumenti veri (dal più acuto)."""
+    notifica = notifica or (lambda messaggio: None)
+    caso_random = random.Random(seme)
+    ordinati = sorted(ESTENSIONI, key=lambda s: -(ESTENSIONI[s].minimo + ESTENSIONI[s].massimo))
+    croma = TICK_PER_QUARTO // 2
+    senza_precedenti = Precedenti({}, None)
+    casi = {}
+    for n_strumenti in strumenti:
+        estratti = set(caso_random.sample(ordinati, n_strumenti))
+        estensioni = [ESTENSIONI[s] for s in ordinati if s in estratti]
+        per_nome = {s: ESTENSIONI[s] for s in ordinati if s in estratti}
+        for n_note in note:
+            lotto = [(sorted((caso_random.randint(24, 96) for _ in range(n_note)), reverse=True),
+                      [caso_random.choice((None, caso_random.randint(36, 90))) for _ in estensioni]) for _ in range(problemi)]
+            secondi = _piu_veloce(lambda: [assegna(altezze, estensioni, precedenti) for altezze, precedenti in lotto], 3)[0]
+            # Misure di crome: a volte una nota lunga tiene occupato lo strumento all'offset dopo
+            offsets = [k * croma for k in range(OFFSET_SARTO)]
+            misure = [([[(ps, caso_random.choice((croma, croma, 2 * croma))) for ps in sorted((caso_random.randint(24, 96) for _ in range(n_note)), reverse=True)]
+                        for _ in offsets], [[s for s in per_nome if caso_random.random() < 0.8] for _ in offsets]) for _ in range(problemi // 10)]
+            secondi_misura = _piu_veloce(lambda: [assegna_misura(offsets, note_misura, per_nome, liberi, senza_precedenti) for note_misura, liberi in misure], 3)[0]
+            secondi_offset = _piu_veloce(lambda: [assegna_misura(offsets, note_misura, per_nome, liberi, senza_precedenti, fascio=1, candidati=1)
+                                                  for note_misura, liberi in misure], 3)[0]
+            casi[f"{n_strumenti}x{n_note}"] = {"us_per_assegnazione": secondi / problemi * 1e6, "assegnazioni_al_s": problemi / secondi,
+                                               "us_per_misura": secondi_misura / len(misure) * 1e6, "misure_al_s": len(misure) / secondi_misura,
+                                               "us_per_misura_offset_per_offset": secondi_offset / len(misure) * 1e6}
+            notifica(f"{n_strumenti:>3} strumenti x {n_note:>2} note  {secondi / problemi * 1e6:8.1f} us  {problemi / secondi:10.0f} /s"
+                     f"  misura {secondi_misura / len(misure) * 1e6:8.1f} us  {len(misure) / secondi_misura:8.0f} /s"
+                     f"  (offset per offset {secondi_offset / len(misure) * 1e6:8.1f} us)")
+    return casi
+
+
+def rendimento_collocazione(dimensioni=None, note=20000, seme=0, notifica=None):
+    """Per ogni dimensione di formazione: nanosecondi per collocare una nota in ogni strumento
+    (spostamento d'ottava nell'estensione), dalle tabelle precalcolate e ricalcolandolo nota per nota."""
+    notifica = notifica or (lambda messaggio: None)
+    caso_random = random.Random(seme)
+    altezze = [caso_random.randint(21, 108) for _ in range(note)]
+    casi = {}
+    for n_strumenti in dimensioni or sorted(ENSEMBLE_PER_DIMENSIONE):
+        estensioni = [ESTENSIONI[s] for s in ENSEMBLE_PER_DIMENSIONE[n_strumenti]]
+        tabelle = _piu_veloce(lambda: [[e.spostamento(ps) for e in estensioni] for ps in altezze], 3)[0]
+        calcolo = _piu_veloce(lambda: [[spostamento_ottave(ps, e.minimo, e.massimo) for e in estensioni] for ps in altezze], 3)[0]
+        casi[str(n_strumenti)] = {"ns_per_nota_tabelle": tabelle / note * 1e9, "ns_per_nota_calcolo": calcolo / note * 1e9}
+        notifica(f"{n_strumenti:>3} strumenti  tabelle {tabelle / note * 1e9:8.0f} ns/nota  calcolo {calcolo / note * 1e9:8.0f} ns/nota")
+    return casi
+
+
+def latenza_anteprima(misure, ripetizioni=3, seme=0, notifica=None):
+    """Per ogni lunghezza: secondi di motore.anteprima sulle prime e sulle ultime
+    MISURE_ANTEPRIMA misure (l'esecuzione più veloce), con la formazione da 8 strumenti."""
+    notifica = notifica or (lambda messaggio: None)
+    casi = {}
+    for n_misure in misure:
+        dati = genera_mxl(n_misure, seme=seme)
+        ultima = min(motore.MISURE_ANTEPRIMA, n_misure)
+        caso = {}
+        for nome, prima in (("inizio_s", 1), ("fine_s", n_misure - ultima + 1)):
+            caso[nome] = _piu_veloce(lambda: motore.anteprima(dati, ENSEMBLE_PER_DIMENSIONE[8], prima, prima + ultima - 1), ripetizioni)[0]
+        casi[str(n_misure)] = caso
+        notifica(f"{n_misure:>6} misure  inizio {caso['inizio_s']:6.3f} s  fine {caso['fine_s']:6.3f} s")
+    return casi
+
+
+def confronta(risultati, riferimento, soglia=SOGLIA_PREDEFINITA, minimo_s=MINIMO_ASSOLUTO_S):
+    """Regressioni rispetto al riferimento, come messaggi (lista vuota se non ce ne sono).
+
+    Si confrontano i tempi di avvio e, per i casi presenti in entrambi, il tempo totale e quello
+    di ogni fase.
+    """
+    confronti = [("avvio", f, s, riferimento.get("avvio_s", {}).get(f)) for f, s in risultati.get("avvio_s", {}).items()]
+    for nome, caso in risultati["casi"].items():
+        vecchio = riferimento["casi"].get(nome)
+        if vecchio is None: continue
+        confronti.append((nome, "totale", caso["totale_s"], vecchio["totale_s"]))
+        confronti += [(nome, f, s, vecchio["fasi_s"].get(f, 0.0)) for f, s in caso["fasi_s"].items()]
+
+    regressioni = []
+    for nome, voce, nuovo_s, vecchio_s in confronti:
+        if vecchio_s is None: continue
+        if nuovo_s > vecchio_s * (1 + soglia) and nuovo_s - vecchio_s > minimo_s:
+            regressioni.append(f"{nome} {voce}: {vecchio_s:.3f} s -> {nuovo_s:.3f} s "
+                               f"(+{(nuovo_s / vecchio_s - 1) * 100 if vecchio_s else float('inf'):.0f}%)")
+    return regressioni
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del motore su partiture per pianoforte generate.")
+    parser.add_argument("--misure", nargs="+", type=int, default=[10, 100, 1000],
+                        help="Lunghezze delle partiture generate (da 10 a 5000 misure)")
+    parser.add_argument("--strumenti", nargs="+", type=int, default=[1, 2, 4, 8], choices=sorted(ENSEMBLE_PER_DIMENSIONE),
+                        help=f"Dimensioni delle formazioni, tra: {', '.join(map(str, sorted(ENSEMBLE_PER_DIMENSIONE)))}")
+    parser.add_argument("--tessiture", nargs="+", choices=TESSITURE, metavar="TESSITURA",
+                        help=f"Tessiture da mescolare, tra: {', '.join(TESSITURE)} (default: tutte)")
+    parser.add_argument("--ripetizioni", type=int, default=3, help="Esecuzioni per caso (si tiene la più veloce)")
+    parser.add_argument("-j", "--processi", type=int, default=1, help="Processi per l'orchestrazione")
+    parser.add_argument("--senza-originale", action="store_true", help="Non includere il pianoforte originale")
+    parser.add_argument("--seme", type=int, default=0, help="Seme delle partiture generate")
+    parser.add_argument("--finestra", type=int, metavar="MISURE", help="Orchestrazione a finestre di MISURE misure")
+    parser.add_argument("-o", "--output", help="File JSON dei risultati")
+    parser.add_argument("--riferimento", help="Risultati JSON con cui confrontarsi")
+    parser.add_argument("--soglia", type=float, default=SOGLIA_PREDEFINITA,
+                        help="Rallentamento relativo tollerato rispetto al riferimento (0.25 = +25%%)")
+    parser.add_argument("--lettura", nargs="+", metavar="FILE",
+                        help="Confronta solo i tempi di lettura di questi file (converter.parse, leggi_partitura, lettura diretta)")
+    parser.add_argument("--sarto", action="store_true",
+                        help="Misura solo il rendimento dell'assegnazione delle note scartate (sarto.assegna)")
+    parser.add_argument("--collocazione", action="store_true",
+                        help="Misura solo il costo per nota dello spostamento nelle estensioni, per dimensione di formazione")
+    parser.add_argument("--anteprima", action="store_true",
+                        help="Misura solo la latenza dell'anteprima MIDI, all'inizio e alla fine di partiture lunghe --misure")
+    args = parser.parse_args(argv)
+
+    if args.anteprima:
+        casi = latenza_anteprima(args.misure, args.ripetizioni, args.seme, notifica=print)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"ambiente": {"python": platform.python_version(), "music21": music21.__version__},
+                           "seme": args.seme, "casi": casi}, f, indent=2)
+        return 0
+
+    if args.collocazione:
+        casi = rendimento_collocazione(seme=args.seme, notifica=print)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"ambiente": {"python": platform.python_version()}, "seme": args.seme, "casi": casi}, f, indent=2)
+        return 0
+
+    if args.sarto:
+        casi = rendimento_sarto(seme=args.seme, notifica=print)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"ambiente": {"python": platform.python_version()}, "seme": args.seme, "casi": casi}, f, indent=2)
+        return 0
+
+    if args.lettura:
+        print(f"{'file':>32}  {'converter':>10}  {'music21':>10}  {'diretta':>10}")
+        casi = confronta_letture(args.lettura, args.ripetizioni, notifica=print)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"ambiente": {"python": platform.python_version(), "music21": music21.__version__},
+                           "ripetizioni": args.ripetizioni, "casi": casi}, f, indent=2)
+        return 0 if all(caso.get("stesse_mani", True) for caso in casi.values()) else 1
+
+    fuori_scala = [n for n in args.misure if not 10 <= n <= 5000]
+    if fuori_scala:
+        parser.error(f"lunghezze fuori scala (10-5000 misure): {fuori_scala}")
+
+    risultati = esegui(args.misure, args.strumenti, args.tessiture, args.ripetizioni, args.processi,
+                       keep_original=not args.senza_originale, seme=args.seme, notifica=print, finestra=args.finestra)
+    for nome, caso in risultati["casi"].items():
+        fasi = "  ".join(f"{f} {s:.3f}" for f, s in caso["fasi_s"].items())
+        print(f"{nome:>10}  {fasi}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(risultati, f, indent=2)
+
+    if args.riferimento:
+        with open(args.riferimento) as f:
+            regressioni = confronta(risultati, json.load(f), args.soglia)
+        for messaggio in regressioni:
+            print(f"REGRESSIONE {messaggio}", file=sys.stderr)
+        if regressioni: return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Cache LRU in memoria, condivise tra le esecuzioni dello stesso processo."""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def impronta(dati):
+    """Hash del contenuto, usato come chiave stabile per i file caricati."""
+    return hashlib.sha256(dati).hexdigest()
+
+
+class CacheLRU:
+    """Cache LRU limitata per numero di voci e, opzionalmente, per peso totale.
+
+    Il peso di ogni voce lo decide il chiamante (es. la dimensione in byte del file
+    sorgente): quando uno dei due limiti viene superato si scartano le voci usate meno
+    di recente. Sicura da usare da più thread (le sessioni Streamlit girano in parallelo).
+    """
+
+    def __init__(self, max_voci, max_peso=None):
+        self.max_voci = max_voci
+        self.max_peso = max_peso
+        self._voci = OrderedDict()
+        self._peso_totale = 0
+        self._lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+
+    def get(self, chiave, default=None):
+        with self._lock:
+            if chiave not in self._voci:
+                self.miss += 1
+                return default
+            self._voci.move_to_end(chiave)
+            self.hit += 1
+            return self._voci[chiave][0]
+
+    def put(self, chiave, valore, peso=1):
+        with self._lock:
+            if chiave in self._voci:
+                self._peso_totale -= self._voci.pop(chiave)[1]
+            if self.max_peso is not None and peso > self.max_peso:
+                return
+            self._voci[chiave] = (valore, peso)
+            self._peso_totale += peso
+            while len(self._voci) > self.max_voci or (self.max_peso is not None and self._peso_totale > self.max_peso):
+                _, (_, peso_scartato) = self._voci.popitem(last=False)
+                self._peso_totale -= peso_scartato
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self._peso_totale = 0
+
+    def __contains__(self, chiave):
+        with self._lock:
+            return chiave in self._voci
+
+    def __len__(self):
+        return len(self._voci)
@@ -0,0 +1,103 @@
+"""Cassetti di lavoro: gli eventi di una misura per uno strumento e i suoi intervalli occupati."""
+from bisect import bisect_left, bisect_right
+
+from eventi import MappaDinamiche
+
+
+def _unisci(inizi, fini, inizio, fine):
+    # Inserisce [inizio, fine) nella lista ordinata di intervalli disgiunti, fondendo quelli
+    # che si sovrappongono o si toccano
+    if fine <= inizio: return
+    sx = bisect_left(fini, inizio)
+    dx = bisect_right(inizi, fine)
+    if sx < dx:
+        inizio = min(inizio, inizi[sx])
+        fine = max(fine, fini[dx - 1])
+    inizi[sx:dx] = [inizio]
+    fini[sx:dx] = [fine]
+
+
+class Occupazione:
+    """Indice ordinato degli intervalli suonati in un cassetto, aggiornato a ogni inserimento.
+
+    Una sola lista di intervalli [inizio, fine) già uniti, in tick: con una ricerca binaria dice
+    se lo strumento è libero a un dato offset, e da lì l'assemblaggio ricava le pause da inserire.
+    """
+
+    __slots__ = ("_inizi", "_fini")
+
+    def __init__(self):
+        self.svuota()
+
+    def svuota(self):
+        self._inizi, self._fini = [], []
+
+    def aggiungi(self, offset, durata):
+        _unisci(self._inizi, self._fini, offset, offset + durata)
+
+    def e_libero(self, offset):
+        i = bisect_right(self._inizi, offset) - 1
+        return i < 0 or offset >= self._fini[i]
+
+    def intervalli_uniti(self):
+        return list(zip(self._inizi, self._fini))
+
+
+# Mappa vuota condivisa dai cassetti senza dinamiche: non si modifica mai
+_NESSUNA_DINAMICA = MappaDinamiche()
+
+
+class Cassetto:
+    """Misura in costruzione per uno strumento: eventi (vedi eventi.Evento) e dinamiche per offset
+    in tick (vedi eventi.MappaDinamiche), con l'occupazione aggiornata a ogni nota. La misura music21 si
+    crea in finalizzazione.
+
+    Un cassetto che raddoppia un'altra parte non ha eventi propri: tiene il riferimento al
+    raddoppio (vedi eventi.Raddoppio) e condivide l'occupazione della sorgente, che da lì in
+    poi non riceve più note."""
+
+    __slots__ = ("numero", "eventi", "dinamiche", "occupazione", "raddoppio")
+
+    def __init__(self, num):
+        self.numero = num
+        self.eventi = []
+        self.dinamiche = _NESSUNA_DINAMICA
+        self.occupazione = Occupazione()
+        self.raddoppio = None
+
+    def inserisci(self, evento):
+        self.eventi.append(evento)
+        if evento.durata > 0:
+            self.occupazione.aggiungi(evento.offset, evento.durata)
+
+    def aggiungi_dinamiche(self, dinamiche):
+        # La mappa della misura sorgente si condivide così com'è; solo se il cassetto ne ha già
+        # un'altra si uniscono in una nuova (una sola dinamica, o testo, dello stesso tipo per offset)
+        if not self.dinamiche:
+            self.dinamiche = dinamiche
+            return
+        unite = MappaDinamiche(self.dinamiche.coppie())
+        for offset, el in dinamiche.coppie(): unite.aggiungi(offset, el)
+        self.dinamiche = unite
+
+    def eventi_in_ordine(self):
+        # Stesso ordine di misura.notes: per offset, a parità nell'ordine di inserimento
+        return sorted(self.eventi, key=lambda ev: ev.offset)
+
+    def svuota_note(self):
+        self.eventi = []
+        self.occupazione = Occupazione()
+        self.raddoppio = None
+
+    def raddoppia(self, raddoppio):
+        # Le note già presenti lasciano il posto a quelle della sorgente, come dopo svuota_note
+        self.eventi = []
+        self.occupazione = raddoppio.sorgente.occupazione
+        self.raddoppio = raddoppio
+
+    def note_suonate(self):
+        # Note che la misura avrà, senza costruirle
+        return len(self.eventi) if self.raddoppio is None else len(self.raddoppio.eventi_in_ordine())
+
+    def e_libero(self, offset):
+        return self.occupazione.e_libero(offset)
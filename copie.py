@@ -0,0 +1,123 @@
+"""Copie leggere degli oggetti music21 usati dal motore, e conteggio delle copie profonde.
+
+Durate, articolazioni, note e dinamiche si ricostruiscono dai soli attributi che servono, con
+prototipi immutabili condivisi dove possibile. Ogni copia profonda, di oggetti music21 interi
+(accordi, armature, parti intere) come delle parti piccole di una nota copiata (altezza, travature,
+legatura di valore), passa da copia_profonda, che la conta.
+"""
+import contextvars
+import copy
+
+from music21 import duration, dynamics, expressions, instrument, note
+
+_contatore_attivo = contextvars.ContextVar("contatore_copie", default=None)
+
+
+class ContatoreCopie:
+    """Conta le copie profonde fatte dentro il blocco with (separatamente per ogni thread)."""
+
+    def __init__(self):
+        self.copie_profonde = 0
+        self._token = None
+
+    def __enter__(self):
+        self._token = _contatore_attivo.set(self)
+        return self
+
+    def __exit__(self, *eccezione):
+        _contatore_attivo.reset(self._token)
+
+
+def registra_copie(n):
+    # Copie fatte altrove (per esempio in un processo figlio) per conto dell'esecuzione corrente
+    contatore = _contatore_attivo.get()
+    if contatore is not None: contatore.copie_profonde += n
+
+
+def copia_profonda(oggetto):
+    contatore = _contatore_attivo.get()
+    if contatore is not None: contatore.copie_profonde += 1
+    return copy.deepcopy(oggetto)
+
+
+def nuova_durata(sorgente):
+    # Le durate semplici condividono il DurationTuple (immutabile) della sorgente; gruppi
+    # irregolari, abbellimenti e durate composte si copiano
+    if sorgente.isGrace or sorgente.tuplets or len(sorgente.components) != 1 or not sorgente.linked:
+        return copia_profonda(sorgente)
+    return duration.Duration(durationTuple=sorgente.components[0])
+
+
+# Articolazioni senza stile proprio, una per tipo e valori: nessuno le modifica dopo
+# l'inserimento, quindi più note possono condividere la stessa istanza. I valori sono tutti gli
+# attributi dell'oggetto (posizione, diteggiatura, numero di corda o di tasto...), tranne lo
+# stato di music21 che non descrive l'articolazione
+_prototipi_articolazioni = {}
+_STATO_DI_CONTESTO = frozenset(("sites", "_activeSite", "_activeSiteStoredOffset", "_cache", "_derivation",
+                                "_naiveOffset", "_duration", "_id", "_editorial", "_style"))
+
+def articolazione_condivisa(art):
+    if art.hasStyleInformation or art.hasEditorialInformation or art._id is not None: return copia_profonda(art)
+    valori = tuple(sorted((nome, tuple(valore) if nome == "groups" else valore)
+                          for nome, valore in vars(art).items() if nome not in _STATO_DI_CONTESTO))
+    chiave = (type(art), valori)
+    try:
+        prototipo = _prototipi_articolazioni.get(chiave)
+    except TypeError:
+        # Un valore non hashable (per esempio gli spanner di HammerOn): niente prototipo
+        return copia_profonda(art)
+    if prototipo is None:
+        prototipo = _prototipi_articolazioni[chiave] = copia_profonda(art)
+    return prototipo
+
+
+def copia_nota(sorgente):
+    # Equivale a copy.deepcopy di una Note, campo per campo: restano gli attributi che arrivano
+    # nel MusicXML e la derivazione, che music21 segue per trovare il contesto (chiave, gambi)
+    if type(sorgente) is not note.Note or sorgente.hasVolumeInformation():
+        return copia_profonda(sorgente)
+
+    n = note.Note(copia_profonda(sorgente.pitch), duration=nuova_durata(sorgente.duration))
+    n.derivation.origin = sorgente
+    n.derivation.method = '__deepcopy__'
+    if sorgente._id is not None: n.id = sorgente.id
+    n.priority = sorgente.priority
+    n.groups = list(sorgente.groups)
+    n.stemDirection = sorgente.stemDirection
+    n.notehead = sorgente.notehead
+    n.noteheadFill = sorgente.noteheadFill
+    n.noteheadParenthesis = sorgente.noteheadParenthesis
+    if sorgente.beams: n.beams = copia_profonda(sorgente.beams)
+    if sorgente.tie is not None: n.tie = copia_profonda(sorgente.tie)
+    if sorgente.articulations: n.articulations = [articolazione_condivisa(art) for art in sorgente.articulations]
+    if sorgente.expressions: n.expressions = copia_profonda(sorgente.expressions)
+    if sorgente.lyrics: n.lyrics = copia_profonda(sorgente.lyrics)
+    if sorgente.hasStyleInformation: n.style = copy.copy(sorgente.style)
+    if sorgente.hasEditorialInformation: n.editorial = copia_profonda(sorgente.editorial)
+    return n
+
+
+def copia_dinamica(sorgente):
+    # Dinamiche e testi: nuovo oggetto con lo stesso valore, posizione e stile (copia superficiale)
+    if type(sorgente) is dynamics.Dynamic:
+        nuovo = dynamics.Dynamic(sorgente.value)
+    elif type(sorgente) is expressions.TextExpression:
+        nuovo = expressions.TextExpression(sorgente.content)
+        nuovo.tieAttach = sorgente.tieAttach
+    else:
+        return copia_profonda(sorgente)
+    nuovo.placement = sorgente.placement
+    nuovo.priority = sorgente.priority
+    if sorgente.hasStyleInformation: nuovo.style = copy.copy(sorgente.style)
+    if sorgente.hasEditorialInformation: nuovo.editorial = copia_profonda(sorgente.editorial)
+    return nuovo
+
+
+def nuova_istanza(prototipo):
+    # Chiavi e strumenti della libreria: oggetti senza stato proprio, si ricostruiscono dalla
+    # classe; degli strumenti si riporta la trasposizione, che strumenti.json può cambiare
+    # rispetto a quella di music21 (il Controfagotto suona un'ottava sotto)
+    nuovo = type(prototipo)()
+    if isinstance(prototipo, instrument.Instrument) and prototipo.transposition != nuovo.transposition:
+        nuovo.transposition = copia_profonda(prototipo.transposition)
+    return nuovo
@@ -0,0 +1,113 @@
+"""Strumentazione del motore: tempi delle fasi e delle misure, e contatori, raccolti solo quando
+un Cronometro è attivo.
+
+Senza cronometro le chiamate costano un controllo di ContextVar: il motore le lascia sempre
+al loro posto. Le fasi non si sovrappongono, quindi la somma dei tempi è il tempo misurato.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+_cronometro_attivo = contextvars.ContextVar("cronometro", default=None)
+
+
+class Cronometro:
+    """Raccoglie, dentro il blocco with (separatamente per ogni thread):
+
+    - fasi: secondi per fase (lettura, analisi, melodia, ...);
+    - misure: secondi per numero di misura (orchestrazione e finalizzazione di tutte le parti);
+    - contatori: conteggi semplici (nome -> n) o per voce (nome -> {voce: n}).
+    """
+
+    def __init__(self):
+        self.fasi = {}
+        self.misure = {}
+        self.contatori = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = _cronometro_attivo.set(self)
+        return self
+
+    def __exit__(self, *eccezione):
+        _cronometro_attivo.reset(self._token)
+
+    def aggiungi(self, nome, secondi):
+        self.fasi[nome] = self.fasi.get(nome, 0.0) + secondi
+
+    def aggiungi_misura(self, num, secondi):
+        self.misure[num] = self.misure.get(num, 0.0) + secondi
+
+    def conta(self, nome, quantita=1, voce=None):
+        if voce is None:
+            self.contatori[nome] = self.contatori.get(nome, 0) + quantita
+        else:
+            per_voce = self.contatori.setdefault(nome, {})
+            per_voce[voce] = per_voce.get(voce, 0) + quantita
+
+    def riepilogo(self):
+        # Dati semplici (serializzabili in JSON e trasferibili tra processi)
+        return {"fasi_s": self.fasi, "misure_s": self.misure, "contatori": self.contatori}
+
+    def unisci(self, riepilogo):
+        for nome, secondi in riepilogo["fasi_s"].items(): self.aggiungi(nome, secondi)
+        for num, secondi in riepilogo["misure_s"].items(): self.aggiungi_misura(num, secondi)
+        for nome, valore in riepilogo["contatori"].items():
+            if isinstance(valore, dict):
+                for voce, quantita in valore.items(): self.conta(nome, quantita, voce)
+            else:
+                self.conta(nome, valore)
+
+
+@contextmanager
+def fase(nome):
+    cronometro = _cronometro_attivo.get()
+    if cronometro is None:
+        yield
+        return
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        cronometro.aggiungi(nome, time.perf_counter() - inizio)
+
+
+def conta(nome, quantita=1, voce=None):
+    cronometro = _cronometro_attivo.get()
+    if cronometro is not None: cronometro.conta(nome, quantita, voce)
+
+
+class Giro:
+    """Cronometro a giri per le fasi consecutive di una stessa funzione: fase(nome) attribuisce
+    a nome il tempo trascorso dalla fase precedente (o dalla creazione del giro), misura(num)
+    attribuisce alla misura num il tempo trascorso dalla creazione."""
+
+    __slots__ = ("_cronometro", "_inizio", "_ultimo")
+
+    def __init__(self):
+        self._cronometro = _cronometro_attivo.get()
+        self._inizio = self._ultimo = time.perf_counter() if self._cronometro is not None else None
+
+    @property
+    def attivo(self):
+        return self._cronometro is not None
+
+    def fase(self, nome):
+        if self._cronometro is None: return
+        adesso = time.perf_counter()
+        self._cronometro.aggiungi(nome, adesso - self._ultimo)
+        self._ultimo = adesso
+
+    def misura(self, num):
+        if self._cronometro is None: return
+        self._cronometro.aggiungi_misura(num, time.perf_counter() - self._inizio)
+
+    def conta(self, nome, quantita=1, voce=None):
+        if self._cronometro is not None: self._cronometro.conta(nome, quantita, voce)
+
+
+def registra(riepilogo):
+    # Tempi e contatori raccolti altrove (per esempio in un processo figlio) per conto
+    # dell'esecuzione corrente
+    cronometro = _cronometro_attivo.get()
+    if cronometro is not None: cronometro.unisci(riepilogo)
@@ -0,0 +1,151 @@
+"""Rappresentazione compatta usata dal motore: tabelle delle mani ed eventi dei cassetti.
+
+Le fasi di orchestrazione (melodia, accompagnamento, pattern, Il Sarto, raddoppi) lavorano
+solo su questi dati; gli oggetti music21 delle parti orchestrate si creano in finalizzazione.
+Offset e durate sono in tick interi (vedi griglia.py).
+"""
+from music21 import articulations
+
+from griglia import in_tick
+
+
+class TabellaMano:
+    """Note e accordi di una mano in una misura, in colonne parallele (una riga per elemento).
+
+    La misura viene appiattita una volta sola; offset e durate sono in tick. Le altezze di ogni riga sono coppie (ps, nome)
+    ordinate dal grave all'acuto; articolazioni esclude le diteggiature, come copia_proprieta.
+    Insieme alle colonne si calcolano una volta le caratteristiche della mano lette dalle fasi
+    del motore: righe non di abbellimento e suonate, quota di accordi, altezza media e durate minime.
+    """
+
+    __slots__ = ("elementi", "offset", "durata", "grazia", "nota_o_accordo", "accordo",
+                 "altezze", "ps_basso", "legatura", "articolazioni", "pattern",
+                 "non_grazia", "suonate", "quota_accordi", "altezza_media", "durata_minima", "durata_minima_positiva")
+
+    def __init__(self, misura):
+        self.elementi = list(misura.flatten().notes)
+        self.offset, self.durata, self.grazia, self.nota_o_accordo, self.accordo = [], [], [], [], []
+        self.altezze, self.ps_basso, self.legatura, self.articolazioni = [], [], [], []
+
+        for el in self.elementi:
+            self.offset.append(in_tick(el.offset))
+            self.durata.append(in_tick(el.quarterLength))
+            self.grazia.append(getattr(el.duration, 'isGrace', False))
+            self.nota_o_accordo.append('Note' in el.classSet or 'Chord' in el.classSet)
+
+            pitches = el.pitches if hasattr(el, 'pitches') else ()
+            self.accordo.append(len(pitches) > 1)
+            if pitches:
+                altezze = [(p.ps, p.nameWithOctave) for p in sorted(pitches)]
+            elif hasattr(el, 'pitch'):
+                altezze = [(el.pitch.ps, el.pitch.nameWithOctave)]
+            else:
+                altezze = []
+            self.altezze.append(altezze)
+            self.ps_basso.append(min(ps for ps, _ in altezze) if altezze else 60)
+
+            self.legatura.append(el.tie.type if getattr(el, 'tie', None) is not None else None)
+            self.articolazioni.append(tuple(art for art in getattr(el, 'articulations', ())
+                                            if not isinstance(art, articulations.Fingering)))
+        # Pattern riconosciuti sulla mano, calcolati dal motore al primo uso (non dipendono dalla formazione)
+        self.pattern = None
+
+        # Righe senza abbellimenti; di queste, quelle con durata (nell'ordine della misura)
+        self.non_grazia = [i for i in range(len(self.elementi)) if not self.grazia[i]]
+        self.suonate = [i for i in self.non_grazia if self.durata[i] > 0]
+        # Quota di accordi e altezza media (None senza altezze) sulle righe senza abbellimenti
+        self.quota_accordi = sum(self.accordo[i] for i in self.non_grazia) / len(self.non_grazia) if self.non_grazia else 0.0
+        ps = [ps for i in self.non_grazia for ps, _ in self.altezze[i]]
+        self.altezza_media = sum(ps) / len(ps) if ps else None
+        # Durata minima delle righe suonate e di tutte le righe con durata (None se non ce ne sono)
+        self.durata_minima = min((self.durata[i] for i in self.suonate), default=None)
+        self.durata_minima_positiva = min((d for d in self.durata if d > 0), default=None)
+
+    def __len__(self):
+        return len(self.elementi)
+
+    def righe_suonate(self, righe=None):
+        # Righe non di abbellimento e con durata, nell'ordine della misura (tra righe, se date)
+        if righe is None: return self.suonate
+        return [i for i in righe if not self.grazia[i] and self.durata[i] > 0]
+
+
+class AnalisiMisura:
+    """Ciò che di una coppia di misure sorgente non dipende dalla formazione, riusabile tra
+    esecuzioni con strumenti diversi: tabelle delle mani, ruolo delle mani, offset e altezze
+    della melodia (in ordine di scelta), dinamiche e testi di ciascuna mano per offset (vedi
+    MappaDinamiche). Va trattata in sola lettura.
+    """
+
+    __slots__ = ("tab_dx", "tab_sx", "is_dx_melodia", "is_melodia_bassa", "melodia", "dinamiche_dx", "dinamiche_sx")
+
+    def __init__(self, tab_dx, tab_sx, is_dx_melodia, is_melodia_bassa, melodia, dinamiche_dx, dinamiche_sx):
+        self.tab_dx = tab_dx
+        self.tab_sx = tab_sx
+        self.is_dx_melodia = is_dx_melodia
+        self.is_melodia_bassa = is_melodia_bassa
+        self.melodia = melodia
+        self.dinamiche_dx = dinamiche_dx
+        self.dinamiche_sx = dinamiche_sx
+
+
+class MappaDinamiche(dict):
+    """Dinamiche e testi di una misura: offset (in tick) -> elementi, nell'ordine della misura, con al più
+    un elemento per tipo a ogni offset (il primo). I cassetti la condividono in sola lettura."""
+
+    __slots__ = ()
+
+    def __init__(self, elementi=()):
+        super().__init__()
+        for offset, el in elementi: self.aggiungi(offset, el)
+
+    def aggiungi(self, offset, el):
+        presenti = self.setdefault(offset, [])
+        if not any(isinstance(d, type(el)) for d in presenti): presenti.append(el)
+
+    def coppie(self):
+        return [(offset, el) for offset, elementi in self.items() for el in elementi]
+
+
+class Evento:
+    """Nota destinata a un cassetto, descritta dai soli dati necessari a costruirla alla fine.
+
+    Due forme, come le note che il motore inseriva prima nei cassetti:
+    - nome: nota nuova con quell'altezza, durata e proprietà della riga della tabella;
+    - senza nome: copia dell'elemento sorgente, con ps e/o durata eventualmente sostituiti
+      (pattern della mano sinistra).
+    Offset, durata e nuova_durata sono in tick. L'ottava viene poi adattata all'estensione di
+    strumento; oggetto conserva la nota costruita.
+    I raddoppi non hanno eventi propri (vedi Raddoppio).
+    """
+
+    __slots__ = ("offset", "durata", "tabella", "riga", "strumento", "nome", "ps", "nuova_durata", "oggetto")
+
+    def __init__(self, offset, durata, tabella, riga, strumento, nome=None, ps=None, nuova_durata=None):
+        self.offset = offset
+        self.durata = durata
+        self.tabella = tabella
+        self.riga = riga
+        self.strumento = strumento
+        self.nome = nome
+        self.ps = ps
+        self.nuova_durata = nuova_durata
+        self.oggetto = None
+
+
+class Raddoppio:
+    """Riferimento con cui una parte raddoppia un'altra in una misura (clona_parte): le note
+    con durata del cassetto sorgente, rese monofoniche e adattate all'estensione di strumento.
+    Nessuna nota viene copiata durante l'orchestrazione: le note del raddoppio si costruiscono
+    solo in finalizzazione, a partire da quelle già costruite della sorgente.
+    """
+
+    __slots__ = ("sorgente", "strumento")
+
+    def __init__(self, sorgente, strumento):
+        self.sorgente = sorgente
+        self.strumento = strumento
+
+    def eventi_in_ordine(self):
+        # Eventi della sorgente che il raddoppio suona, nell'ordine in cui vanno nella misura
+        return [ev for ev in self.sorgente.eventi_in_ordine() if ev.durata > 0]
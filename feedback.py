@@ -0,0 +1,204 @@
+"""Feedback degli utenti: una casella d'uscita su SQLite e un postino in background.
+
+L'interfaccia scrive il messaggio nella casella (un file SQLite, che sopravvive ai riavvii) e
+risponde subito; il postino, in un thread, lo consegna con una sessione HTTP riusata, con
+timeout, e ritenta gli invii falliti con attese crescenti. Un messaggio si toglie dalla coda
+solo quando il server risponde 2xx: la consegna è "almeno una volta" (una risposta persa per
+timeout può produrre un doppione).
+
+    casella = CasellaUscita("feedback.sqlite3")
+    postino = Postino(casella, "https://api.telegram.org/bot<TOKEN>/sendMessage",
+                      lambda testo: {"chat_id": CHAT_ID, "text": testo}).avvia()
+    casella.aggiungi("Ottimo lavoro!"); postino.sveglia()
+
+Da riga di comando consegna i messaggi in attesa (o ne mostra lo stato), anche verso un server
+locale di prova:
+
+    python feedback.py feedback.sqlite3 --url http://localhost:8000/sendMessage --chat-id 1
+"""
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+
+TIMEOUT_CONNESSIONE_S = 3.05
+TIMEOUT_LETTURA_S = 10.0
+MAX_TENTATIVI = 8
+ATTESA_BASE_S = 2.0
+ATTESA_MAX_S = 15 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messaggi (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    testo TEXT NOT NULL,
+    creato REAL NOT NULL,
+    tentativi INTEGER NOT NULL DEFAULT 0,
+    prossimo_tentativo REAL NOT NULL,
+    inviato REAL,
+    ultimo_errore TEXT
+)
+"""
+
+
+class CasellaUscita:
+    """Messaggi da consegnare, in un file SQLite. Ogni operazione apre la sua connessione,
+    quindi la casella si usa da più thread (e da più processi) senza altro coordinamento."""
+
+    def __init__(self, percorso, max_tentativi=MAX_TENTATIVI):
+        self.percorso = percorso
+        self.max_tentativi = max_tentativi
+        with closing(self._connessione()) as con, con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(_SCHEMA)
+
+    def _connessione(self):
+        return sqlite3.connect(self.percorso, timeout=30)
+
+    def aggiungi(self, testo):
+        adesso = time.time()
+        with closing(self._connessione()) as con, con:
+            return con.execute("INSERT INTO messaggi (testo, creato, prossimo_tentativo) VALUES (?, ?, ?)",
+                               (testo, adesso, adesso)).lastrowid
+
+    def da_inviare(self, limite=100, adesso=None):
+        # (id, testo, tentativi) dei messaggi non consegnati, non abbandonati e con il tentativo scaduto
+        with closing(self._connessione()) as con:
+            return con.execute("SELECT id, testo, tentativi FROM messaggi WHERE inviato IS NULL AND tentativi < ? AND prossimo_tentativo <= ?"
+                               " ORDER BY id LIMIT ?", (self.max_tentativi, adesso or time.time(), limite)).fetchall()
+
+    def prossimo_tentativo(self):
+        # Istante del prossimo tentativo in programma (None se non c'è niente da inviare)
+        with closing(self._connessione()) as con:
+            return con.execute("SELECT MIN(prossimo_tentativo) FROM messaggi WHERE inviato IS NULL AND tentativi < ?",
+                               (self.max_tentativi,)).fetchone()[0]
+
+    def segna_inviato(self, id_messaggio):
+        with closing(self._connessione()) as con, con:
+            con.execute("UPDATE messaggi SET inviato = ?, tentativi = tentativi + 1, ultimo_errore = NULL WHERE id = ?",
+                        (time.time(), id_messaggio))
+
+    def segna_fallito(self, id_messaggio, errore, attesa_s):
+        with closing(self._connessione()) as con, con:
+            con.execute("UPDATE messaggi SET tentativi = tentativi + 1, ultimo_errore = ?, prossimo_tentativo = ? WHERE id = ?",
+                        (str(errore)[:500], time.time() + attesa_s, id_messaggio))
+
+    def stato(self):
+        """Conteggi: "inviati", "in_attesa", "abbandonati" (oltre max_tentativi)."""
+        with closing(self._connessione()) as con:
+            inviati, in_attesa, abbandonati = con.execute(
+                "SELECT SUM(inviato IS NOT NULL), SUM(inviato IS NULL AND tentativi < ?), SUM(inviato IS NULL AND tentativi >= ?)"
+                " FROM messaggi", (self.max_tentativi, self.max_tentativi)).fetchone()
+        return {"inviati": inviati or 0, "in_attesa": in_attesa or 0, "abbandonati": abbandonati or 0}
+
+
+def attesa_tentativo(tentativo, base_s=ATTESA_BASE_S, max_s=ATTESA_MAX_S):
+    # Backoff esponenziale con jitter pieno: i messaggi falliti insieme non ritentano insieme
+    return random.uniform(0, min(max_s, base_s * 2 ** tentativo))
+
+
+class Postino:
+    """Consegna in background i messaggi della casella, con POST JSON a url.
+
+    prepara(testo) costruisce il corpo JSON della richiesta. La sessione HTTP (requests) è una
+    sola per postino e riusa le connessioni; ogni richiesta ha i suoi timeout. Sono errori
+    da ritentare le eccezioni di rete e le risposte non 2xx (per un 429 si rispetta Retry-After).
+    """
+
+    def __init__(self, casella, url, prepara, timeout=(TIMEOUT_CONNESSIONE_S, TIMEOUT_LETTURA_S),
+                 attesa_base_s=ATTESA_BASE_S, attesa_max_s=ATTESA_MAX_S, intervallo_s=60.0):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.casella, self.url, self.prepara, self.timeout = casella, url, prepara, timeout
+        self.attesa_base_s, self.attesa_max_s, self.intervallo_s = attesa_base_s, attesa_max_s, intervallo_s
+        self._sessione = requests.Session()
+        self._sessione.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self._sessione.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self._sveglia = threading.Event()
+        self._fermo = threading.Event()
+        self._thread = None
+
+    def avvia(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._ciclo, name="postino-feedback", daemon=True)
+            self._thread.start()
+        return self
+
+    def sveglia(self):
+        # Un messaggio nuovo: non aspettare il prossimo giro
+        self._sveglia.set()
+
+    def ferma(self, attesa_s=5.0):
+        self._fermo.set()
+        self._sveglia.set()
+        if self._thread is not None: self._thread.join(attesa_s)
+        self._sessione.close()
+
+    def consegna(self):
+        """Un giro di consegna dei messaggi pronti; restituisce quanti sono stati consegnati."""
+        consegnati = 0
+        for id_messaggio, testo, tentativi in self.casella.da_inviare():
+            if self._fermo.is_set(): break
+            consegnati += self._consegna_uno(id_messaggio, testo, tentativi)
+        return consegnati
+
+    def _consegna_uno(self, id_messaggio, testo, tentativi):
+        import requests
+        try:
+            risposta = self._sessione.post(self.url, json=self.prepara(testo), timeout=self.timeout)
+        except requests.RequestException as e:
+            return self._fallito(id_messaggio, tentativi, e)
+        if 200 <= risposta.status_code < 300:
+            self.casella.segna_inviato(id_messaggio)
+            return 1
+        attesa = None
+        if risposta.status_code == 429:
+            try: attesa = float(risposta.headers.get("Retry-After", ""))
+            except ValueError: pass
+        return self._fallito(id_messaggio, tentativi, f"HTTP {risposta.status_code}: {risposta.text[:200]}", attesa)
+
+    def _fallito(self, id_messaggio, tentativi, errore, attesa=None):
+        if attesa is None: attesa = attesa_tentativo(tentativi + 1, self.attesa_base_s, self.attesa_max_s)
+        self.casella.segna_fallito(id_messaggio, errore, attesa)
+        return 0
+
+    def _ciclo(self):
+        errori = 0
+        while not self._fermo.is_set():
+            try:
+                self.consegna()
+                prossimo = self.casella.prossimo_tentativo()
+            except Exception as e:
+                # La casella non deve fermare il postino (per esempio database occupato o disco
+                # pieno): si riprova con attese crescenti, al più un intervallo
+                errori += 1
+                print(f"Postino del feedback: {e}", file=sys.stderr)
+                attesa = min(self.intervallo_s, attesa_tentativo(errori, self.attesa_base_s, self.attesa_max_s))
+            else:
+                errori = 0
+                attesa = self.intervallo_s if prossimo is None else min(self.intervallo_s, max(0.0, prossimo - time.time()))
+            self._sveglia.wait(attesa)
+            self._sveglia.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consegna (o mostra) i feedback in attesa nella casella d'uscita.")
+    parser.add_argument("casella", help="File SQLite della casella d'uscita")
+    parser.add_argument("--url", help="Endpoint a cui consegnare i messaggi (POST JSON)")
+    parser.add_argument("--chat-id", help="chat_id da aggiungere a ogni messaggio (API di Telegram)")
+    args = parser.parse_args(argv)
+
+    casella = CasellaUscita(args.casella)
+    if args.url:
+        postino = Postino(casella, args.url, lambda testo: {"chat_id": args.chat_id, "text": testo, "parse_mode": "Markdown"})
+        print(f"Consegnati: {postino.consegna()}")
+        postino.ferma()
+    print(json.dumps(casella.stato()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
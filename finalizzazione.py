@@ -0,0 +1,196 @@
+"""Finalizzazione delle parti orchestrate: un solo passaggio lineare per parte.
+
+Per ogni misura, in ordine: armature e indicazioni di tempo solo dove cambiano, note troncate
+alla stanghetta, pause nei vuoti, durate non rappresentabili spezzate, gruppi irregolari,
+legature ripulite rispetto alla nota precedente, alterazioni, travature e gambi. Lo stato che
+music21 cercherebbe nel contesto (armatura e tempo correnti, misura e nota precedenti, chiave)
+viaggia con il passaggio, così ogni misura si completa senza ricerche né copie. Le posizioni
+si confrontano in tick (vedi griglia.py), esatte.
+"""
+from music21 import beam, common, note, tie
+from music21.stream import makeNotation
+
+from griglia import in_quarti, in_tick
+
+
+def equivalenti(a, b):
+    # Armature e indicazioni di tempo equivalenti (una ripetizione è ridondante)
+    if a is None or b is None: return a is b
+    if hasattr(a, 'sharps'): return a.sharps == b.sharps and getattr(a, 'mode', None) == getattr(b, 'mode', None)
+    return a.ratioString == b.ratioString
+
+
+def stato_prima_di(voci, num):
+    """Armatura e indicazione di tempo in vigore subito prima della misura num.
+
+    voci: le voci di indicizza_misure nell'ordine della parte sorgente.
+    """
+    armatura = tempo = None
+    for n, voce in voci:
+        if n == num: break
+        if voce["armature"]: armatura = voce["armature"][-1]
+        if voce["tempi"]: tempo = voce["tempi"][-1]
+    return armatura, tempo
+
+
+class PassaggioParte:
+    """Finalizza, una dopo l'altra, le misure di una parte.
+
+    chiave: la chiave dello strumento (orienta i gambi); armatura e tempo: lo stato in vigore
+    prima della prima misura passata (None se si parte dall'inizio del brano).
+    """
+
+    def __init__(self, chiave, armatura=None, tempo=None):
+        self.chiave = chiave
+        self.armatura = armatura
+        self.tempo = tempo
+        self.misura_precedente = None
+        self.nota_precedente = None
+        self.fine_precedente = None
+        self.inizio_misura = 0
+        self._armatura_precedente = armatura
+
+    def finalizza(self, m, occupazione, durata, armature=(), tempi=(), copia=None, prima=False):
+        """Completa la misura m (già riempita di note e dinamiche) e la restituisce.
+
+        occupazione: intervalli suonati (Occupazione del cassetto); durata: durata della misura
+        sorgente, in tick; armature, tempi: quelli della misura sorgente, inseriti (con copia)
+        solo se cambiano lo stato o se prima è vera.
+        """
+        for ks in armature:
+            if prima or not equivalenti(ks, self.armatura): m.insert(ks.offset, copia(ks))
+            self.armatura = ks
+        for ts in tempi:
+            if prima or not equivalenti(ts, self.tempo): m.insert(ts.offset, copia(ts))
+            self.tempo = ts
+
+        self._tronca(m, durata)
+        self._pause(m, occupazione, durata)
+        if any(el.duration.type == 'complex' for el in m.notesAndRests):
+            m.splitAtDurations(recurse=True)
+        if any(el.duration.tuplets for el in m.notesAndRests):
+            makeNotation.splitElementsToCompleteTuplets(m, recurse=True, addTies=True)
+            makeNotation.consolidateCompletedTuplets(m, recurse=True, onlyIfTied=True)
+            for m_o_v in [m, *m.voices]: makeNotation.makeTupletBrackets(m_o_v, inPlace=True)
+
+        self._legature(m)
+        self._alterazioni(m)
+        if self.tempo is None:
+            self.tempo = m.bestTimeSignature()
+        self._travature(m)
+        self._gambi(m)
+
+        self.misura_precedente = m
+        self.inizio_misura += durata
+        return m
+
+    def chiudi(self):
+        # Fine della parte: l'ultima nota non può legarsi a niente
+        if self.nota_precedente is not None: self._taglia_legatura_avanti(self.nota_precedente)
+
+    # --- durate e pause ---
+    @staticmethod
+    def _tronca(m, durata):
+        # Le note non superano la stanghetta
+        for n in m.notes:
+            inizio = in_tick(n.offset)
+            if inizio < durata < inizio + in_tick(n.quarterLength):
+                n.quarterLength = in_quarti(durata - inizio)
+
+    @staticmethod
+    def _pause(m, occupazione, durata):
+        curr = 0
+        for s, e in occupazione.intervalli_uniti():
+            if s >= durata: break
+            if s > curr: m.insert(in_quarti(curr), _pausa(s - curr))
+            curr = max(curr, min(e, durata))
+        if curr < durata:
+            m.insert(in_quarti(curr), _pausa(durata - curr))
+
+    # --- legature ---
+    def _legature(self, m):
+        # Una legatura resta solo se la nota successiva della parte ha le stesse altezze e
+        # comincia dove finisce questa; altrimenti si chiude (o si apre) dal lato giusto
+        for n in m.notes:
+            inizio = self.inizio_misura + in_tick(n.offset)
+            prec = self.nota_precedente
+            legata = (prec is not None and prec.tie is not None and prec.tie.type in ('start', 'continue')
+                      and n.tie is not None and n.tie.type in ('stop', 'continue')
+                      and self.fine_precedente == inizio
+                      and _nomi(prec) == _nomi(n))
+            if not legata:
+                if prec is not None: self._taglia_legatura_avanti(prec)
+                if n.tie is not None and n.tie.type == 'stop': n.tie = None
+                elif n.tie is not None and n.tie.type == 'continue': n.tie = tie.Tie('start')
+            self.nota_precedente = n
+            self.fine_precedente = inizio + in_tick(n.quarterLength)
+
+    @staticmethod
+    def _taglia_legatura_avanti(n):
+        if n.tie is None: return
+        if n.tie.type == 'start': n.tie = None
+        elif n.tie.type == 'continue': n.tie = tie.Tie('stop')
+
+    # --- alterazioni, travature e gambi ---
+    def _alterazioni(self, m):
+        # Come makeAccidentalsInMeasureStream, una misura alla volta
+        precedente = self.misura_precedente
+        altezze_passate, legate = None, None
+        ks_misura = m.keySignature
+        if precedente is not None:
+            altezze = precedente.pitches + makeNotation.ornamentalPitches(precedente)
+            if ks_misura is None:
+                altezze_passate = altezze
+            elif self._armatura_precedente is not None:
+                diatoniche = [p.name for p in self._armatura_precedente.getScale().pitches]
+                altezze_passate = [p for p in altezze if p.name not in diatoniche]
+            ultime = precedente[note.NotRest]
+            if ultime:
+                legate = makeNotation.getTiePitchSet(ultime[-1])
+                if legate is not None and ks_misura is not None:
+                    nuove_diatoniche = [p.name for p in ks_misura.getScale().pitches]
+                    legate = {tp for tp in legate if tp in nuove_diatoniche}
+        m.makeAccidentals(pitchPastMeasure=altezze_passate, useKeySignature=self.armatura,
+                          searchKeySignatureByContext=False, tiePitchSet=legate, inPlace=True)
+        self._armatura_precedente = self.armatura
+
+    def _travature(self, m):
+        # Come makeBeams, con l'indicazione di tempo corrente invece di quella di contesto
+        durata_battuta = self.tempo.barDuration.quarterLength
+        gruppi = [v.notesAndRests.stream() for v in m.voices] if m.hasVoices() else [m.notesAndRests.stream()]
+        for gruppo in gruppi:
+            if len(gruppo) <= 1: continue
+            for n in list(gruppo):
+                if n.duration.isGrace: gruppo.remove(n)
+            if common.opFrac(sum(n.quarterLength for n in gruppo)) > durata_battuta: continue
+
+            inizio = 0.0
+            if m.paddingLeft != 0.0:
+                inizio = common.opFrac(m.paddingLeft)
+            elif m.paddingRight == 0.0 and gruppo.highestTime < durata_battuta:
+                inizio = durata_battuta - gruppo.highestTime
+            for n, travi in zip(gruppo, self.tempo.getBeams(gruppo, measureStartOffset=inizio)):
+                n.beams = travi if travi is not None else beam.Beams()
+
+    def _gambi(self, m):
+        # Come setStemDirectionForBeamGroups, con la chiave dello strumento
+        for gruppo in makeNotation.iterateBeamGroups(m, skipNoBeams=True, recurse=True):
+            direzioni = {n.stemDirection for n in gruppo if n.stemDirection in ('up', 'down', 'unspecified')}
+            coerenti = 'unspecified' not in direzioni and len(direzioni) < 2
+            altezze = [p for n in gruppo for p in n.pitches]
+            if not altezze: continue
+            direzione = self.chiave.getStemDirectionForPitches(altezze)
+            for n in gruppo:
+                if n.stemDirection in ('up', 'down') and coerenti: continue
+                if n.stemDirection in ('up', 'down', 'unspecified'): n.stemDirection = direzione
+
+
+def _nomi(n):
+    return sorted(p.nameWithOctave for p in n.pitches)
+
+
+def _pausa(durata):
+    r = note.Rest()
+    r.quarterLength = in_quarti(durata)
+    r.style.hideObjectOnPrint = False
+    return r
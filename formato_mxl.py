@@ -0,0 +1,639 @@
+"""Lettura e scrittura di MusicXML (.xml / .mxl) interamente in memoria, senza file temporanei.
+
+La scrittura produce lo stesso documento di Score.write('mxl'), ma comprime il testo mentre
+lo genera: l'intestazione viene scritta per prima e ogni parte viene convertita in XML,
+compressa e scartata prima di passare alla successiva.
+
+Per le partiture molto lunghe lettura e scrittura vanno anche a finestre di misure
+(leggi_a_finestre, ScrittoreMxlAFinestre): in memoria resta una finestra di oggetti music21
+alla volta, più il testo compresso già scritto.
+
+Quando del file servono solo le due mani (orchestrazione senza pianoforte originale),
+leggi_mani le legge direttamente dall'XML, senza costruire con music21 il resto della partitura.
+Per l'anteprima di poche misure, leggi_intervallo converte con music21 solo quelle.
+
+Lettura diretta e scrittura a finestre usano parti interne di music21 (PartParser,
+MeasureParser, gli esportatori di m21ToXml e i loro attributi): la versione va tenuta entro
+l'intervallo indicato in requirements.txt.
+"""
+import io
+import zipfile
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Comment, fromstring, tostring
+
+from music21 import clef, defaults, key, meter, stream
+from music21.common.enums import OffsetSpecial
+from music21.musicxml import helpers, m21ToXml, xmlToM21
+from music21.musicxml.xmlObjects import MusicXMLExportException, MusicXMLImportException
+
+from copie import copia_profonda
+
+# Nome del documento dentro l'archivio .mxl (e titolo di ripiego per le partiture senza
+# titolo, come fa music21 con il nome del file letto)
+NOME_DOCUMENTO = "partitura.musicxml"
+
+_CONTAINER = '''<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{}"/>
+  </rootfiles>
+</container>
+'''
+
+# ==========================================
+# LETTURA
+# ==========================================
+def _nome_documento(archivio):
+    # Il documento principale è quello indicato in META-INF/container.xml; in mancanza,
+    # il primo file .xml / .musicxml dell'archivio
+    nomi = archivio.namelist()
+    if "META-INF/container.xml" in nomi:
+        container = fromstring(archivio.read("META-INF/container.xml"))
+        rootfile = container.find(".//rootfile")
+        if rootfile is not None and rootfile.get("full-path") in nomi:
+            return rootfile.get("full-path")
+    for nome in nomi:
+        if "META-INF" not in nome and nome.lower().endswith((".xml", ".musicxml")):
+            return nome
+    raise ValueError("Nessun documento MusicXML trovato nell'archivio .mxl.")
+
+def _documento_da_archivio(archivio):
+    return archivio.read(_nome_documento(archivio))
+
+def _radice(testo):
+    # ElementTree legge la codifica dal BOM o dalla dichiarazione XML (parseXMLText di music21
+    # decodifica sempre in UTF-8 e fallisce sui documenti UTF-16, frequenti dentro gli .mxl)
+    radice = fromstring(testo)
+    if radice.tag != "score-partwise":
+        raise MusicXMLImportException(f"Si leggono solo i file MusicXML score-partwise, non <{radice.tag}>.")
+    return radice
+
+def leggi_partitura(dati, estensione=".mxl"):
+    testo = dati
+    if estensione == ".mxl" and zipfile.is_zipfile(io.BytesIO(dati)):
+        with zipfile.ZipFile(io.BytesIO(dati)) as archivio:
+            testo = _documento_da_archivio(archivio)
+
+    importatore = xmlToM21.MusicXMLImporter()
+    importatore.xmlRootToScore(_radice(testo), importatore.stream)
+    partitura = importatore.stream
+    if partitura.metadata.movementName is None:
+        partitura.metadata.movementName = "partitura" + estensione
+    return partitura
+
+# ==========================================
+# LETTURA A FINESTRE
+# ==========================================
+# Attributi che valgono fino a nuovo ordine, nell'ordine dello schema di <attributes>: all'inizio
+# di ogni finestra si ripetono quelli in vigore, perché music21 legga la finestra come un brano
+# a sé. Chiavi, armature e tempi ripetuti si tolgono poi dalla finestra letta.
+_ATTRIBUTI_DI_STATO = ("divisions", "key", "time", "staves", "clef")
+_CLASSI_RIPETUTE = {"key": key.KeySignature, "time": meter.TimeSignature, "clef": clef.Clef}
+
+@contextmanager
+def _apri_documento(dati, estensione):
+    if estensione == ".mxl" and zipfile.is_zipfile(io.BytesIO(dati)):
+        with zipfile.ZipFile(io.BytesIO(dati)) as archivio, archivio.open(_nome_documento(archivio)) as documento:
+            yield documento
+    else:
+        yield io.BytesIO(dati)
+
+def _attributi_iniziali(misura):
+    # Tipi di attributo dati all'inizio della misura (prima della prima nota)
+    tipi = set()
+    for figlio in misura:
+        if figlio.tag in ("note", "backup", "forward"): break
+        if figlio.tag == "attributes": tipi.update(el.tag for el in figlio)
+    return tipi
+
+def _aggiorna_stato(stato, misura):
+    # stato: tipo -> {numero del pentagramma (None: tutti) -> elemento}
+    for attributi in misura.iter("attributes"):
+        for el in attributi:
+            if el.tag not in _ATTRIBUTI_DI_STATO: continue
+            numero = el.get("number")
+            if numero is None or el.tag not in stato: stato[el.tag] = {}
+            stato[el.tag][numero] = el
+
+def _con_stato(misura, stato):
+    # La misura con davanti gli attributi di stato in vigore che non ridefinisce all'inizio, e
+    # i tipi di attributo aggiunti
+    mancanti = [tipo for tipo in _ATTRIBUTI_DI_STATO if tipo in stato and tipo not in _attributi_iniziali(misura)]
+    if not mancanti: return misura, mancanti
+    attributi = ElementTree.Element("attributes")
+    for tipo in mancanti: attributi.extend(stato[tipo].values())
+    prima = ElementTree.Element(misura.tag, misura.attrib)
+    prima.append(attributi)
+    prima.extend(misura)
+    return prima, mancanti
+
+def _finestre_xml(sorgente, misure_per_finestra):
+    # Documenti MusicXML di misure_per_finestra misure per parte, con l'intestazione dell'originale.
+    # Le misure si leggono con iterparse e si staccano dall'albero appena lette; con più parti,
+    # quelle che precedono l'ultima restano in memoria (come XML) finché l'ultima non arriva.
+    radice, intestazione, n_parti = None, [], 0
+    misure, stati = {}, {}
+    profondita, parte = 0, None
+
+    def componi(n):
+        finestra, ripetuti = ElementTree.Element(radice.tag, radice.attrib), {}
+        finestra.extend(intestazione)
+        for id_parte, coda in misure.items():
+            blocco = [coda.popleft() for _ in range(min(n, len(coda)))]
+            stato = stati.setdefault(id_parte, {})
+            if blocco:
+                blocco[0], mancanti = _con_stato(blocco[0], stato)
+                if mancanti: ripetuti[id_parte] = {tipo for tipo in mancanti if tipo in _CLASSI_RIPETUTE}
+            for m in blocco: _aggiorna_stato(stato, m)
+            ElementTree.SubElement(finestra, "part", id=id_parte).extend(blocco)
+        return finestra, ripetuti
+
+    for evento, el in ElementTree.iterparse(sorgente, events=("start", "end")):
+        if evento == "start":
+            profondita += 1
+            if profondita == 1: radice = el
+            elif profondita == 2 and el.tag == "part":
+                parte = el
+                misure[el.get("id")] = deque()
+            continue
+        profondita -= 1
+        if profondita == 1:
+            if el.tag == "part-list": n_parti = len(el.findall("score-part"))
+            if el.tag != "part": intestazione.append(el)
+            radice.remove(el)
+        elif profondita == 2 and el.tag == "measure":
+            misure[parte.get("id")].append(el)
+            parte.remove(el)
+            while len(misure) >= n_parti and all(len(coda) >= misure_per_finestra for coda in misure.values()):
+                yield componi(misure_per_finestra)
+    if radice is None or radice.tag != "score-partwise":
+        raise ValueError("Si leggono a finestre solo i file MusicXML score-partwise.")
+    while any(misure.values()):
+        yield componi(misure_per_finestra)
+
+def leggi_a_finestre(dati, estensione=".mxl", misure_per_finestra=64):
+    """Come leggi_partitura, ma una partitura music21 ogni misure_per_finestra misure.
+
+    Ogni finestra ha le parti dell'originale con le loro misure (numeri originali, offset da 0);
+    armature, tempi e chiavi compaiono dove li mette l'originale. Le legature di valore si
+    leggono nota per nota; gli spanner (legature di portamento, forcelle) a cavallo tra due
+    finestre vanno persi.
+    """
+    if misure_per_finestra < 1: raise ValueError("Una finestra deve avere almeno una misura.")
+    with _apri_documento(dati, estensione) as sorgente:
+        for radice, ripetuti in _finestre_xml(sorgente, misure_per_finestra):
+            importatore = xmlToM21.MusicXMLImporter()
+            importatore.xmlRootToScore(radice, importatore.stream)
+            partitura = importatore.stream
+            if partitura.metadata.movementName is None:
+                partitura.metadata.movementName = "partitura" + estensione
+            for id_parte, parte in importatore.m21PartObjectsById.items():
+                tipi = ripetuti.get(id_parte.split("-Staff")[0])
+                prima = parte.getElementsByClass(stream.Measure).first() if tipi else None
+                if prima is None: continue
+                for el in list(prima.getElementsByOffset(0).getElementsByClass([_CLASSI_RIPETUTE[t] for t in tipi])):
+                    prima.remove(el)
+            yield partitura
+
+# ==========================================
+# LETTURA DI UN INTERVALLO DI MISURE
+# ==========================================
+# Per l'anteprima di poche misure di un brano lungo: delle misure che precedono l'intervallo si
+# tengono solo gli attributi di stato (come tra una finestra e l'altra) e l'ultima indicazione
+# di metronomo, che si ripetono all'inizio dell'intervallo; music21 converte solo le misure
+# dell'intervallo e la lettura si ferma quando l'ultima parte le ha tutte.
+def _metronomo(misura):
+    # Ultima indicazione di metronomo (<direction> con <metronome> o <sound tempo>) della misura
+    trovata = None
+    for direzione in misura.iter("direction"):
+        if direzione.find("direction-type/metronome") is not None or direzione.find("sound[@tempo]") is not None:
+            trovata = direzione
+    return trovata
+
+def _intervallo_xml(sorgente, inizio, fine):
+    # Documento MusicXML con le misure dalla posizione inizio (inclusa, da 0) a fine (esclusa) di
+    # ogni parte, con l'intestazione dell'originale
+    radice, intestazione, n_parti = None, [], 0
+    misure, stati, metronomi = {}, {}, {}
+    profondita, parte, posizione = 0, None, 0
+    for evento, el in ElementTree.iterparse(sorgente, events=("start", "end")):
+        if evento == "start":
+            profondita += 1
+            if profondita == 1:
+                radice = el
+                if el.tag != "score-partwise": raise ValueError("Si leggono per intervalli solo i file MusicXML score-partwise.")
+            elif profondita == 2 and el.tag == "part":
+                parte, posizione = el, 0
+                misure[el.get("id")] = []
+            continue
+        profondita -= 1
+        if profondita == 1:
+            if el.tag == "part-list": n_parti = len(el.findall("score-part"))
+            if el.tag != "part": intestazione.append(el)
+            radice.remove(el)
+        elif profondita == 2 and el.tag == "measure":
+            id_parte = parte.get("id")
+            if posizione < inizio:
+                _aggiorna_stato(stati.setdefault(id_parte, {}), el)
+                metronomi[id_parte] = _metronomo(el) or metronomi.get(id_parte)
+            elif posizione < fine:
+                misure[id_parte].append(el)
+            posizione += 1
+            parte.remove(el)
+            # L'ultima parte ha tutte le sue misure: il resto del documento non serve
+            if posizione >= fine and len(misure) >= n_parti: break
+
+    documento = ElementTree.Element(radice.tag, radice.attrib)
+    documento.extend(intestazione)
+    for id_parte, blocco in misure.items():
+        if blocco:
+            blocco[0], _ = _con_stato(blocco[0], stati.get(id_parte, {}))
+            metronomo = metronomi.get(id_parte)
+            if metronomo is not None and _metronomo(blocco[0]) is None:
+                # Subito dopo gli attributi iniziali, cioè all'inizio della misura
+                davanti = next((i for i, figlio in enumerate(blocco[0]) if figlio.tag != "attributes"), len(blocco[0]))
+                blocco[0].insert(davanti, metronomo)
+        ElementTree.SubElement(documento, "part", id=id_parte).extend(blocco)
+    return documento
+
+def leggi_intervallo(dati, estensione=".mxl", inizio=0, fine=16):
+    """Partitura music21 con le sole misure dalla posizione inizio (inclusa, da 0) a fine
+    (esclusa) di ogni parte, con numeri originali e offset da 0. All'inizio valgono chiavi,
+    armature, tempi e metronomo in vigore in quel punto del brano; gli spanner che iniziano
+    prima dell'intervallo vanno persi."""
+    if not 0 <= inizio < fine: raise ValueError("L'intervallo deve contenere almeno una misura.")
+    with _apri_documento(dati, estensione) as sorgente:
+        radice = _intervallo_xml(sorgente, inizio, fine)
+    importatore = xmlToM21.MusicXMLImporter()
+    importatore.xmlRootToScore(radice, importatore.stream)
+    partitura = importatore.stream
+    if partitura.metadata.movementName is None:
+        partitura.metadata.movementName = "partitura" + estensione
+    return partitura
+
+# ==========================================
+# LETTURA DIRETTA DELLE MANI
+# ==========================================
+# Il motore usa del file solo i due pentagrammi delle mani (note, dinamiche, testi, armature,
+# tempi, indicazioni di metronomo) e i metadati. La lettura diretta scorre il documento con
+# iterparse e converte ogni misura appena letta con i convertitori di music21 (MeasureParser),
+# quindi note, accordi, legature e abbellimenti sono quelli di converter.parse; poi divide la
+# misura tra i due pentagrammi con le regole di PartParser.separateOutPartStaves, una misura
+# alla volta invece che sull'intera parte a lettura finita. Si ferma appena ha le due mani: le
+# parti successive non si convertono. Nelle misure delle mani restano solo gli elementi del
+# pentagramma: stanghette, ritornelli e impaginazione (che il motore non legge) non ci sono.
+# Dove non sa replicare music21 solleva LetturaNonSupportata e leggi_mani rilegge con music21.
+_CLASSI_DEL_PENTAGRAMMA = frozenset(["Clef", "Dynamic", "Expression", "GeneralNote", "KeySignature",
+                                     "StaffLayout", "TempoIndication", "TimeSignature"])
+
+
+class LetturaNonSupportata(Exception):
+    pass
+
+
+def _del_pentagramma(sorgente, esclusi, gia_messi):
+    # (offset, elemento) che vanno nel pentagramma, come in copy_into_partStaff di music21: gli
+    # elementi comuni a tutti i pentagrammi vanno com'erano nel primo e come copie profonde negli
+    # altri. Si scorrono direttamente gli elementi (in ordine), senza iteratori
+    if not sorgente.isSorted: sorgente.sort()
+    scelti = []
+    for el in (*sorgente._elements, *sorgente._endElements):
+        if id(el) in esclusi or _CLASSI_DEL_PENTAGRAMMA.isdisjoint(el.classSet): continue
+        if id(el) in gia_messi:
+            scelti.append((sorgente.elementOffset(el, returnSpecial=True), copia_profonda(el)))
+        else:
+            scelti.append((sorgente.elementOffset(el, returnSpecial=True), el))
+            gia_messi.add(id(el))
+    return scelti
+
+def _inserisci(destinazione, scelti, spostamento=0.0):
+    for offset, el in scelti:
+        if offset == OffsetSpecial.AT_END: destinazione.coreStoreAtEnd(el)
+        else: destinazione.coreInsert(spostamento + offset, el)
+    destinazione.coreElementsChanged()
+
+def _dividi_misura(m, riferimenti, pentagrammi):
+    # Una misura per pentagramma; riferimenti: pentagramma -> elementi (0: tutti), da MeasureParser.
+    # Come dopo flattenUnnecessaryVoices: le voci rimaste vuote non ci sono e una voce rimasta
+    # sola si scioglie nella misura
+    gia_messi, misure = set(), []
+    for pentagramma in pentagrammi:
+        esclusi = {id(el) for chiave, elementi in riferimenti.items() if chiave not in (0, pentagramma) for el in elementi}
+        mano = m.cloneEmpty(derivationMethod="template")
+        _inserisci(mano, _del_pentagramma(m, esclusi, gia_messi))
+        voci = [(voce, scelti) for voce in m.voices if (scelti := _del_pentagramma(voce, esclusi, gia_messi))]
+        if len(voci) == 1:
+            _inserisci(mano, voci[0][1], m.elementOffset(voci[0][0]))
+        else:
+            for voce, scelti in voci:
+                copia = voce.cloneEmpty(derivationMethod="template")
+                _inserisci(copia, scelti)
+                mano.coreInsert(m.elementOffset(voce), copia)
+            mano.coreElementsChanged()
+        misure.append(mano)
+    return misure
+
+class _ParteDiretta:
+    # Una <part> letta misura per misura con PartParser. Con un solo pentagramma la parte è lo
+    # stream del parser; con due, ogni misura si divide quando arriva la successiva (l'ultima
+    # può ancora perdere la pausa finale di Finale, vedi removeFinaleIncorrectEndingForwardRest)
+
+    def __init__(self, importatore, el):
+        parte_xml = importatore.mxScorePartDict.get(el.get("id"))
+        if parte_xml is None: raise LetturaNonSupportata(f"parte {el.get('id')} assente da <part-list>")
+        self.parser = xmlToM21.PartParser(el, parte_xml, parent=importatore)
+        self.parser.parseXmlScorePart()
+        self.pentagrammi, self.chiavi, self.da_dividere, self.mani = None, set(), None, []
+
+    def misura(self, el):
+        parser = self.parser
+        offset = parser.lastMeasureOffset
+        m = parser.xmlMeasureToMeasure(el)
+        if self.pentagrammi is None:
+            self.pentagrammi = parser.maxStaves
+            if self.pentagrammi > 2: raise LetturaNonSupportata(f"parte con {self.pentagrammi} pentagrammi")
+            if self.pentagrammi == 2:
+                for pentagramma in (1, 2):
+                    mano = stream.PartStaff()
+                    mano.mergeAttributes(parser.stream)
+                    mano.id = f"{parser.partId}-Staff{pentagramma}"
+                    mano.coreInsert(0, copia_profonda(parser.activeInstrument))
+                    self.mani.append(mano)
+        elif parser.maxStaves != self.pentagrammi:
+            raise LetturaNonSupportata("numero di pentagrammi che cambia durante il brano")
+        if self.pentagrammi == 2:
+            riferimenti = parser.lastMeasureParser.staffReference
+            self.chiavi.update(chiave for chiave in riferimenti if chiave)
+            self._dividi()
+            self.da_dividere = (offset, m, riferimenti)
+
+    def _dividi(self):
+        if self.da_dividere is None: return
+        offset, m, riferimenti = self.da_dividere
+        for mano, misura in zip(self.mani, _dividi_misura(m, riferimenti, (1, 2))):
+            mano.coreInsert(offset, misura)
+        self.da_dividere = None
+
+    def chiudi(self):
+        # I pentagrammi della parte, come li restituirebbe music21
+        parser = self.parser
+        if self.pentagrammi is None: raise LetturaNonSupportata(f"parte {parser.partId} senza misure")
+        parser.removeFinaleIncorrectEndingForwardRest()
+        if self.pentagrammi == 1:
+            parser.stream.coreElementsChanged()
+            self.mani = [parser.stream]
+        else:
+            if self.chiavi != {1, 2}: raise LetturaNonSupportata("pentagrammi dichiarati ma non usati")
+            self._dividi()
+        for mano in self.mani:
+            mano.atSoundingPitch = parser.atSoundingPitch
+            mano.coreElementsChanged()
+        return self.mani
+
+def _leggi_mani(sorgente):
+    importatore = xmlToM21.MusicXMLImporter()
+    radice, parte, mani = None, None, []
+    profondita = 0
+    for evento, el in ElementTree.iterparse(sorgente, events=("start", "end")):
+        if evento == "start":
+            profondita += 1
+            if profondita == 1:
+                radice = el
+                if el.tag != "score-partwise": raise LetturaNonSupportata(f"documento <{el.tag}>")
+            elif profondita == 2 and el.tag == "part":
+                if parte is None and not mani:
+                    # Intestazione completa: metadati (e accorgimenti per Finale) ed elenco delle parti
+                    if radice.get("version"): importatore.musicXmlVersion = radice.get("version")
+                    metadati = importatore.xmlMetadata(radice)
+                    importatore.parsePartList(radice)
+                parte = _ParteDiretta(importatore, el)
+            continue
+        profondita -= 1
+        if profondita == 2 and el.tag == "measure" and parte is not None:
+            parte.misura(el)
+            parte.parser.mxPart.remove(el)
+        elif profondita == 1 and el.tag == "part":
+            mani += parte.chiudi()
+            parte = None
+            radice.remove(el)
+            if len(mani) >= 2: break
+    if len(mani) < 2: raise LetturaNonSupportata("meno di due pentagrammi")
+
+    partitura = stream.Score()
+    partitura.coreInsert(0, metadati)
+    for mano in mani[:2]: partitura.coreInsert(0, mano)
+    partitura.coreElementsChanged()
+    return partitura
+
+def leggi_mani_diretta(dati, estensione=".mxl"):
+    """Partitura music21 con i soli due pentagrammi delle mani (le prime due parti che darebbe
+    leggi_partitura, stesse misure, note e indicazioni) e i metadati; LetturaNonSupportata se
+    il documento usa costrutti che la lettura diretta non gestisce."""
+    with _apri_documento(dati, estensione) as sorgente:
+        partitura = _leggi_mani(sorgente)
+    if partitura.metadata.movementName is None:
+        partitura.metadata.movementName = "partitura" + estensione
+    return partitura
+
+def leggi_mani(dati, estensione=".mxl"):
+    """Come leggi_mani_diretta, rileggendo con music21 (tutte le parti) se serve."""
+    try:
+        return leggi_mani_diretta(dati, estensione)
+    except LetturaNonSupportata:
+        return leggi_partitura(dati, estensione)
+
+# ==========================================
+# SCRITTURA
+# ==========================================
+class _EsportatoreParte(m21ToXml.PartExporter):
+    # PartExporter.parse diviso in due: prepara() fa tutto ciò che serve all'intestazione
+    # della partitura (notazione, strumenti, id), misure() genera l'XML delle misure
+
+    def prepara(self):
+        self.stream.toWrittenPitch(inPlace=True, ottavasToSounding=True)
+        if self.makeNotation:
+            self.stream = self.stream.splitAtDurations(recurse=True)[0]
+            if self.stream.getElementsByClass(stream.Measure):
+                self.fixupNotationMeasured()
+            else:
+                self.fixupNotationFlat()
+        elif not self.stream.getElementsByClass(stream.Measure):
+            raise MusicXMLExportException('Cannot export with makeNotation=False if there are no measures')
+        self.spannerBundle.setIdLocals()
+        self.instrumentSetup()
+        self.xmlRoot.set('id', str(self.firstInstrumentObject.partId))
+
+    def misure(self):
+        for m in self.stream.getElementsByClass(stream.Measure):
+            self.addDividerComment('Measure ' + str(m.number))
+            esportatore_misura = m21ToXml.MeasureExporter(m, parent=self)
+            esportatore_misura.spannerBundle = self.spannerBundle
+            try:
+                mx_misura = esportatore_misura.parse()
+            except MusicXMLExportException as e:
+                e.measureNumber = str(m.number)
+                e.partName = self.stream.partName
+                raise e
+            self.xmlRoot.append(mx_misura)
+
+    def parse(self):
+        self.prepara()
+        self.misure()
+        return self.xmlRoot
+
+
+class _EsportatorePartitura(m21ToXml.ScoreExporter):
+    # Come ScoreExporter.parse, ma le parti che non vanno unite ad altre (pentagrammi dello
+    # stesso strumento) generano le misure solo al momento di scriverle
+
+    def _populatePartExporterList(self):
+        for parte in list(self.parts):
+            esportatore = _EsportatoreParte(parte, parent=self)
+            esportatore.spannerBundle = self.spannerBundle
+            self.partExporterList.append(esportatore)
+
+    def prepara(self, continua=False):
+        # Tutto ciò che precede le misure delle parti. Restituisce il testo del documento prima
+        # e dopo le parti, gli esportatori delle parti e quelli che hanno già le misure (i
+        # pentagrammi uniti). continua: la partitura prosegue una finestra precedente, quindi
+        # le divisioni sono già state dichiarate
+        s = self.stream
+        s.toWrittenPitch(inPlace=True, ottavasToSounding=True)
+        self.scorePreliminaries()
+        self._populatePartExporterList()
+        self.groupsToJoin = self.joinableGroups()
+        self.setPartExporterStaffGroups()
+        self.renumberVoicesWithinStaffGroups()
+
+        da_unire = [esp for esp in self.partExporterList if esp.staffGroup in self.groupsToJoin]
+        for esp in self.partExporterList:
+            if continua: esp.lastDivisions = defaults.divisionsPerQuarter
+            if esp in da_unire: esp.parse()
+            else: esp.prepara()
+        self.joinPartStaffs()
+        self.setScoreHeader()
+
+        # Intestazione: la radice con un segnaposto dove andranno le parti
+        segnaposto = Comment('PARTI')
+        self.xmlRoot.append(segnaposto)
+        testo = helpers.dumpString(self.xmlRoot, noCopy=True)
+        prima, dopo = testo.split(tostring(segnaposto, encoding='unicode'))
+
+        esportatori = list(self.partExporterList)
+        self.partExporterList.clear()
+        return prima, dopo, esportatori, da_unire
+
+    def scrivi(self, uscita):
+        prima, dopo, esportatori, da_unire = self.prepara()
+        uscita.write(self.xmlHeader())
+        uscita.write(prima.encode('utf-8'))
+        for i, esp in enumerate(esportatori):
+            if esp not in da_unire: esp.misure()
+            divisore = Comment(self._testo_divisore('Part ' + str(i + 1)))
+            self._scrivi_figlio(uscita, divisore, ultimo=False)
+            self._scrivi_figlio(uscita, esp.xmlRoot, ultimo=i == len(esportatori) - 1)
+            esp.xmlRoot = None
+        uscita.write(dopo.lstrip('\n').encode('utf-8'))
+
+    @staticmethod
+    def _testo_divisore(commento):
+        # Stesso testo di addDividerComment
+        lunghezza = min(len(commento), 60)
+        return '=' * ((60 - lunghezza) // 2) + ' ' + commento + ' ' + '=' * (60 - lunghezza - (60 - lunghezza) // 2)
+
+    @staticmethod
+    def _scrivi_figlio(uscita, elemento, ultimo):
+        # Un figlio diretto della radice, indentato e con gli attributi ordinati come in dumpString
+        helpers.indent(elemento, 1)
+        elemento.tail = '\n' if ultimo else '\n  '
+        for el in elemento.iter():
+            if len(el.attrib) > 1:
+                attributi = sorted(el.attrib.items())
+                el.attrib.clear()
+                el.attrib.update(attributi)
+        uscita.write(tostring(elemento, encoding='unicode').encode('utf-8'))
+
+
+class ScrittoreMxlAFinestre:
+    """Scrive un .mxl una finestra di misure alla volta.
+
+    aggiungi(partitura) riceve partiture già finalizzate con le stesse parti, nello stesso
+    ordine, e le misure successive a quelle già scritte (con l'offset che hanno nel brano
+    intero); chiudi() restituisce i byte del file. Il MusicXML elenca le parti una dopo l'altra,
+    quindi le misure di ogni parte si accumulano compresse finché la partitura non è chiusa;
+    l'intestazione viene dalla prima finestra.
+    """
+
+    def __init__(self):
+        self._intestazione = None
+        self._parti = []
+
+    def aggiungi(self, partitura):
+        continua = self._intestazione is not None
+        esportatore = _EsportatorePartitura(partitura, makeNotation=False)
+        prima, dopo, esportatori, da_unire = esportatore.prepara(continua)
+        if not continua:
+            self._intestazione = (esportatore.xmlHeader() + prima.encode('utf-8'), dopo.lstrip('\n').encode('utf-8'))
+            self._parti = [{"id": esp.xmlRoot.get('id'), "compressore": zlib.compressobj(), "blocchi": deque()} for esp in esportatori]
+        elif len(esportatori) != len(self._parti):
+            raise ValueError("Ogni finestra deve avere le stesse parti della prima.")
+
+        for parte, esp in zip(self._parti, esportatori):
+            if esp not in da_unire: esp.misure()
+            # Come in _scrivi_figlio, con le misure un livello più in dentro
+            helpers.indent(esp.xmlRoot, 1)
+            testo = []
+            for el in esp.xmlRoot:
+                el.tail = None
+                for figlio in el.iter():
+                    if len(figlio.attrib) > 1:
+                        attributi = sorted(figlio.attrib.items())
+                        figlio.attrib.clear()
+                        figlio.attrib.update(attributi)
+                testo.append('\n    ' + tostring(el, encoding='unicode'))
+            parte["blocchi"].append(parte["compressore"].compress(''.join(testo).encode('utf-8')))
+            esp.xmlRoot = None
+
+    def chiudi(self):
+        if self._intestazione is None: raise ValueError("Nessuna finestra da scrivere.")
+        prima, dopo = self._intestazione
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archivio:
+            with archivio.open(NOME_DOCUMENTO, 'w') as documento:
+                documento.write(prima)
+                for i, parte in enumerate(self._parti):
+                    divisore = Comment(_EsportatorePartitura._testo_divisore('Part ' + str(i + 1)))
+                    documento.write(f'{tostring(divisore, encoding="unicode")}\n  <part id="{parte["id"]}">'.encode('utf-8'))
+                    parte["blocchi"].append(parte["compressore"].flush())
+                    decompressore = zlib.decompressobj()
+                    # Ogni blocco si libera appena scritto
+                    while parte["blocchi"]:
+                        documento.write(decompressore.decompress(parte["blocchi"].popleft()))
+                    documento.write(decompressore.flush())
+                    documento.write(b'\n  </part>' + (b'\n' if i == len(self._parti) - 1 else b'\n  '))
+                documento.write(dopo)
+            archivio.writestr('META-INF/container.xml', _CONTAINER.format(NOME_DOCUMENTO))
+        self._parti = []
+        return buffer.getvalue()
+
+
+def scrivi_mxl(partitura, notazione=True):
+    """Restituisce i byte del file .mxl della partitura.
+
+    Con notazione=True la partitura viene copiata e completata da music21 (pause, legature,
+    travature, alterazioni), come in Score.write; con notazione=False viene esportata così com'è,
+    e va modificata sul posto: serve a partiture già finalizzate.
+    """
+    esportatore_generale = m21ToXml.GeneralObjectExporter(partitura)
+    esportatore_generale.makeNotation = notazione
+    partitura_pronta = esportatore_generale.fromGeneralObject(partitura)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archivio:
+        with archivio.open(NOME_DOCUMENTO, 'w') as documento:
+            _EsportatorePartitura(partitura_pronta, makeNotation=esportatore_generale.makeNotation).scrivi(documento)
+        archivio.writestr('META-INF/container.xml', _CONTAINER.format(NOME_DOCUMENTO))
+    return buffer.getvalue()
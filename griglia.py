@@ -0,0 +1,23 @@
+"""Griglia dei tempi del motore: offset e durate in tick interi, TICK_PER_QUARTO per quarto.
+
+Come le <divisions> di MusicXML, ma fisse: TICK_PER_QUARTO è multiplo dei valori di <divisions>
+più comuni (480, 960, 1024, 10080), quindi ogni offset e durata letti da questi file cade
+esattamente sulla griglia, gruppi irregolari (fino a 7, e terzine di terzine) compresi. Le
+fasi del motore confrontano e indicizzano solo interi, senza tolleranze; le misure music21
+ricevono i quarti (in_quarti) solo quando si costruiscono.
+"""
+from fractions import Fraction
+
+from music21 import common
+
+TICK_PER_QUARTO = 2**10 * 3**2 * 5 * 7
+
+
+def in_tick(quarti):
+    # quarterLength (float o Fraction) -> tick; ciò che non cade sulla griglia va al tick più vicino
+    return round(quarti * TICK_PER_QUARTO)
+
+
+def in_quarti(tick):
+    # tick -> quarterLength come lo rappresenta music21 (float se esatto, altrimenti Fraction)
+    return common.opFrac(Fraction(tick, TICK_PER_QUARTO))
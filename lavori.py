@@ -0,0 +1,175 @@
+"""Coda di lavori in background, nello stesso processo: un pool di thread con un limite di lavori
+contemporanei, avanzamento per fase e per misura, annullamento e tempo massimo.
+
+    coda = CodaLavori(max_concorrenti=2, timeout=300)
+    id_lavoro = coda.invia(orchestra, dati, ensemble)
+    coda.stato(id_lavoro)     # {"stato": "in_corso", "fase": "orchestrazione", "fatte": 12, "totale": 40, ...}
+    coda.annulla(id_lavoro)
+
+Il lavoro riferisce l'avanzamento con segnala(fase, fatte, totale), che costa un controllo di
+ContextVar fuori da un lavoro. Annullamento e tempo massimo sono cooperativi: è segnala a
+sollevare LavoroAnnullato (o TempoScaduto) nel thread del lavoro, alla prima chiamata utile.
+"""
+import contextvars
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+_lavoro_attivo = contextvars.ContextVar("lavoro", default=None)
+
+IN_CODA, IN_CORSO, COMPLETATO, ERRORE, ANNULLATO, SCADUTO = "in_coda", "in_corso", "completato", "errore", "annullato", "scaduto"
+STATI_FINALI = (COMPLETATO, ERRORE, ANNULLATO, SCADUTO)
+
+
+class LavoroAnnullato(Exception):
+    """Sollevata da segnala nel lavoro annullato."""
+
+
+class TempoScaduto(LavoroAnnullato):
+    """Sollevata da segnala nel lavoro che ha superato il tempo massimo."""
+
+
+class Lavoro:
+    """Un lavoro della coda: stato, avanzamento e risultato (o errore).
+
+    Gli attributi si leggono da altri thread; per una fotografia coerente si usa istantanea().
+    """
+
+    def __init__(self, funzione, args, kwargs, timeout=None):
+        self.id = uuid.uuid4().hex
+        self.funzione, self.args, self.kwargs = funzione, args, kwargs
+        self.timeout = timeout
+        self.stato = IN_CODA
+        self.fase, self.fatte, self.totale = None, 0, 0
+        self.risultato = self.errore = None
+        self.creato, self.iniziato, self.finito = time.time(), None, None
+        self._annullato = threading.Event()
+        self._lock = threading.Lock()
+        self._futuro = None
+
+    def annulla(self):
+        self._annullato.set()
+        # Un lavoro ancora in coda non parte nemmeno
+        if self._futuro is not None and self._futuro.cancel(): self._chiudi(ANNULLATO)
+
+    def segnala(self, fase=None, fatte=None, totale=None):
+        with self._lock:
+            if fase is not None and fase != self.fase: self.fase, self.fatte, self.totale = fase, 0, 0
+            if fatte is not None: self.fatte = fatte
+            if totale is not None: self.totale = totale
+        if self._annullato.is_set(): raise LavoroAnnullato("Lavoro annullato")
+        if self.timeout is not None and time.time() - self.iniziato > self.timeout:
+            raise TempoScaduto(f"Tempo massimo superato ({self.timeout:g} s)")
+
+    def istantanea(self):
+        # Dati semplici, serializzabili in JSON: quello che l'interfaccia interroga
+        with self._lock:
+            fine = self.finito or time.time()
+            return {"id": self.id, "stato": self.stato, "fase": self.fase, "fatte": self.fatte, "totale": self.totale,
+                    "errore": str(self.errore) if self.errore is not None else None,
+                    "attesa_s": (self.iniziato or fine) - self.creato,
+                    "durata_s": fine - self.iniziato if self.iniziato else 0.0}
+
+    @property
+    def concluso(self):
+        return self.stato in STATI_FINALI
+
+    def _esegui(self):
+        if self._annullato.is_set(): return self._chiudi(ANNULLATO)
+        with self._lock: self.stato, self.iniziato = IN_CORSO, time.time()
+        token = _lavoro_attivo.set(self)
+        try:
+            risultato = self.funzione(*self.args, **self.kwargs)
+            # Anche l'ultimo tratto senza segnala (per esempio l'esportazione) conta
+            self.segnala()
+        except TempoScaduto as e:
+            self._chiudi(SCADUTO, errore=e)
+        except LavoroAnnullato as e:
+            self._chiudi(ANNULLATO, errore=e)
+        except Exception as e:
+            self._chiudi(ERRORE, errore=e)
+        else:
+            self._chiudi(COMPLETATO, risultato=risultato)
+        finally:
+            _lavoro_attivo.reset(token)
+
+    def _chiudi(self, stato, risultato=None, errore=None):
+        with self._lock:
+            self.stato, self.risultato, self.errore, self.finito = stato, risultato, errore, time.time()
+        # Argomenti (per esempio i byte del file) non servono più
+        self.args, self.kwargs = (), {}
+
+
+class CodaLavori:
+    """Esegue i lavori inviati, al massimo max_concorrenti alla volta (gli altri aspettano in
+    ordine di invio). timeout: secondi massimi di esecuzione (dall'inizio, non dall'invio) di
+    ogni lavoro, se invia non ne indica uno proprio. Dei lavori finiti si tengono gli ultimi
+    max_conservati, perché l'interfaccia possa ancora leggerne il risultato.
+    """
+
+    _numeratore = itertools.count(1)
+
+    def __init__(self, max_concorrenti=2, timeout=None, max_conservati=100):
+        if max_concorrenti < 1: raise ValueError("max_concorrenti deve essere almeno 1")
+        self.max_concorrenti = max_concorrenti
+        self.timeout = timeout
+        self.max_conservati = max_conservati
+        self._pool = ThreadPoolExecutor(max_workers=max_concorrenti, thread_name_prefix=f"lavori-{next(self._numeratore)}")
+        self._lavori = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invia(self, funzione, *args, timeout=None, **kwargs):
+        """Mette in coda funzione(*args, **kwargs) e ne restituisce l'id."""
+        lavoro = Lavoro(funzione, args, kwargs, timeout if timeout is not None else self.timeout)
+        with self._lock:
+            self._lavori[lavoro.id] = lavoro
+            self._dimentica_finiti()
+        lavoro._futuro = self._pool.submit(lavoro._esegui)
+        return lavoro.id
+
+    def lavoro(self, id_lavoro):
+        # KeyError se il lavoro non esiste (o è stato dimenticato)
+        with self._lock: return self._lavori[id_lavoro]
+
+    def stato(self, id_lavoro):
+        return self.lavoro(id_lavoro).istantanea()
+
+    def risultato(self, id_lavoro):
+        lavoro = self.lavoro(id_lavoro)
+        if lavoro.stato == COMPLETATO: return lavoro.risultato
+        if lavoro.stato == ERRORE: raise lavoro.errore
+        raise LavoroAnnullato(f"Lavoro {lavoro.stato}") if lavoro.concluso else RuntimeError("Lavoro non ancora finito")
+
+    def annulla(self, id_lavoro):
+        self.lavoro(id_lavoro).annulla()
+
+    def attendi(self, id_lavoro, timeout=None):
+        # Per script e prove: blocca finché il lavoro non finisce (l'interfaccia interroga stato)
+        self.lavoro(id_lavoro)._futuro.exception(timeout)
+        return self.stato(id_lavoro)
+
+    def attivi(self):
+        with self._lock: return sum(lavoro.stato == IN_CORSO for lavoro in self._lavori.values())
+
+    def in_coda(self):
+        with self._lock: return sum(lavoro.stato == IN_CODA for lavoro in self._lavori.values())
+
+    def chiudi(self, annulla=True):
+        if annulla:
+            with self._lock: lavori = list(self._lavori.values())
+            for lavoro in lavori: lavoro.annulla()
+        self._pool.shutdown(wait=True)
+
+    def _dimentica_finiti(self):
+        finiti = [id_lavoro for id_lavoro, lavoro in self._lavori.items() if lavoro.concluso]
+        for id_lavoro in finiti[:max(0, len(finiti) - self.max_conservati)]: del self._lavori[id_lavoro]
+
+
+def segnala(fase=None, fatte=None, totale=None):
+    """Avanzamento del lavoro corrente (fase, unità fatte su totale); fuori da un lavoro non fa
+    niente. Solleva LavoroAnnullato se il lavoro è stato annullato o ha superato il tempo."""
+    lavoro = _lavoro_attivo.get()
+    if lavoro is not None: lavoro.segnala(fase, fatte, totale)
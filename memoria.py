@@ -0,0 +1,80 @@
+"""Picco di memoria di un'esecuzione.
+
+Su Linux il picco del processo (VmHWM) si azzera all'inizio del blocco scrivendo in
+/proc/self/clear_refs, quindi il picco letto alla fine è quello del blocco; altrove (o se
+l'azzeramento non è permesso) si ripiega su getrusage, che dà il picco dall'avvio del processo.
+È sempre il picco dell'intero processo: esecuzioni contemporanee in altri thread vi contribuiscono,
+i processi figli no. Con traccia=True si misura anche, con tracemalloc, il picco della memoria
+allocata da Python dentro il blocco (più preciso, ma rallenta l'esecuzione).
+"""
+import sys
+import tracemalloc
+
+_STATO = "/proc/self/status"
+_AZZERA = "/proc/self/clear_refs"
+
+
+def _leggi_status(campo):
+    # kB -> MB, None se il campo (o il file) non c'è
+    try:
+        with open(_STATO) as f:
+            for riga in f:
+                if riga.startswith(campo + ":"): return int(riga.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _azzera_picco():
+    try:
+        with open(_AZZERA, "w") as f: f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _picco_dall_avvio_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Byte su macOS, kB altrove
+    return picco / (1024 * 1024) if sys.platform == "darwin" else picco / 1024
+
+
+class PiccoMemoria:
+    """Con with: all'uscita, riepilogo() dà rss_iniziale_mb, picco_rss_mb, "picco_dall_avvio"
+    (se il picco non si è potuto azzerare) e, con traccia, picco_python_mb."""
+
+    def __init__(self, traccia=False):
+        self.traccia = traccia
+        self.rss_iniziale_mb = self.picco_rss_mb = self.picco_python_mb = None
+        self.picco_dall_avvio = False
+        self._traccia_avviata = False
+
+    def __enter__(self):
+        self.rss_iniziale_mb = _leggi_status("VmRSS")
+        self.picco_dall_avvio = not _azzera_picco()
+        if self.traccia:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                self._traccia_avviata = True
+        return self
+
+    def __exit__(self, *eccezione):
+        if self.traccia:
+            self.picco_python_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            if self._traccia_avviata: tracemalloc.stop()
+        picco = None if self.picco_dall_avvio else _leggi_status("VmHWM")
+        if picco is None:
+            picco, self.picco_dall_avvio = _picco_dall_avvio_mb(), True
+        self.picco_rss_mb = picco
+
+    def riepilogo(self):
+        riepilogo = {"rss_iniziale_mb": self.rss_iniziale_mb, "picco_rss_mb": self.picco_rss_mb}
+        if self.picco_dall_avvio: riepilogo["picco_dall_avvio"] = True
+        if self.picco_python_mb is not None: riepilogo["picco_python_mb"] = self.picco_python_mb
+        return riepilogo
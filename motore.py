@@ -0,0 +1,1156 @@
+"""Motore di orchestrazione: pipeline importabile e CLI per l'elaborazione batch.
+
+Uso da riga di comando:
+
+    python motore.py brano.mxl -o orchestrato.mxl --strumenti "Violino I" "Viola" "Violoncello"
+    python motore.py brano.mxl --anteprima 1 16 --strumenti "Flauto" "Violino I" "Violoncello"
+"""
+import argparse
+import cProfile
+import json
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from music21 import *
+
+from cache import CacheLRU, impronta
+from cassetto import Cassetto
+from cronometro import Cronometro, Giro, conta, fase, registra
+from copie import (ContatoreCopie, articolazione_condivisa, copia_dinamica, copia_nota,
+                   copia_profonda, nuova_durata, nuova_istanza, registra_copie)
+from eventi import AnalisiMisura, Evento, MappaDinamiche, Raddoppio, TabellaMano
+from finalizzazione import PassaggioParte, equivalenti, stato_prima_di
+from formato_mxl import ScrittoreMxlAFinestre, leggi_a_finestre, leggi_intervallo, leggi_mani, leggi_partitura, scrivi_mxl
+from griglia import TICK_PER_QUARTO, in_quarti, in_tick
+from lavori import segnala
+from memoria import PiccoMemoria
+from sarto import Precedenti, assegna_misura
+from strumenti import ESTENSIONI, ORDINE_PARTITURA, PRIORITA_BASSO, PRIORITA_MELODIA, libreria_strumenti
+
+# ==========================================
+# GLOBALI & LIBRERIA STRUMENTI
+# ==========================================
+# Ordine da partitura ed estensioni stanno in strumenti.py, importabile senza music21; chiavi e
+# strumenti music21 vengono costruiti una volta per processo e condivisi
+LIBRERIA_STRUMENTI = libreria_strumenti()
+
+# ==========================================
+# FUNZIONI DI SUPPORTO E FISICA
+# ==========================================
+def get_octave_shift(ps, strumento):
+    # Dalla tabella precalcolata dello strumento (vedi strumenti.Estensione)
+    return ESTENSIONI[strumento].spostamento(ps)
+
+def applica_limiti_fisici(nota_obj, strumento):
+    if not isinstance(nota_obj, note.Note): return nota_obj
+    shift_ottave = get_octave_shift(nota_obj.pitch.ps, strumento)
+    if shift_ottave != 0:
+        nota_obj.pitch.octave += shift_ottave
+    return nota_obj
+
+def copia_proprieta(sorgente, destinazione):
+    if hasattr(sorgente, 'tie') and sorgente.tie is not None: 
+        destinazione.tie = tie.Tie(sorgente.tie.type)
+        
+    if hasattr(sorgente, 'articulations') and sorgente.articulations:
+        nuove_art = [articolazione_condivisa(art) for art in sorgente.articulations if not isinstance(art, articulations.Fingering)]
+        if nuove_art: 
+            destinazione.articulations = nuove_art
+
+def analizza_misure(tab_dx, tab_sx):
+    if tab_dx is None or tab_sx is None: return True, False
+    if not tab_dx.non_grazia or not tab_sx.non_grazia: return True, False
+
+    is_dx_melodia = True
+    if tab_dx.quota_accordi > 0.5 and tab_sx.quota_accordi == 0:
+        is_dx_melodia = False
+
+    avg_dx = tab_dx.altezza_media if tab_dx.altezza_media is not None else 60
+    avg_sx = tab_sx.altezza_media if tab_sx.altezza_media is not None else 48
+
+    is_melodia_bassa = False
+    if is_dx_melodia and avg_dx < avg_sx: is_melodia_bassa = True
+    elif not is_dx_melodia and avg_sx < avg_dx: is_melodia_bassa = True
+
+    return is_dx_melodia, is_melodia_bassa
+
+def tabella_mano(misura):
+    # Tabella delle note di una misura sorgente, o None se la misura manca o è vuota
+    return TabellaMano(misura) if misura else None
+
+# ==========================================
+# MOTORE DEI PATTERN 
+# ==========================================
+TIPI_PATTERN = ("ottave", "alberti", "tremolo", "arpeggio")
+
+def tipo_pattern(p1, p2, p3, p4):
+    # Tipo delle quattro altezze (il primo che si riconosce, nell'ordine di TIPI_PATTERN), o None
+    if abs(p1 - p2) == 12 and p1 == p3 and p2 == p4: return "ottave"
+    if p1 < p3 < p2 == p4: return "alberti"
+    if p2 == p4 and p1 < p2 and p3 < p4: return "tremolo"
+    if p1 < p2 < p3 < p4: return "arpeggio"
+    return None
+
+def rileva_pattern(offsets, altezze, min_dur):
+    # offsets: offset distinti e ordinati della misura (tick); altezze: ps della nota più
+    # grave su ciascun offset. Da ogni offset si provano i passi d verso i tre offset successivi,
+    # in ordine: la prima finestra di quattro note (o1, o1+d, o1+2d, o1+3d) che cade sulla
+    # griglia e ha un tipo riconosciuto è un pattern, e la ricerca riparte dopo la sua ultima nota.
+    # Restituisce tuple (i, j, tipo, i2, i3, i4) di indici in offsets.
+    n = len(offsets)
+    posizione = {off: k for k, off in enumerate(offsets)}
+    risultati = []
+    corrente = 0
+    while corrente < n:
+        o1 = offsets[corrente]
+        for j in range(corrente + 1, min(corrente + 4, n)):
+            passo = offsets[j] - o1
+            if not 0 < passo <= min_dur * 2: continue
+            i3, i4 = posizione.get(o1 + 2 * passo), posizione.get(o1 + 3 * passo)
+            if i3 is None or i4 is None: continue
+            tipo = tipo_pattern(altezze[corrente], altezze[j], altezze[i3], altezze[i4])
+            if tipo is not None:
+                risultati.append((corrente, j, tipo, j, i3, i4))
+                corrente = i4
+                break
+        corrente += 1
+    return risultati
+
+def rileva_pattern_mano(tab):
+    # Pattern della mano, indipendenti dalla formazione: per ogni offset si guarda la riga più
+    # grave. Restituisce tuple (tipo, offsets, righe, altezze, durata) con le quattro note del
+    # pattern; durata è il passo tra la prima nota e la successiva usata per cercarlo.
+    righe_by_offset = {}
+    for r in tab.righe_suonate():
+        righe_by_offset.setdefault(tab.offset[r], []).append(r)
+
+    unique_offsets = sorted(righe_by_offset.keys())
+    righe_basse = [min(righe_by_offset[off], key=lambda r: tab.ps_basso[r]) for off in unique_offsets]
+    altezze = [tab.ps_basso[r] for r in righe_basse]
+
+    min_dur = tab.durata_minima_positiva if tab.durata_minima_positiva is not None else TICK_PER_QUARTO // 2
+
+    rilevati = []
+    for i, j, tipo, i2, i3, i4 in rileva_pattern(unique_offsets, altezze, min_dur):
+        indici = (i, i2, i3, i4)
+        rilevati.append((tipo, tuple(unique_offsets[k] for k in indici), tuple(righe_basse[k] for k in indici),
+                         tuple(altezze[k] for k in indici), unique_offsets[j] - unique_offsets[i]))
+    return rilevati
+
+def arrangia_pattern_sinistra(tab, cassetti, num, strum_pattern):
+    # Lavora sulle righe della tabella della mano d'accompagnamento e restituisce quelle non
+    # assorbite da un pattern
+    tutte_righe = list(range(len(tab)))
+    if not tutte_righe or not strum_pattern: return []
+    
+    s_b = strum_pattern[0] if len(strum_pattern) > 0 else None
+    s_m = strum_pattern[1] if len(strum_pattern) > 1 else strum_pattern[0]
+    s_h = strum_pattern[2] if len(strum_pattern) > 2 else None
+    
+    if not s_b or not s_m: return tutte_righe 
+
+    # I pattern restano nella tabella: un'altra formazione sulla stessa misura li riusa
+    if tab.pattern is None: tab.pattern = rileva_pattern_mano(tab)
+
+    def copia(strum, r, off, ps=None, durata=None):
+        # Copia della nota sorgente (ps e durata eventualmente sostituiti), nel cassetto di strum
+        ql = tab.durata[r] if durata is None else durata
+        cassetti[strum][num].inserisci(Evento(off, ql, tab, r, strum, ps=ps, nuova_durata=durata))
+
+    usate = set()
+    for tipo, (o1, real_o2, real_o3, real_o4), (r1, r2, r3, r4), (p1, p2, p3, p4), dur in tab.pattern:
+        conta("pattern", voce=tipo)
+
+        if tipo == "ottave":
+            low_p, high_p = min(p1, p2), max(p1, p2)
+            for rj, real_off in zip([r1, r2, r3, r4], [o1, real_o2, real_o3, real_o4]):
+                copia(s_b, rj, real_off, ps=low_p)
+                if s_m != s_b: copia(s_m, rj, real_off, ps=high_p)
+                if s_h: copia(s_h, rj, real_off, ps=high_p)
+                usate.add(rj)
+
+        elif tipo == "alberti":
+            copia(s_b, r1, o1)
+            usate.add(r1)
+            for rj, real_off in zip([r2, r3, r4], [real_o2, real_o3, real_o4]):
+                if s_m != s_b: copia(s_m, rj, real_off, ps=p3)
+                if s_h: copia(s_h, rj, real_off, ps=p2)
+                usate.add(rj)
+
+        elif tipo == "tremolo":
+            durata_doppia = dur * 2
+
+            copia(s_b, r1, o1, durata=durata_doppia)
+            copia(s_b, r3, real_o3, durata=durata_doppia)
+
+            if s_h:
+                copia(s_m, r1, o1, durata=durata_doppia)
+                copia(s_m, r3, real_o3, durata=durata_doppia)
+                for rj, real_off in zip([r1, r2, r3, r4], [o1, real_o2, real_o3, real_o4]):
+                    copia(s_h, rj, real_off)
+                    usate.add(rj)
+            elif s_m != s_b:
+                for rj, real_off in zip([r1, r2, r3, r4], [o1, real_o2, real_o3, real_o4]):
+                    copia(s_m, rj, real_off)
+                    usate.add(rj)
+
+        elif tipo == "arpeggio":
+            copia(s_b, r1, o1)
+            usate.add(r1)
+            for rj, real_off in zip([r2, r3, r4], [real_o2, real_o3, real_o4]):
+                if tab.ps_basso[rj] < 48:
+                    copia(s_b, rj, real_off)
+                elif s_m != s_b:
+                    copia(s_m, rj, real_off)
+                    if s_h: copia(s_h, rj, real_off)
+                usate.add(rj)
+
+    return [r for r in tutte_righe if r not in usate]
+
+def applica_dinamiche_e_testi(dinamiche, cassetto):
+    # dinamiche: MappaDinamiche della misura sorgente, come da dinamiche_e_testi
+    cassetto.aggiungi_dinamiche(dinamiche)
+
+def calcola_ruoli_dinamici(ensemble, configurazione_attuale):
+    if not ensemble: return
+    n = len(ensemble)
+    
+    for s in ensemble:
+        configurazione_attuale[s]["ruolo"] = "Accompagnamento"
+        
+    if n == 1:
+        configurazione_attuale[ensemble[0]]["ruolo"] = "Melodia"
+        return
+        
+    melodie_candidate = [s for s in PRIORITA_MELODIA if s in ensemble]
+    bassi_candidati = [s for s in PRIORITA_BASSO if s in ensemble]
+    
+    num_melodie = 2 if n >= 5 else 1
+    num_bassi = 2 if n >= 6 else 1
+    
+    assegnati = set()
+    
+    for i in range(min(num_melodie, len(melodie_candidate))):
+        s = melodie_candidate[i]
+        configurazione_attuale[s]["ruolo"] = "Melodia"
+        assegnati.add(s)
+        
+    bassi_assegnati = 0
+    for s in bassi_candidati:
+        if s not in assegnati or n == 2:
+            configurazione_attuale[s]["ruolo"] = "Basso"
+            assegnati.add(s)
+            bassi_assegnati += 1
+        if bassi_assegnati >= num_bassi:
+            break
+
+# ==========================================
+# PIPELINE DI ORCHESTRAZIONE
+# ==========================================
+def _nessuna_notifica(messaggio):
+    pass
+
+# Partiture già lette, indicizzate per hash del contenuto, ognuna con le analisi delle sue
+# misure (vedi Lettura): il peso di ogni voce è una stima della memoria della partitura letta e
+# delle analisi (BYTE_PER_ELEMENTO_LETTO e BYTE_PER_ELEMENTO_ANALIZZATO per elemento music21; il
+# file sorgente, compresso, è centinaia di volte più piccolo), così la memoria occupata resta limitata.
+MAX_PARTITURE_IN_CACHE = 8
+MAX_BYTE_PARTITURE_IN_CACHE = 256 * 1024 * 1024
+BYTE_PER_ELEMENTO_LETTO = 5 * 1024
+BYTE_PER_ELEMENTO_ANALIZZATO = 1536
+_cache_partiture = CacheLRU(MAX_PARTITURE_IN_CACHE, max_peso=MAX_BYTE_PARTITURE_IN_CACHE)
+
+
+class Lettura:
+    """Una partitura letta e le analisi delle sue misure (AnalisiMisura per posizione nella
+    partitura): una nuova formazione sullo stesso brano ricalcola solo i ruoli e le fasi che
+    dipendono dagli strumenti. Le analisi tengono gli elementi music21 della partitura (vedi
+    TabellaMano), quindi stanno nella stessa voce di cache ed escono con lei."""
+
+    __slots__ = ("partitura", "analisi")
+
+    def __init__(self, partitura):
+        self.partitura = partitura
+        self.analisi = {}
+
+# File .mxl già prodotti, indicizzati per (hash del file, estensione, formazione, pianoforte
+# originale): un invio identico restituisce subito gli stessi byte.
+MAX_RISULTATI_IN_CACHE = 16
+MAX_BYTE_RISULTATI_IN_CACHE = 64 * 1024 * 1024
+_cache_risultati = CacheLRU(MAX_RISULTATI_IN_CACHE, max_peso=MAX_BYTE_RISULTATI_IN_CACHE)
+
+# Le esecuzioni sullo stesso file condividono partitura e analisi in cache, che music21 aggiorna
+# pigramente anche in lettura: nello stesso processo si orchestra un file alla volta (file
+# diversi possono andare in parallelo, per esempio nei lavori di CodaLavori)
+_lock_file = {}
+_lock_registro = threading.Lock()
+
+@contextmanager
+def uso_esclusivo(chiave_file):
+    with _lock_registro:
+        lock = _lock_file.setdefault(chiave_file, threading.Lock())
+    # L'attesa resta annullabile: un lavoro fermo qui risponde comunque all'annullamento
+    while not lock.acquire(timeout=0.2):
+        segnala("attesa")
+    try:
+        yield
+    finally:
+        lock.release()
+
+def carica_partitura(dati_partitura, estensione=".mxl", chiave_file=None, completa=True):
+    # La partitura restituita è condivisa tra le esecuzioni: va trattata in sola lettura
+    return leggi_in_cache(dati_partitura, estensione, chiave_file, completa).partitura
+
+def leggi_in_cache(dati_partitura, estensione=".mxl", chiave_file=None, completa=True):
+    # La Lettura del file, dalla cache o nuova. chiave_file: (impronta, estensione), se già
+    # calcolata. Con completa=False bastano le due mani (senza pianoforte originale nell'export):
+    # si leggono direttamente, senza music21 per l'intero documento (leggi_mani), e vanno in
+    # cache a parte; una lettura completa già in cache va bene comunque
+    chiave = chiave_file or (impronta(dati_partitura), estensione)
+    lettura = _cache_partiture.get(chiave)
+    if lettura is None and not completa:
+        lettura = _cache_partiture.get((*chiave, "mani"))
+        if lettura is None:
+            lettura = Lettura(leggi_mani(dati_partitura, estensione))
+            _cache_partiture.put((*chiave, "mani"), lettura, peso=peso_partitura(lettura.partitura))
+    elif lettura is None:
+        lettura = Lettura(leggi_partitura(dati_partitura, estensione))
+        _cache_partiture.put(chiave, lettura, peso=peso_partitura(lettura.partitura))
+    return lettura
+
+def peso_partitura(partitura):
+    # Byte stimati della partitura letta e delle analisi delle sue misure: circa 4-5 KB per
+    # elemento (nota, accordo, pausa, misura...) più 1,5 KB di analisi, misurati con tracemalloc
+    # su brani sintetici e del corpus di music21
+    return sum(1 for _ in partitura.recurse()) * (BYTE_PER_ELEMENTO_LETTO + BYTE_PER_ELEMENTO_ANALIZZATO)
+
+def analisi_misura(lettura, indice, m_dx_orig, m_sx_orig):
+    analisi = lettura.analisi.get(indice)
+    if analisi is None:
+        analisi = lettura.analisi[indice] = analizza_misura(m_dx_orig, m_sx_orig)
+    else:
+        conta("misure_da_cache")
+    return analisi
+
+def svuota_cache():
+    # Dimentica partiture lette, analisi e risultati (per esempio per misurare da capo ogni fase)
+    for cache in (_cache_partiture, _cache_risultati): cache.svuota()
+
+def prepara_configurazione(ensemble):
+    sconosciuti = [s for s in ensemble if s not in LIBRERIA_STRUMENTI]
+    if sconosciuti:
+        raise ValueError(f"Strumenti non riconosciuti: {', '.join(sconosciuti)}")
+    ensemble_attivo = [s for s in ORDINE_PARTITURA if s in ensemble]
+    if not ensemble_attivo:
+        raise ValueError("Seleziona almeno uno strumento per procedere.")
+
+    configurazione = {s: {"attivo": s in ensemble_attivo, "ruolo": "Accompagnamento"} for s in ORDINE_PARTITURA}
+    calcola_ruoli_dinamici(ensemble_attivo, configurazione)
+    return ensemble_attivo, configurazione
+
+def forza_monofonia(n_originale):
+    n_new = note.Note(min(n_originale.pitches)) if isinstance(n_originale, chord.Chord) else copia_nota(n_originale)
+    n_new.duration = nuova_durata(n_originale.duration)
+    copia_proprieta(n_originale, n_new)
+    return n_new
+
+def clona_parte(cassetti, num, sorgente, destinazione):
+    # Il raddoppio resta un riferimento alla sorgente fino alla costruzione della misura
+    if sorgente in cassetti and destinazione in cassetti:
+        cassetti[destinazione][num].raddoppia(Raddoppio(cassetti[sorgente][num], destinazione))
+
+def _nota_da_riga(tab, riga, nome):
+    # Nota nuova con l'altezza scelta e durata e proprietà della riga (come copia_proprieta)
+    n = note.Note(nome)
+    n.duration = nuova_durata(tab.elementi[riga].duration)
+    if tab.legatura[riga] is not None: n.tie = tie.Tie(tab.legatura[riga])
+    if tab.articolazioni[riga]: n.articulations = [articolazione_condivisa(art) for art in tab.articolazioni[riga]]
+    return n
+
+def altezza_suonata(evento, strumento):
+    # ps che l'evento avrà nella parte, adattato all'estensione come in applica_limiti_fisici
+    # (degli accordi copiati interi, la nota più grave); None per le note senza altezza
+    if evento.ps is not None:
+        ps = evento.ps
+    else:
+        altezze = evento.tabella.altezze[evento.riga]
+        if evento.nome is not None: ps = next((ps for ps, nome in altezze if nome == evento.nome), None)
+        else: ps = altezze[0][0] if altezze else None
+    return ps if ps is None else ESTENSIONI[strumento].adatta(ps)
+
+def costruisci_nota(evento):
+    # Oggetto music21 dell'evento, creato una volta sola: i raddoppi partono dalla nota già
+    # costruita (vedi costruisci_misura)
+    if evento.oggetto is None:
+        if evento.nome is not None:
+            n = _nota_da_riga(evento.tabella, evento.riga, evento.nome)
+        else:
+            n = copia_nota(evento.tabella.elementi[evento.riga])
+            if evento.ps is not None:
+                # Un accordo che entra in un pattern diventa una nota sola, all'altezza del pattern
+                if isinstance(n, chord.Chord): n = forza_monofonia(n)
+                n.pitch.ps = evento.ps
+            if evento.nuova_durata is not None: n.duration.quarterLength = in_quarti(evento.nuova_durata)
+        evento.oggetto = applica_limiti_fisici(n, evento.strumento)
+    return evento.oggetto
+
+def dinamiche_e_testi(m_sorgente):
+    if not m_sorgente: return MappaDinamiche()
+    return MappaDinamiche((in_tick(el.offset), el) for el in m_sorgente.getElementsByClass(['Dynamic', 'TextExpression']))
+
+def analizza_misura(m_dx_orig, m_sx_orig):
+    # Analisi della coppia di misure che non dipende dalla formazione (vedi AnalisiMisura)
+    tab_dx, tab_sx = tabella_mano(m_dx_orig), tabella_mano(m_sx_orig)
+    is_dx_melodia, is_melodia_bassa = analizza_misure(tab_dx, tab_sx)
+
+    # Melodia: per ogni offset le altezze suonate, nell'ordine in cui vengono scelte
+    fonte_melodia = tab_dx if is_dx_melodia else tab_sx
+    melodia = None
+    if fonte_melodia is not None:
+        tab = fonte_melodia
+        offset_dict = {}
+        for r in tab.righe_suonate():
+            if tab.nota_o_accordo[r]:
+                offset_dict.setdefault(tab.offset[r], []).append(r)
+        melodia = []
+        for off in sorted(offset_dict.keys()):
+            pitches_qui = [(ps, nome, r) for r in offset_dict[off] for ps, nome in tab.altezze[r]]
+            pitches_qui.sort(key=lambda x: x[0], reverse=not is_melodia_bassa)
+            melodia.append((off, pitches_qui))
+
+    return AnalisiMisura(tab_dx, tab_sx, is_dx_melodia, is_melodia_bassa, melodia,
+                         dinamiche_e_testi(m_dx_orig), dinamiche_e_testi(m_sx_orig))
+
+def orchestra_misura(m_dx_orig, m_sx_orig, ensemble_attivo, configurazione, cassetti, lettura=None, indice=None):
+    # lettura, indice: la Lettura della partitura e la posizione della coppia, per riusare
+    # l'analisi in cache (vedi analisi_misura); senza, la coppia si analizza da capo. In
+    # entrambi i casi il tempo va alla fase "analisi" e alla misura
+    num = m_dx_orig.number
+    for strum in cassetti: cassetti[strum][num] = Cassetto(num)
+    giro = Giro()
+    
+    if lettura is None: analisi = analizza_misura(m_dx_orig, m_sx_orig)
+    else: analisi = analisi_misura(lettura, indice, m_dx_orig, m_sx_orig)
+    tab_dx, tab_sx = analisi.tab_dx, analisi.tab_sx
+    is_dx_melodia, is_melodia_bassa = analisi.is_dx_melodia, analisi.is_melodia_bassa
+    giro.conta("note_lette", (len(tab_dx) if tab_dx else 0) + (len(tab_sx) if tab_sx else 0))
+    giro.fase("analisi")
+    fonte_melodia = tab_dx if is_dx_melodia else tab_sx
+    fonte_accomp = tab_sx if is_dx_melodia else tab_dx
+    
+    strum_melodia = [s for s in ensemble_attivo if configurazione[s]["ruolo"] == "Melodia"]
+    strum_accomp  = [s for s in ensemble_attivo if configurazione[s]["ruolo"] == "Accompagnamento"]
+    strum_basso   = [s for s in ensemble_attivo if configurazione[s]["ruolo"] == "Basso"]
+
+    if is_melodia_bassa:
+        strum_melodia, strum_basso = strum_basso, strum_melodia
+        strum_accomp = strum_melodia + strum_accomp
+
+    # Scarti: (ps, nome, tabella, riga) per offset
+    info_offset = {}
+    
+
+    # --- ESTRAZIONE MELODIA ---
+    if analisi.melodia is not None:
+        tab = fonte_melodia
+        melody_busy_until = -1
+        for off, pitches_qui in analisi.melodia:
+            info_offset.setdefault(off, {'melodia': None, 'basso': None, 'scarti': []})
+            if not pitches_qui: continue 
+
+            if off >= melody_busy_until:
+                ps_top, nome_top, r_top = pitches_qui[0]
+                for s_mel in strum_melodia:
+                    cassetti[s_mel][num].inserisci(Evento(off, tab.durata[r_top], tab, r_top, s_mel, nome=nome_top))
+
+                melody_busy_until = off + tab.durata[r_top]
+                info_offset[off]['melodia'] = ps_top
+
+                for ps, nome, r in pitches_qui[1:]:
+                    if ps % 12 == ps_top % 12: continue 
+                    info_offset[off]['scarti'].append((ps, nome, tab, r))
+            else:
+                for ps, nome, r in pitches_qui:
+                    info_offset[off]['scarti'].append((ps, nome, tab, r))
+    giro.fase("melodia")
+
+    # --- ESTRAZIONE VOCI E ACCOMPAGNAMENTO ---
+    if fonte_accomp is not None:
+        tab = fonte_accomp
+        min_dur = tab.durata_minima if tab.durata_minima is not None else TICK_PER_QUARTO
+
+        ci_sono_scarti_melodia = any(len(v['scarti']) > 0 for v in info_offset.values())
+        voci_indipendenti = [r for r in tab.non_grazia if tab.durata[r] >= min_dur * 2]
+
+        pat_basso = strum_basso[0] if strum_basso else None
+        pat_accomp = strum_accomp.copy()
+        if not pat_accomp and "Clarinetto in Sib" in strum_accomp:
+            pat_accomp = ["Clarinetto in Sib"]
+
+        strum_pattern = []
+        if pat_basso: strum_pattern.append(pat_basso)
+        if pat_accomp: strum_pattern.extend(pat_accomp[::-1]) 
+
+        if (voci_indipendenti or ci_sono_scarti_melodia) and len(strum_pattern) > 2:
+            strum_pattern = strum_pattern[:-1] 
+
+        giro.fase("accompagnamento")
+        righe_restanti = arrangia_pattern_sinistra(tab, cassetti, num, strum_pattern)
+        giro.fase("pattern_sinistra")
+
+        offset_dict_acc = {}
+        for r in tab.righe_suonate(righe_restanti):
+            offset_dict_acc.setdefault(tab.offset[r], []).append(r)
+
+        strum_accomp_principale = pat_basso if pat_basso else (pat_accomp[0] if pat_accomp else None)
+
+        accomp_busy_until = -1
+        for off in sorted(offset_dict_acc.keys()):
+            info_offset.setdefault(off, {'melodia': None, 'basso': None, 'scarti': []})
+            pitches_qui = [(ps, nome, r) for r in offset_dict_acc[off] for ps, nome in tab.altezze[r]]
+
+            if not pitches_qui: continue 
+            pitches_qui.sort(key=lambda x: x[0], reverse=is_melodia_bassa) 
+
+            if strum_accomp_principale and off >= accomp_busy_until and cassetti[strum_accomp_principale][num].e_libero(off):
+                _, nome_prin, r_prin = pitches_qui[0]
+                cassetti[strum_accomp_principale][num].inserisci(Evento(off, tab.durata[r_prin], tab, r_prin, strum_accomp_principale, nome=nome_prin))
+                accomp_busy_until = off + tab.durata[r_prin]
+
+                for ps, nome, r in pitches_qui[1:]: info_offset[off]['scarti'].append((ps, nome, tab, r))
+            else:
+                for ps, nome, r in pitches_qui: info_offset[off]['scarti'].append((ps, nome, tab, r))
+    giro.fase("accompagnamento")
+
+    # --- IL SARTO ---
+    # Tutta la misura in una volta: a ogni offset gli strumenti liberi, dal più acuto, ricevono
+    # le note scartate, con i salti da un offset all'altro nel costo (vedi sarto.py)
+    offset_scarti = [off for off in sorted(info_offset.keys()) if info_offset[off]['scarti']]
+    if offset_scarti:
+        strum_sarto = sorted((s for s in strum_accomp if s in cassetti), key=lambda s: -(ESTENSIONI[s].minimo + ESTENSIONI[s].massimo))
+        precedenti = Precedenti({s: cassetti[s][num].eventi for s in strum_sarto}, altezza_suonata)
+        liste_note = []
+        for off in offset_scarti:
+            lista_note = info_offset[off]['scarti']
+            giro.conta("scarti_prodotti", len(lista_note))
+            lista_note.sort(key=lambda x: x[0], reverse=True)
+            liste_note.append(lista_note)
+
+        assegnazioni = assegna_misura(offset_scarti, [[(ps, tab.durata[r]) for ps, _, tab, r in lista_note] for lista_note in liste_note],
+                                      {s: ESTENSIONI[s] for s in strum_sarto},
+                                      [[s for s in strum_sarto if cassetti[s][num].e_libero(off)] for off in offset_scarti],
+                                      precedenti)
+        for off, lista_note, scelte in zip(offset_scarti, liste_note, assegnazioni):
+            giro.conta("scarti_usati", len({i for _, i in scelte}))
+            for strum, i in scelte:
+                ps, nome, tab, r = lista_note[i]
+                cassetti[strum][num].inserisci(Evento(off, tab.durata[r], tab, r, strum, nome=nome))
+    giro.fase("sarto")
+
+    # --- RADDOPPI E DINAMICHE ---
+    if len(strum_basso) > 1:
+        basso_principale = strum_basso[0]
+        for basso_sec in strum_basso[1:]: clona_parte(cassetti, num, basso_principale, basso_sec)
+
+    if len(strum_melodia) > 1:
+        mel_principale = strum_melodia[0]
+        for mel_sec in strum_melodia[1:]: clona_parte(cassetti, num, mel_principale, mel_sec)
+
+    # Melodia dalla mano destra, il resto dalla sinistra (o dalla destra, se la sinistra non ne ha)
+    dinamiche_accomp = analisi.dinamiche_sx or analisi.dinamiche_dx
+    for strum in ensemble_attivo:
+        fonte_dinamiche = analisi.dinamiche_dx if configurazione[strum]["ruolo"] == "Melodia" else dinamiche_accomp
+        applica_dinamiche_e_testi(fonte_dinamiche, cassetti[strum][num])
+    giro.fase("raddoppi")
+
+    if giro.attivo:
+        for strum in ensemble_attivo: giro.conta("note_inserite", cassetti[strum][num].note_suonate(), voce=strum)
+    giro.misura(num)
+
+def indicizza_misure(parte):
+    # Un solo passaggio sulla parte: numero di misura -> misura sorgente, durata (in tick),
+    # armature, indicazioni di tempo e di metronomo/testo (stessa misura di part.measure(num))
+    indice = {}
+    for m in parte.getElementsByClass(stream.Measure):
+        if m.number in indice: continue
+        voce = {"misura": m, "durata": in_tick(m.quarterLength),
+                "armature": [], "tempi": [], "indicazioni": []}
+        for el in m:
+            if isinstance(el, key.KeySignature): voce["armature"].append(el)
+            elif isinstance(el, meter.TimeSignature): voce["tempi"].append(el)
+            elif isinstance(el, (tempo.MetronomeMark, expressions.TextExpression)): voce["indicazioni"].append(el)
+        indice[m.number] = voce
+    return indice
+
+def coppie_mani(partitura):
+    parti_orig = partitura.getElementsByClass(stream.Part)
+    if len(parti_orig) < 2:
+        raise ValueError("La partitura deve contenere almeno due pentagrammi (mano destra e mano sinistra).")
+    misure_destra = list(parti_orig[0].getElementsByClass(stream.Measure))
+    misure_sinistra = list(parti_orig[1].getElementsByClass(stream.Measure))
+    return list(zip(misure_destra, misure_sinistra))
+
+def costruisci_misura(cassetto):
+    m = stream.Measure(number=cassetto.numero)
+    raddoppio = cassetto.raddoppio
+    if raddoppio is not None:
+        # Le note della sorgente, monofoniche e nell'estensione dello strumento che raddoppia
+        for ev in raddoppio.eventi_in_ordine():
+            m.insert(in_quarti(ev.offset), applica_limiti_fisici(forza_monofonia(costruisci_nota(ev)), raddoppio.strumento))
+    for ev in cassetto.eventi: m.insert(in_quarti(ev.offset), costruisci_nota(ev))
+    for offset, el in cassetto.dinamiche.coppie(): m.insert(in_quarti(offset), copia_dinamica(el))
+    return m
+
+def nuova_parte(nome):
+    p = stream.Part()
+    p.id = nome; p.partName = nome
+    p.insert(0, nuova_istanza(LIBRERIA_STRUMENTI[nome]["inst"]))
+    return p
+
+def finalizza_parti(cassetti, indice_dx, ensemble_attivo, prima_misura, uscita=None, tempi_fin=None, passaggi=None):
+    # Spazzatrice: le misure vengono prima costruite tutte (un raddoppio copia le note della
+    # sorgente com'erano in orchestrazione, senza gambi, travature e alterazioni), poi ogni parte viene
+    # finalizzata in un solo passaggio lineare, misura dopo misura (vedi finalizzazione.py).
+    # uscita: i numeri di misura da restituire (le altre fanno solo da contesto, nei blocchi paralleli);
+    # tempi_fin: se è un dizionario, vi somma i secondi di finalizzazione di ogni parte;
+    # passaggi: se è un dizionario, i PassaggioParte di ogni parte proseguono da una chiamata
+    # all'altra (pipeline a finestre) e la chiusura delle parti spetta al chiamante.
+    with fase("costruzione"):
+        misure = {nome: {num: costruisci_misura(c) for num, c in cassetti[nome].items()} for nome in cassetti}
+    with fase("finalizzazione"):
+        return _finalizza_parti(misure, cassetti, indice_dx, ensemble_attivo, prima_misura, uscita, tempi_fin, passaggi)
+
+def _finalizza_parti(misure, cassetti, indice_dx, ensemble_attivo, prima_misura, uscita, tempi_fin, passaggi=None):
+    parti = {}
+    fatte, totale = 0, sum(len(cassetti[nome]) for nome in cassetti)
+    for nome in ORDINE_PARTITURA:
+        if nome not in cassetti: continue
+        inizio_parte = time.perf_counter()
+        numeri = sorted(cassetti[nome])
+        primo_strumento = nome == ensemble_attivo[0]
+        passaggio = passaggi.get(nome) if passaggi is not None else None
+        if passaggio is None and numeri:
+            passaggio = PassaggioParte(nuova_istanza(LIBRERIA_STRUMENTI[nome]["clef"]), *stato_prima_di(indice_dx.items(), numeri[0]))
+            if passaggi is not None: passaggi[nome] = passaggio
+        chiave = passaggio.chiave if passaggio else None
+        p = nuova_parte(nome)
+        for num in numeri:
+            giro = Giro()
+            m, voce_dx = misure[nome][num], indice_dx.get(num)
+            if num == prima_misura: m.insert(0, nuova_istanza(chiave))
+            if primo_strumento and voce_dx:
+                for t in voce_dx["indicazioni"]: m.insert(t.offset, copia_profonda(t))
+            passaggio.finalizza(m, cassetti[nome][num].occupazione, voce_dx["durata"] if voce_dx else 4 * TICK_PER_QUARTO,
+                                voce_dx["armature"] if voce_dx else (), voce_dx["tempi"] if voce_dx else (),
+                                copia=copia_profonda, prima=num == prima_misura)
+            if uscita is None or num in uscita:
+                p.append(m)
+                giro.misura(num)
+        if passaggio and passaggi is None: passaggio.chiudi()
+        parti[nome] = p
+        fatte += len(numeri)
+        segnala("finalizzazione", fatte, totale)
+        if tempi_fin is not None: tempi_fin[nome] = tempi_fin.get(nome, 0.0) + time.perf_counter() - inizio_parte
+    return parti
+
+def assembla_partitura(partitura_originale, parti):
+    partitura_finale = stream.Score()
+
+    if partitura_originale.metadata is not None:
+        partitura_finale.metadata = copia_profonda(partitura_originale.metadata)
+    else:
+        partitura_finale.metadata = metadata.Metadata()
+
+    for nome in ORDINE_PARTITURA:
+        if nome in parti: partitura_finale.append(parti[nome])
+
+    return partitura_finale
+
+def aggiungi_pianoforte_originale(partitura_finale, partitura_originale, prima_misura):
+    # Una sola copia della partitura intera: copiando i pentagrammi uno per uno, le legature di
+    # portamento (e gli altri spanner) che ne toccano le note non verrebbero ricollegate alle copie
+    for p_ref in copia_profonda(partitura_originale).getElementsByClass(stream.Part):
+        togli_tempi_ridondanti(p_ref.getElementsByClass(stream.Measure), prima_misura)
+        partitura_finale.append(p_ref)
+
+def togli_tempi_ridondanti(misure, prima_misura, tempo_corrente=None):
+    # Come nelle parti orchestrate, restano solo le indicazioni di tempo che cambiano il metro;
+    # restituisce quella in vigore dopo l'ultima misura
+    for m_ref in misure:
+        for ts in list(m_ref.getElementsByClass(meter.TimeSignature)):
+            if m_ref.number != prima_misura and equivalenti(ts, tempo_corrente): m_ref.remove(ts)
+            tempo_corrente = ts
+    return tempo_corrente
+
+# ==========================================
+# ORCHESTRAZIONE PARALLELA
+# ==========================================
+# Ogni misura si orchestra da sola (lo stato riparte da zero a ogni misura), quindi blocchi di
+# misure consecutive possono andare a processi diversi. La finalizzazione guarda solo la misura
+# precedente (alterazioni, legature) e la prima nota della successiva (legature): ogni blocco
+# orchestra anche le due misure di confine, solo come contesto. Quanti blocchi preparare per
+# processo, per bilanciare misure più o meno dense:
+BLOCCHI_PER_PROCESSO = 4
+
+def _contesto_processi():
+    # Con fork i processi figli ereditano la cache delle partiture già lette e non rileggono il
+    # file, ma solo da un processo con un solo thread è sicuro: con altri thread attivi
+    # (l'interfaccia, la coda dei lavori) un figlio può nascere con un lock preso da un altro
+    # thread (cache, registro dei file in uso, logging) e bloccarsi per sempre. Allora i figli
+    # partono da un processo pulito, con forkserver o spawn (vedi _prepara_processo)
+    metodi = multiprocessing.get_all_start_methods()
+    if "fork" in metodi and threading.active_count() == 1: return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("forkserver" if "forkserver" in metodi else "spawn")
+
+def _preparazione_processi(contesto, dati_partitura, estensione, completa):
+    # Argomenti del pool: i figli non creati con fork leggono la partitura appena partiti
+    if contesto.get_start_method() == "fork": return {}
+    return {"initializer": _prepara_processo, "initargs": (dati_partitura, estensione, completa)}
+
+def _prepara_processo(dati_partitura, estensione, completa):
+    # Eseguita all'avvio dei processi figli: mette la partitura nella cache del processo
+    carica_partitura(dati_partitura, estensione, (impronta(dati_partitura), estensione), completa)
+
+def _orchestra_blocco(dati_partitura, estensione, ensemble, inizio, fine, completa=True):
+    # Eseguita nei processi figli: orchestra e finalizza le misure [inizio, fine) e le
+    # restituisce congelate, perché i flussi music21 non si trasferiscono con un pickle semplice
+    # Insieme alle misure restituisce le statistiche del blocco: copie profonde, tempi di
+    # finalizzazione per parte e il riepilogo del cronometro (le misure di confine, solo di
+    # contesto, non entrano nei contatori: li conta il blocco che le restituisce)
+    ensemble_attivo, configurazione = prepara_configurazione(ensemble)
+    chiave_file = (impronta(dati_partitura), estensione)
+    lettura = leggi_in_cache(dati_partitura, estensione, chiave_file, completa)
+    partitura_originale = lettura.partitura
+    coppie_misure = coppie_mani(partitura_originale)
+    prima_misura = min(m_dx.number for m_dx, _ in coppie_misure)
+    uscita = {m_dx.number for m_dx, _ in coppie_misure[inizio:fine]}
+
+    tempi_fin = {}
+    cronometro = Cronometro()
+    with ContatoreCopie() as contatore:
+        cassetti = {strum: {} for strum in ensemble_attivo}
+        for indice in range(max(0, inizio - 1), min(fine + 1, len(coppie_misure))):
+            m_dx_orig, m_sx_orig = coppie_misure[indice]
+            with cronometro if m_dx_orig.number in uscita else Cronometro():
+                orchestra_misura(m_dx_orig, m_sx_orig, ensemble_attivo, configurazione, cassetti, lettura, indice)
+        with cronometro:
+            indice_dx = indicizza_misure(partitura_originale.getElementsByClass(stream.Part)[0])
+            parti = finalizza_parti(cassetti, indice_dx, ensemble_attivo, prima_misura, uscita=uscita, tempi_fin=tempi_fin)
+
+    contenitore = stream.Score()
+    for p in parti.values(): contenitore.insert(0, p)
+    statistiche = {"copie_profonde": contatore.copie_profonde, "finalizzazione_s": tempi_fin, "cronometro": cronometro.riepilogo()}
+    return freezeThaw.StreamFreezer(contenitore, fastButUnsafe=True).writeStr(fmt='pickle'), statistiche
+
+def _scongela_misure(dati_congelati):
+    scongelatore = freezeThaw.StreamThawer()
+    scongelatore.openStr(dati_congelati)
+    return {p.id: {m.number: m for m in p.getElementsByClass(stream.Measure)}
+            for p in scongelatore.stream.getElementsByClass(stream.Part)}
+
+def orchestra_misure_parallelo(dati_partitura, estensione, ensemble_attivo, n_misure, processi, dimensione_blocco=None, tempi_fin=None,
+                               completa=True):
+    if dimensione_blocco is None:
+        dimensione_blocco = max(1, math.ceil(n_misure / (processi * BLOCCHI_PER_PROCESSO)))
+
+    misure_finali = {strum: {} for strum in ensemble_attivo}
+    contesto = _contesto_processi()
+    with ProcessPoolExecutor(max_workers=processi, mp_context=contesto,
+                             **_preparazione_processi(contesto, dati_partitura, estensione, completa)) as pool:
+        futuri = [pool.submit(_orchestra_blocco, dati_partitura, estensione, ensemble_attivo, inizio, min(inizio + dimensione_blocco, n_misure), completa)
+                  for inizio in range(0, n_misure, dimensione_blocco)]
+        # Unione nell'ordine delle misure, come nel ciclo seriale
+        try:
+            for i, futuro in enumerate(futuri):
+                dati_congelati, statistiche = futuro.result()
+                registra_copie(statistiche["copie_profonde"])
+                registra(statistiche["cronometro"])
+                if tempi_fin is not None:
+                    for strum, secondi in statistiche["finalizzazione_s"].items(): tempi_fin[strum] = tempi_fin.get(strum, 0.0) + secondi
+                for strum, misure in _scongela_misure(dati_congelati).items():
+                    misure_finali[strum].update(misure)
+                segnala("orchestrazione", min((i + 1) * dimensione_blocco, n_misure), n_misure)
+        except BaseException:
+            # Errore o lavoro annullato: i blocchi non ancora partiti non partono
+            for futuro in futuri: futuro.cancel()
+            raise
+
+    parti = {}
+    for nome in ensemble_attivo:
+        parti[nome] = nuova_parte(nome)
+        for num in sorted(misure_finali[nome]): parti[nome].append(misure_finali[nome][num])
+    return parti
+
+def orchestra(dati_partitura, ensemble, keep_original=True, estensione=".mxl", notifica=None, processi=1,
+              statistiche=None, profilo=None, finestra=None, traccia_memoria=False):
+    """Orchestra una partitura per pianoforte e restituisce i byte del file .mxl risultante.
+
+    Con processi > 1 le misure vengono orchestrate e finalizzate a blocchi su un pool di
+    processi; il risultato è identico a quello dell'esecuzione seriale.
+    Se statistiche è un dizionario, vi registra il riepilogo dell'esecuzione (vedi riepilogo_json):
+    "totale_s", i secondi di ogni fase ("fasi_s": lettura, analisi, melodia, ...), di ogni misura
+    ("misure_s") e di finalizzazione di ogni parte ("finalizzazione_s"), i "contatori" (note lette,
+    note inserite per strumento, pattern per tipo, scarti prodotti e usati) e le "copie_profonde".
+    Con più processi i tempi sono sommati sui processi.
+    Se profilo è un percorso, vi scrive il profilo cProfile dell'esecuzione (del solo processo
+    principale), leggibile con pstats o snakeviz.
+
+    Le analisi delle misure restano in cache per file, così cambiando solo la formazione si
+    rifanno i ruoli e le parti ma non l'analisi; un invio identico (stesso file, formazione e
+    keep_original) restituisce subito i byte già prodotti, con "da_cache" nelle statistiche.
+    Senza pianoforte originale del file si leggono solo le due mani, direttamente dall'XML
+    (leggi_mani in formato_mxl.py, che ripiega su music21 dove serve): il risultato è lo stesso.
+
+    Con finestra (un numero di misure) la partitura si legge, si orchestra e si scrive a finestre
+    di quelle misure, con memoria limitata dalla finestra e non dalla lunghezza del brano (vedi
+    ORCHESTRAZIONE A FINESTRE); processi e cache delle partiture e delle analisi non si usano.
+    Le statistiche riportano anche il picco di memoria dell'esecuzione ("memoria", in MB, vedi
+    memoria.py); con traccia_memoria anche il picco della memoria allocata da Python, più lento.
+
+    Dentro un lavoro di CodaLavori (lavori.py) riferisce l'avanzamento per fase e per misura, e
+    si interrompe con LavoroAnnullato se il lavoro viene annullato o supera il tempo massimo.
+    """
+    inizio = time.perf_counter()
+    chiave_file = (impronta(dati_partitura), estensione)
+    ensemble_attivo, _ = prepara_configurazione(ensemble)
+    chiave_risultato = (*chiave_file, tuple(ensemble_attivo), bool(keep_original), finestra)
+    with uso_esclusivo(chiave_file):
+        risultato = _cache_risultati.get(chiave_risultato)
+        if risultato is not None:
+            (notifica or _nessuna_notifica)("Stessa partitura e stessa formazione: risultato dalla cache.")
+            if statistiche is not None:
+                statistiche.update({"totale_s": time.perf_counter() - inizio, "fasi_s": {}, "misure_s": {}, "contatori": {},
+                                    "finalizzazione_s": {}, "copie_profonde": 0, "da_cache": True})
+            return risultato
+
+        tempi_fin = {}
+        profilatore = cProfile.Profile() if profilo else None
+        with PiccoMemoria(traccia_memoria) as memoria, ContatoreCopie() as contatore, Cronometro() as cronometro:
+            if profilatore: profilatore.enable()
+            try:
+                if finestra:
+                    risultato = _orchestra_a_finestre(dati_partitura, ensemble, keep_original, estensione, notifica, finestra, tempi_fin)
+                else:
+                    risultato = _orchestra(dati_partitura, ensemble, keep_original, estensione, notifica, processi, tempi_fin, chiave_file)
+            finally:
+                if profilatore:
+                    profilatore.disable()
+                    profilatore.dump_stats(profilo)
+        _cache_risultati.put(chiave_risultato, risultato, peso=len(risultato))
+    if statistiche is not None:
+        statistiche["totale_s"] = time.perf_counter() - inizio
+        statistiche.update(cronometro.riepilogo())
+        statistiche["finalizzazione_s"] = tempi_fin
+        statistiche["copie_profonde"] = contatore.copie_profonde
+        statistiche["memoria"] = memoria.riepilogo()
+        statistiche["da_cache"] = False
+    return risultato
+
+def riepilogo_json(statistiche):
+    """Le statistiche di orchestra come testo JSON (misure in ordine di numero)."""
+    riepilogo = dict(statistiche)
+    if "misure_s" in riepilogo:
+        riepilogo["misure_s"] = {str(num): secondi for num, secondi in sorted(riepilogo["misure_s"].items())}
+    return json.dumps(riepilogo, indent=2, ensure_ascii=False)
+
+def righe_riepilogo(statistiche, misure_lente=5):
+    """Il riepilogo in poche righe leggibili: tempi, fasi più pesanti, misure più lente, contatori."""
+    righe = [f"Tempo totale: {statistiche['totale_s']:.2f} s"]
+    if statistiche.get("da_cache"): return righe + ["Risultato dalla cache (stessa partitura e stessa formazione)"]
+    fasi = sorted(statistiche["fasi_s"].items(), key=lambda voce: -voce[1])
+    righe.append("Fasi: " + ", ".join(f"{nome} {secondi:.2f} s" for nome, secondi in fasi))
+    lente = sorted(statistiche["misure_s"].items(), key=lambda voce: -voce[1])[:misure_lente]
+    if lente: righe.append("Misure più lente: " + ", ".join(f"{num} ({secondi * 1000:.0f} ms)" for num, secondi in lente))
+    contatori = statistiche["contatori"]
+    righe.append(f"Note lette: {contatori.get('note_lette', 0)}, inserite: " +
+                 ", ".join(f"{strum} {n}" for strum, n in contatori.get("note_inserite", {}).items()))
+    righe.append("Pattern: " + (", ".join(f"{tipo} {n}" for tipo, n in contatori.get("pattern", {}).items()) or "nessuno"))
+    righe.append(f"Scarti usati: {contatori.get('scarti_usati', 0)} su {contatori.get('scarti_prodotti', 0)}")
+    if contatori.get("misure_da_cache"): righe.append(f"Analisi dalla cache: {contatori['misure_da_cache']} misure")
+    righe.append(f"Copie profonde: {statistiche['copie_profonde']}")
+    memoria = statistiche.get("memoria", {})
+    if memoria.get("picco_rss_mb") is not None:
+        righe.append(f"Picco di memoria: {memoria['picco_rss_mb']:.0f} MB" + (" (dall'avvio del processo)" if memoria.get("picco_dall_avvio") else "") +
+                     (f", Python {memoria['picco_python_mb']:.0f} MB" if "picco_python_mb" in memoria else ""))
+    return righe
+
+def _orchestra(dati_partitura, ensemble, keep_original, estensione, notifica, processi, tempi_fin, chiave_file):
+    notifica = notifica or _nessuna_notifica
+    ensemble_attivo, configurazione = prepara_configurazione(ensemble)
+
+    notifica("Formazione configurata:")
+    for s in ensemble_attivo:
+        notifica(f"- {s} ({configurazione[s]['ruolo']})")
+
+    # 1. Caricamento
+    notifica("Lettura del file in corso...")
+    segnala("lettura")
+    with fase("lettura"):
+        lettura = leggi_in_cache(dati_partitura, estensione, chiave_file, completa=keep_original)
+        partitura_originale = lettura.partitura
+        coppie_misure = coppie_mani(partitura_originale)
+    prima_misura = min((m_dx.number for m_dx, _ in coppie_misure), default=None)
+
+    # 2. Orchestrazione
+    notifica("Analisi ed estrazione delle parti...")
+    segnala("orchestrazione", 0, len(coppie_misure))
+    if processi > 1 and len(coppie_misure) > 1:
+        parti = orchestra_misure_parallelo(dati_partitura, estensione, ensemble_attivo, len(coppie_misure), processi, tempi_fin=tempi_fin,
+                                           completa=keep_original)
+        notifica("Applicazione Spazzatrice e assemblaggio partitura...")
+    else:
+        cassetti = {strum: {} for strum in ensemble_attivo}
+        for indice, (m_dx_orig, m_sx_orig) in enumerate(coppie_misure):
+            orchestra_misura(m_dx_orig, m_sx_orig, ensemble_attivo, configurazione, cassetti, lettura, indice)
+            segnala("orchestrazione", indice + 1, len(coppie_misure))
+
+        notifica("Applicazione Spazzatrice e assemblaggio partitura...")
+        with fase("analisi"):
+            indice_dx = indicizza_misure(partitura_originale.getElementsByClass(stream.Part)[0])
+        parti = finalizza_parti(cassetti, indice_dx, ensemble_attivo, prima_misura, tempi_fin=tempi_fin)
+
+    # 3. Assemblaggio Finale
+    segnala("assemblaggio")
+    with fase("assemblaggio"):
+        partitura_finale = assembla_partitura(partitura_originale, parti)
+
+        if keep_original:
+            notifica("Aggiunta del pianoforte originale...")
+            aggiungi_pianoforte_originale(partitura_finale, partitura_originale, prima_misura)
+
+    # 4. Esportazione
+    # Le parti sono già finalizzate e il pianoforte originale è notato com'era nel file letto
+    segnala("esportazione")
+    with fase("esportazione"):
+        return scrivi_mxl(partitura_finale, notazione=False)
+
+# ==========================================
+# ORCHESTRAZIONE A FINESTRE
+# ==========================================
+# Per le partiture molto lunghe: lettura, orchestrazione, finalizzazione ed esportazione vanno
+# a finestre di misure consecutive, quindi in memoria restano (oltre al file letto e al testo
+# compresso già scritto) una o due finestre di oggetti music21. Lo stato che attraversa le
+# finestre è quello della finalizzazione (PassaggioParte) e l'indicazione di tempo del
+# pianoforte originale. Una misura finalizzata si esporta solo quando non può più cambiare: la
+# finalizzazione della misura successiva può ancora togliere la legatura dell'ultima nota
+# suonata, quindi si tiene da parte dalla misura che contiene l'ultima nota in poi.
+MISURE_PER_FINESTRA = 64
+
+def _in_sospeso_da(misure):
+    # Indice della prima misura da tenere: l'ultima con note (le pause non hanno legature)
+    for i in range(len(misure) - 1, -1, -1):
+        if misure[i].notes: return i
+    return 0
+
+def _parte_di_finestra(modello, misure, seguito=None, spanner=()):
+    # Parte nuova con le misure all'offset che hanno nel brano intero (strumento e chiave
+    # iniziali non si ripetono). modello: il nome dello strumento, o la parte del pianoforte
+    # originale letta nella finestra, di cui si riprendono id, nome e strumento; spanner: quelli
+    # della parte (legature di portamento, finali di ritornello) che riguardano queste misure.
+    # L'indicazione di tempo in vigore può stare in una finestra già scritta, dove l'esportazione
+    # non la trova: le pause "auto" si decidono qui (di misura intera o no). seguito: (offset,
+    # indicazione di tempo in vigore) dopo la parte già scritta, che si restituisce aggiornato
+    inizio, tempo = seguito or (0.0, None)
+    if isinstance(modello, str):
+        p = nuova_parte(modello)
+    else:
+        p = type(modello)()
+        p.id, p.partName = modello.id, modello.partName
+        strumento = modello.getInstrument(returnDefault=False, recurse=False)
+        if strumento is not None: p.insert(0, strumento)
+    for sp in spanner: p.insert(0, sp)
+    for m in misure:
+        p.insert(inizio, m)
+        inizio += m.quarterLength
+        tempi = list(m.getElementsByClass(meter.TimeSignature))
+        for r in m.recurse().getElementsByClass(note.Rest):
+            if r.fullMeasure != 'auto': continue
+            in_vigore = ([ts for ts in tempi if ts.offset <= r.offset] or [tempo])[-1]
+            r.fullMeasure = in_vigore is not None and in_vigore.barDuration.quarterLength == r.duration.quarterLength
+        if tempi: tempo = tempi[-1]
+    return p, (inizio, tempo)
+
+def _orchestra_a_finestre(dati_partitura, ensemble, keep_original, estensione, notifica, misure_per_finestra, tempi_fin):
+    notifica = notifica or _nessuna_notifica
+    ensemble_attivo, configurazione = prepara_configurazione(ensemble)
+
+    notifica("Formazione configurata:")
+    for s in ensemble_attivo:
+        notifica(f"- {s} ({configurazione[s]['ruolo']})")
+    notifica(f"Orchestrazione a finestre di {misure_per_finestra} misure...")
+
+    scrittore = ScrittoreMxlAFinestre()
+    passaggi, in_sospeso, pronte, pianoforte, seguiti = {}, {strum: [] for strum in ensemble_attivo}, {}, {}, {}
+    prima_misura, tempi_pianoforte, fatte = None, {}, 0
+    finestre = leggi_a_finestre(dati_partitura, estensione, misure_per_finestra)
+    segnala("lettura")
+    with fase("lettura"):
+        finestra = next(finestre, None)
+    if finestra is None: raise ValueError("La partitura non contiene misure.")
+    while finestra is not None:
+        with fase("lettura"):
+            coppie_misure = coppie_mani(finestra)
+            # Una finestra in anticipo: l'ultima chiude le parti
+            successiva = next(finestre, None)
+        if prima_misura is None: prima_misura = min((m_dx.number for m_dx, _ in coppie_misure), default=None)
+
+        cassetti = {strum: {} for strum in ensemble_attivo}
+        for m_dx_orig, m_sx_orig in coppie_misure:
+            orchestra_misura(m_dx_orig, m_sx_orig, ensemble_attivo, configurazione, cassetti)
+            fatte += 1
+            segnala("orchestrazione", fatte)
+        with fase("analisi"):
+            indice_dx = indicizza_misure(finestra.getElementsByClass(stream.Part)[0])
+        finalizzate = finalizza_parti(cassetti, indice_dx, ensemble_attivo, prima_misura, tempi_fin=tempi_fin, passaggi=passaggi)
+        if successiva is None:
+            for passaggio in passaggi.values(): passaggio.chiudi()
+
+        # Misure pronte per parte (orchestrali per nome, del pianoforte per posizione); la finestra
+        # si esporta quando ogni parte ne ha almeno una, perché l'esportazione vuole parti non vuote
+        for nome, p in finalizzate.items():
+            misure = in_sospeso[nome] + list(p.getElementsByClass(stream.Measure))
+            taglio = len(misure) if successiva is None else _in_sospeso_da(misure)
+            pronte.setdefault(nome, []).extend(misure[:taglio])
+            in_sospeso[nome] = misure[taglio:]
+        if keep_original:
+            for i, p_orig in enumerate(finestra.getElementsByClass(stream.Part)):
+                misure = list(p_orig.getElementsByClass(stream.Measure))
+                tempi_pianoforte[i] = togli_tempi_ridondanti(misure, prima_misura, tempi_pianoforte.get(i))
+                pronte.setdefault(i, []).extend(misure)
+                pianoforte.setdefault(i, [None, []])[1].extend(p_orig.spanners)
+                pianoforte[i][0] = p_orig
+        if successiva is None or all(pronte.values()):
+            with fase("assemblaggio"):
+                parti = {}
+                for nome in ensemble_attivo:
+                    parti[nome], seguiti[nome] = _parte_di_finestra(nome, pronte[nome], seguiti.get(nome))
+                partitura_finestra = assembla_partitura(finestra, parti)
+                for i, (p_orig, spanner) in pianoforte.items():
+                    p_ref, seguiti[i] = _parte_di_finestra(p_orig, pronte[i], seguiti.get(i), spanner)
+                    partitura_finestra.append(p_ref)
+                pronte, pianoforte = {}, {}
+            with fase("esportazione"):
+                scrittore.aggiungi(partitura_finestra)
+            del parti, partitura_finestra
+        del finestra, finalizzate
+        finestra = successiva
+
+    segnala("esportazione")
+    with fase("esportazione"):
+        return scrittore.chiudi()
+
+# ==========================================
+# ANTEPRIMA
+# ==========================================
+# Per ascoltare una formazione senza orchestrare ed esportare tutto il brano: del file si
+# leggono solo le misure richieste (leggi_intervallo, con chiavi, tempi e metronomo in vigore
+# all'inizio), che passano da orchestra_misura e dalla finalizzazione come nel ciclo seriale;
+# il risultato è un file MIDI in memoria, senza pianoforte originale.
+MISURE_ANTEPRIMA = 16
+
+def anteprima(dati_partitura, ensemble, prima=1, ultima=MISURE_ANTEPRIMA, estensione=".mxl", statistiche=None):
+    """Orchestra le misure dalla prima all'ultima (posizioni nel brano, contando da 1, estremi
+    inclusi) e restituisce i byte di un file MIDI delle sole parti orchestrate.
+
+    Il tempo non dipende dalla lunghezza del brano ma solo dalle misure richieste (e, per le
+    misure verso la fine, dalla scansione dell'XML che le precede). Se statistiche è un
+    dizionario, vi registra "totale_s", "fasi_s" e "contatori" come orchestra.
+    """
+    if not 1 <= prima <= ultima: raise ValueError("Intervallo di misure non valido: si conta dalla misura 1.")
+    inizio = time.perf_counter()
+    ensemble_attivo, configurazione = prepara_configurazione(ensemble)
+    with Cronometro() as cronometro:
+        with fase("lettura"):
+            partitura_originale = leggi_intervallo(dati_partitura, estensione, prima - 1, ultima)
+            coppie_misure = coppie_mani(partitura_originale)
+        if not coppie_misure: raise ValueError(f"La partitura non arriva alla misura {prima}.")
+
+        cassetti = {strum: {} for strum in ensemble_attivo}
+        for m_dx_orig, m_sx_orig in coppie_misure:
+            orchestra_misura(m_dx_orig, m_sx_orig, ensemble_attivo, configurazione, cassetti)
+        with fase("analisi"):
+            indice_dx = indicizza_misure(partitura_originale.getElementsByClass(stream.Part)[0])
+        parti = finalizza_parti(cassetti, indice_dx, ensemble_attivo, coppie_misure[0][0].number)
+
+        with fase("assemblaggio"):
+            partitura_finale = assembla_partitura(partitura_originale, parti)
+        with fase("esportazione"):
+            risultato = midi.translate.streamToMidiFile(partitura_finale).writestr()
+    if statistiche is not None:
+        statistiche["totale_s"] = time.perf_counter() - inizio
+        statistiche.update(cronometro.riepilogo())
+    return risultato
+
+# ==========================================
+# RIGA DI COMANDO (BATCH)
+# ==========================================
+def _percorso_uscita(percorso_in, args):
+    if args.output and len(args.input) == 1 and not os.path.isdir(args.output):
+        return args.output
+    cartella = args.output or os.path.dirname(percorso_in) or "."
+    base = os.path.splitext(os.path.basename(percorso_in))[0]
+    return os.path.join(cartella, f"{base}_orchestrato.mxl")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Orchestra uno o più brani per pianoforte (.mxl / .xml).")
+    parser.add_argument("input", nargs="+", help="File .mxl / .xml da orchestrare")
+    parser.add_argument("-o", "--output", help="File di uscita (un solo input) oppure cartella di destinazione")
+    parser.add_argument("-s", "--strumenti", nargs="+", default=["Violino I", "Violino II", "Viola", "Violoncello"],
+                        choices=ORDINE_PARTITURA, metavar="STRUMENTO",
+                        help=f"Formazione da usare, tra: {', '.join(ORDINE_PARTITURA)}")
+    parser.add_argument("--senza-originale", action="store_true", help="Non includere il pianoforte originale nel file esportato")
+    parser.add_argument("-j", "--processi", type=int, default=1, help="Numero di processi per orchestrare le misure in parallelo")
+    parser.add_argument("--finestra", type=int, metavar="MISURE",
+                        help=f"Lavora a finestre di MISURE misure, con memoria limitata (per brani molto lunghi; es. {MISURE_PER_FINESTRA})")
+    parser.add_argument("--memoria", action="store_true", help="Misura anche il picco della memoria allocata da Python (più lento)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Mostra l'avanzamento delle fasi e il riepilogo")
+    parser.add_argument("--statistiche", action="store_true", help="Salva il riepilogo JSON accanto a ogni file di uscita")
+    parser.add_argument("--profilo", action="store_true", help="Salva il profilo cProfile (.prof) accanto a ogni file di uscita")
+    parser.add_argument("--anteprima", nargs=2, type=int, metavar=("PRIMA", "ULTIMA"),
+                        help="Solo anteprima MIDI delle misure da PRIMA a ULTIMA (contando da 1), in un file .mid")
+    args = parser.parse_args(argv)
+
+    if args.output and len(args.input) > 1:
+        os.makedirs(args.output, exist_ok=True)
+
+    notifica = (lambda msg: print(msg, file=sys.stderr)) if args.verbose else None
+    errori = 0
+    for percorso_in in args.input:
+        try:
+            with open(percorso_in, "rb") as f:
+                dati = f.read()
+            estensione = os.path.splitext(percorso_in)[1].lower()
+            statistiche = {}
+            percorso_out = _percorso_uscita(percorso_in, args)
+            base_out = os.path.splitext(percorso_out)[0]
+            if args.anteprima:
+                percorso_out = base_out + ".mid"
+                with open(percorso_out, "wb") as f:
+                    f.write(anteprima(dati, args.strumenti, *args.anteprima, estensione=estensione))
+                print(f"{percorso_in} -> {percorso_out}")
+                continue
+            risultato = orchestra(dati, args.strumenti, keep_original=not args.senza_originale,
+                                  estensione=estensione, notifica=notifica, processi=args.processi,
+                                  statistiche=statistiche, profilo=base_out + ".prof" if args.profilo else None,
+                                  finestra=args.finestra, traccia_memoria=args.memoria)
+            if notifica:
+                for riga in righe_riepilogo(statistiche): notifica(riga)
+            with open(percorso_out, "wb") as f:
+                f.write(risultato)
+            if args.statistiche:
+                with open(base_out + "_statistiche.json", "w") as f:
+                    f.write(riepilogo_json(statistiche))
+            print(f"{percorso_in} -> {percorso_out}")
+        except Exception as e:
+            errori += 1
+            print(f"{percorso_in}: errore durante l'elaborazione: {e}", file=sys.stderr)
+    return 1 if errori else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
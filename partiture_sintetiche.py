@@ -0,0 +1,104 @@
+"""Partiture per pianoforte generate, per i benchmark del motore.
+
+Ogni misura ha una tessitura estratta (con i pesi richiesti) tra quelle che il motore
+riconosce: basso albertino, ottave spezzate, tremolo, arpeggio, accordi, abbellimenti nella
+mano destra e melodia nella mano sinistra (il caso is_melodia_bassa). Con lo stesso seme si
+ottiene sempre la stessa partitura.
+"""
+import random
+
+from music21 import articulations, chord, clef, duration, dynamics, expressions, key, layout, meter, note, stream, tempo
+
+from formato_mxl import scrivi_mxl
+
+TESSITURE = ("alberti", "ottave_spezzate", "tremolo", "arpeggio", "accordi", "abbellimenti", "melodia_bassa")
+
+# Quattro note di mano sinistra per tessitura, come intervalli dal basso (in semitoni); ogni
+# gruppo riempie mezza misura di crome e il motore lo riconosce come pattern
+_FIGURE_SINISTRA = {
+    "alberti": (0, 7, 4, 7),
+    "ottave_spezzate": (0, 12, 0, 12),
+    "tremolo": (0, 7, 0, 7),
+    "arpeggio": (0, 4, 7, 12),
+}
+_BASSI = (36, 38, 41, 43, 45, 48)
+_DINAMICHE = ("pp", "p", "mp", "mf", "f")
+
+
+def _pesi(tessiture):
+    if tessiture is None: tessiture = TESSITURE
+    if not isinstance(tessiture, dict): tessiture = {nome: 1 for nome in tessiture}
+    sconosciute = [nome for nome in tessiture if nome not in TESSITURE]
+    if sconosciute:
+        raise ValueError(f"Tessiture non riconosciute: {', '.join(sconosciute)}")
+    return list(tessiture), list(tessiture.values())
+
+
+def _melodia(rnd, misura, abbellimenti=False):
+    # Mano destra cantabile: semiminime e crome, qualche bicordo e qualche staccato
+    t, ps = 0.0, rnd.randint(67, 79)
+    while t < 4:
+        durata = min(rnd.choice((0.5, 0.5, 1.0, 1.0, 2.0)), 4 - t)
+        ps = min(max(ps + rnd.choice((-4, -2, -1, 1, 2, 3)), 62), 86)
+        if rnd.random() < 0.2:
+            el = chord.Chord([ps, ps - rnd.choice((3, 4, 5))], quarterLength=durata)
+        else:
+            el = note.Note(ps, quarterLength=durata)
+            if rnd.random() < 0.15: el.articulations.append(articulations.Staccato())
+            if abbellimenti and rnd.random() < 0.5:
+                grazia = note.Note(ps + 2)
+                grazia.duration = duration.GraceDuration(0.5)
+                misura.insert(t, grazia)
+        misura.insert(t, el)
+        t += durata
+
+
+def _accordi(misura, basso):
+    for t in (0, 2): misura.insert(t, chord.Chord([basso, basso + 7, basso + 16], quarterLength=2))
+
+
+def _misura(rnd, num, tessitura):
+    dx, sx = stream.Measure(number=num), stream.Measure(number=num)
+    basso = rnd.choice(_BASSI)
+    if tessitura == "melodia_bassa":
+        # Accordi in alto a destra, la melodia in basso a sinistra
+        for t in range(4): dx.insert(t, chord.Chord([72, 76, 79 + rnd.choice((0, 2))], quarterLength=1))
+        for t in range(4): sx.insert(t, note.Note(basso + rnd.choice((0, 2, 4, 7)), quarterLength=1))
+        return dx, sx
+
+    _melodia(rnd, dx, abbellimenti=tessitura == "abbellimenti")
+    if tessitura in _FIGURE_SINISTRA:
+        for i, intervallo in enumerate(_FIGURE_SINISTRA[tessitura] * 2):
+            sx.insert(i * 0.5, note.Note(basso + intervallo, quarterLength=0.5))
+    else:
+        _accordi(sx, basso)
+    return dx, sx
+
+
+def genera_partitura(n_misure, tessiture=None, seme=0):
+    """Partitura a due pentagrammi di n_misure misure in 4/4.
+
+    tessiture: nomi di TESSITURE (pesi uguali) o dizionario nome -> peso; di default tutte.
+    """
+    nomi, pesi = _pesi(tessiture)
+    rnd = random.Random(seme)
+    destra, sinistra = stream.PartStaff(), stream.PartStaff()
+    for num in range(1, n_misure + 1):
+        dx, sx = _misura(rnd, num, rnd.choices(nomi, pesi)[0])
+        if num == 1:
+            for m, chiave in ((dx, clef.TrebleClef()), (sx, clef.BassClef())):
+                m.insert(0, chiave); m.insert(0, key.KeySignature(-1)); m.insert(0, meter.TimeSignature("4/4"))
+            dx.insert(0, tempo.MetronomeMark(number=96))
+        if num % 8 == 1: dx.insert(0, dynamics.Dynamic(rnd.choice(_DINAMICHE)))
+        if num % 16 == 9: dx.insert(0, expressions.TextExpression("dolce"))
+        destra.append(dx); sinistra.append(sx)
+
+    partitura = stream.Score()
+    partitura.insert(0, destra); partitura.insert(0, sinistra)
+    partitura.insert(0, layout.StaffGroup([destra, sinistra], symbol="brace"))
+    return partitura
+
+
+def genera_mxl(n_misure, tessiture=None, seme=0):
+    """Come genera_partitura, ma restituisce i byte del file .mxl (pronti per orchestra)."""
+    return scrivi_mxl(genera_partitura(n_misure, tessiture, seme))
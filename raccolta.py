@@ -0,0 +1,186 @@
+"""Orchestrazione di una raccolta di brani (più file, o un archivio zip) con la stessa formazione.
+
+I brani vanno in parallelo su un pool di processi, uno per processo; il risultato è un unico zip
+con i brani orchestrati e il rapporto per file (stato, tempi, errori). Un file illeggibile o
+che fallisce non ferma gli altri: compare nel rapporto con il suo errore.
+
+    python raccolta.py sonata.zip studio1.mxl studio2.xml -o orchestrati.zip -s "Violino I" "Viola" -j 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from lavori import segnala
+from strumenti import ORDINE_PARTITURA
+
+ESTENSIONI = (".mxl", ".xml", ".musicxml")
+NOME_RAPPORTO = "rapporto.json"
+
+# Limiti degli archivi caricati, sui byte non compressi: un file zip piccolo può contenere
+# gigabyte (zip bomb), e i brani si estraggono in memoria prima di ogni limite dei lavori
+MAX_FILE_PER_ZIP = 1000
+MAX_BYTE_PER_FILE = 32 * 1024 * 1024
+MAX_BYTE_ESTRATTI = 256 * 1024 * 1024
+
+
+class FileScartato(Exception):
+    """Al posto dei byte di un file che non si estrae dall'archivio: il motivo va nel rapporto."""
+
+
+def file_da_zip(dati_zip, max_byte=MAX_BYTE_ESTRATTI):
+    """I brani (nome, byte) contenuti in un archivio zip, nell'ordine dell'archivio.
+
+    Si saltano cartelle, file nascosti e metadati di macOS; i file con altre estensioni
+    compaiono comunque nella raccolta, per essere segnalati come scartati nel rapporto.
+    Oltre MAX_FILE_PER_ZIP file, per i file di più di MAX_BYTE_PER_FILE byte e oltre max_byte
+    estratti in tutto, al posto dei byte c'è un FileScartato (il file non si legge): le
+    dimensioni sono quelle dichiarate nell'archivio, e zipfile non legge oltre.
+    """
+    brani, estratti = [], 0
+    with zipfile.ZipFile(io.BytesIO(dati_zip)) as archivio:
+        for info in archivio.infolist():
+            if info.is_dir() or info.filename.startswith("__MACOSX/") or os.path.basename(info.filename).startswith("."): continue
+            if len(brani) >= MAX_FILE_PER_ZIP:
+                motivo = f"Oltre {MAX_FILE_PER_ZIP} file nell'archivio"
+            elif info.file_size > MAX_BYTE_PER_FILE:
+                motivo = f"File troppo grande: {info.file_size} byte (massimo {MAX_BYTE_PER_FILE})"
+            elif estratti + info.file_size > max_byte:
+                motivo = f"Oltre {max_byte} byte estratti dagli archivi"
+            else:
+                estratti += info.file_size
+                brani.append((info.filename, archivio.read(info)))
+                continue
+            brani.append((info.filename, FileScartato(motivo)))
+    return brani
+
+
+def espandi(file):
+    # Gli zip si aprono nei brani che contengono (con il nome dell'archivio come prefisso);
+    # il limite sui byte estratti vale per tutti gli archivi insieme
+    brani, residui = [], MAX_BYTE_ESTRATTI
+    for nome, dati in file:
+        if os.path.splitext(nome)[1].lower() != ".zip":
+            brani.append((nome, dati))
+            continue
+        try:
+            interni = file_da_zip(dati, residui)
+        except zipfile.BadZipFile as e:
+            brani.append((nome, e))
+            continue
+        residui -= sum(len(dati_interni) for _, dati_interni in interni if isinstance(dati_interni, bytes))
+        brani += [(f"{nome}/{interno}", dati_interni) for interno, dati_interni in interni]
+    return brani
+
+
+def _orchestra_brano(dati, ensemble, keep_original, estensione):
+    # Eseguita nei processi figli: gli errori tornano come voce del rapporto, non come eccezione
+    import motore
+    inizio = time.perf_counter()
+    try:
+        statistiche = {}
+        risultato = motore.orchestra(dati, ensemble, keep_original=keep_original, estensione=estensione, statistiche=statistiche)
+        return risultato, {"stato": "ok", "secondi": time.perf_counter() - inizio, "fasi_s": statistiche["fasi_s"],
+                           "note_lette": statistiche["contatori"].get("note_lette", 0), "da_cache": statistiche["da_cache"],
+                           "picco_memoria_mb": statistiche.get("memoria", {}).get("picco_rss_mb")}
+    except Exception as e:
+        return None, {"stato": "errore", "secondi": time.perf_counter() - inizio, "errore": f"{type(e).__name__}: {e}"}
+
+
+def _nome_uscita(nome, usati):
+    # Nello zip di uscita i brani di un archivio stanno in una cartella con il suo nome
+    base = os.path.splitext(nome.replace("\\", "/").replace(".zip/", "/"))[0].lstrip("/")
+    candidato, n = f"{base}_orchestrato.mxl", 2
+    while candidato in usati:
+        candidato, n = f"{base}_orchestrato_{n}.mxl", n + 1
+    usati.add(candidato)
+    return candidato
+
+
+def orchestra_raccolta(file, ensemble, keep_original=True, processi=None, notifica=None):
+    """Orchestra ogni brano di file (coppie nome, byte; gli zip vengono aperti) e restituisce
+    (byte dello zip risultante, rapporto). Il rapporto, una voce per brano nell'ordine di
+    ingresso, è anche nello zip come rapporto.json.
+
+    processi: dimensione del pool (di default il numero di CPU, al massimo uno per brano).
+    Dentro un lavoro di CodaLavori riferisce l'avanzamento per brano e si può annullare.
+    """
+    from motore import _contesto_processi, prepara_configurazione
+    notifica = notifica or (lambda messaggio: None)
+    prepara_configurazione(ensemble)  # formazione non valida: errore subito, non per ogni brano
+
+    brani = espandi(file)
+    rapporto = [{"file": nome} for nome, _ in brani]
+    futuri = {}
+    inizio = time.perf_counter()
+    processi = max(1, min(processi or os.cpu_count() or 1, len(brani)))
+    with ProcessPoolExecutor(max_workers=processi, mp_context=_contesto_processi()) as pool:
+        for i, (nome, dati) in enumerate(brani):
+            estensione = os.path.splitext(nome)[1].lower()
+            if isinstance(dati, FileScartato):
+                rapporto[i].update({"stato": "scartato", "errore": str(dati)})
+            elif isinstance(dati, Exception):
+                rapporto[i].update({"stato": "errore", "errore": f"Archivio non valido: {dati}"})
+            elif estensione not in ESTENSIONI:
+                rapporto[i].update({"stato": "scartato", "errore": f"Estensione non supportata: {estensione or 'nessuna'}"})
+            else:
+                futuri[i] = pool.submit(_orchestra_brano, dati, ensemble, keep_original, estensione)
+
+        risultati, fatte = {}, 0
+        segnala("raccolta", 0, len(futuri))
+        try:
+            for i, futuro in futuri.items():
+                try:
+                    risultati[i], voce = futuro.result()
+                except Exception as e:
+                    # Processo figlio terminato (per esempio per memoria esaurita)
+                    risultati[i], voce = None, {"stato": "errore", "errore": f"{type(e).__name__}: {e}"}
+                rapporto[i].update(voce)
+                fatte += 1
+                notifica(f"{rapporto[i]['file']}: {voce['stato']} ({fatte}/{len(futuri)})")
+                segnala("raccolta", fatte, len(futuri))
+        except BaseException:
+            for futuro in futuri.values(): futuro.cancel()
+            raise
+
+    buffer, usati = io.BytesIO(), {NOME_RAPPORTO}
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archivio:
+        for i, risultato in sorted(risultati.items()):
+            if risultato is None: continue
+            rapporto[i]["uscita"] = _nome_uscita(rapporto[i]["file"], usati)
+            archivio.writestr(rapporto[i]["uscita"], risultato)
+        riepilogo = {"ensemble": list(ensemble), "keep_original": keep_original, "processi": processi,
+                     "totale_s": time.perf_counter() - inizio, "brani": rapporto}
+        archivio.writestr(NOME_RAPPORTO, json.dumps(riepilogo, indent=2, ensure_ascii=False))
+    return buffer.getvalue(), rapporto
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Orchestra una raccolta di brani (file .mxl / .xml o archivi .zip) in un unico zip.")
+    parser.add_argument("input", nargs="+", help="File .mxl / .xml / .zip")
+    parser.add_argument("-o", "--output", default="raccolta_orchestrata.zip", help="Zip di uscita")
+    parser.add_argument("-s", "--strumenti", nargs="+", default=["Violino I", "Violino II", "Viola", "Violoncello"],
+                        choices=ORDINE_PARTITURA, metavar="STRUMENTO",
+                        help=f"Formazione da usare, tra: {', '.join(ORDINE_PARTITURA)}")
+    parser.add_argument("--senza-originale", action="store_true", help="Non includere il pianoforte originale nei file esportati")
+    parser.add_argument("-j", "--processi", type=int, help="Processi del pool (default: numero di CPU)")
+    args = parser.parse_args(argv)
+
+    file = []
+    for percorso in args.input:
+        with open(percorso, "rb") as f: file.append((os.path.basename(percorso), f.read()))
+    dati_zip, rapporto = orchestra_raccolta(file, args.strumenti, keep_original=not args.senza_originale,
+                                            processi=args.processi, notifica=lambda msg: print(msg, file=sys.stderr))
+    with open(args.output, "wb") as f:
+        f.write(dati_zip)
+    riusciti = sum(voce["stato"] == "ok" for voce in rapporto)
+    print(f"{riusciti}/{len(rapporto)} brani orchestrati -> {args.output}")
+    return 0 if riusciti == len(rapporto) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""Il Sarto: le note scartate da melodia e accompagnamento, distribuite agli strumenti liberi.
+
+A ogni offset gli strumenti d'accompagnamento liberi, dal più acuto al più grave (centro
+dell'estensione), ricevono le note scartate, dalla più acuta alla più grave, con un'assegnazione
+monotona (le voci non si incrociano; due strumenti vicini possono raddoppiare la stessa nota).
+Il costo di una nota per uno strumento somma:
+- lo spostamento d'ottava necessario per entrare nell'estensione (in semitoni, dalle tabelle
+  precalcolate di strumenti.Estensione);
+- il salto dalla nota precedente dello strumento nella misura, oltre SALTO_LIBERO semitoni;
+e l'assegnazione paga in più PESO_RADDOPPIO per ogni raddoppio e PESO_NOTA_PERSA per ogni
+nota che resta senza strumento. A un offset, la programmazione dinamica trova le assegnazioni
+migliori in O(strumenti x note x CANDIDATI) (assegna, la sola migliore, senza tenerne altre).
+
+La misura si ottimizza tutta insieme (assegna_misura): le scelte a un offset decidono i salti
+(e gli strumenti ancora occupati) agli offset dopo, quindi gli offset si percorrono in ordine di
+tempo tenendo le FASCIO soluzioni parziali di costo minore, ognuna estesa con le sue CANDIDATI
+assegnazioni migliori all'offset successivo. Il costo resta limitato: O(offset x FASCIO x
+CANDIDATI) programmazioni dinamiche per misura.
+"""
+from bisect import bisect_left
+
+SALTO_LIBERO = 2
+PESO_RADDOPPIO = 8.0
+PESO_NOTA_PERSA = 6.0
+FASCIO = 4
+CANDIDATI = 3
+
+
+def _costi(altezze, estensioni, precedenti):
+    # Costo di ogni nota (colonne) per ogni strumento (righe)
+    costi = []
+    for estensione, precedente in zip(estensioni, precedenti):
+        riga = []
+        for ps in altezze:
+            spostamento = estensione.spostamento(ps)
+            costo = 12.0 * abs(spostamento)
+            if precedente is not None:
+                costo += max(0.0, abs(ps + 12 * spostamento - precedente) - SALTO_LIBERO)
+            riga.append(costo)
+        costi.append(riga)
+    return costi
+
+
+def assegna(altezze, estensioni, precedenti):
+    """Indice della nota per ogni strumento, nell'ordine dato.
+
+    altezze: ps delle note, dalla più acuta; estensioni: strumenti.Estensione di ogni strumento,
+    dal più acuto; precedenti: ps suonato per ultimo da ogni strumento (None: nessun salto da pagare).
+    """
+    n_note = len(altezze)
+    if n_note == 1: return [0] * len(estensioni)
+    costi = _costi(altezze, estensioni, precedenti)
+
+    # migliore[j]: costo minimo dei primi strumenti con l'ultimo sulla nota j, contando perse le
+    # note saltate prima di j; da[i][j]: nota dello strumento precedente in quella soluzione
+    migliore = [c + j * PESO_NOTA_PERSA for j, c in enumerate(costi[0])]
+    da = []
+    for riga in costi[1:]:
+        nuovo, provenienza = [], []
+        minimo_prima, indice_prima = float("inf"), -1
+        for j, costo in enumerate(riga):
+            stessa = migliore[j] + PESO_RADDOPPIO
+            prima = minimo_prima + (j - 1) * PESO_NOTA_PERSA
+            if prima <= stessa:
+                nuovo.append(costo + prima)
+                provenienza.append(indice_prima)
+            else:
+                nuovo.append(costo + stessa)
+                provenienza.append(j)
+            if migliore[j] - j * PESO_NOTA_PERSA < minimo_prima:
+                minimo_prima, indice_prima = migliore[j] - j * PESO_NOTA_PERSA, j
+        migliore = nuovo
+        da.append(provenienza)
+
+    totali = [c + (n_note - 1 - j) * PESO_NOTA_PERSA for j, c in enumerate(migliore)]
+    j = totali.index(min(totali))
+    scelte = [j]
+    for provenienza in reversed(da):
+        j = provenienza[j]
+        scelte.append(j)
+    return scelte[::-1]
+
+
+def migliori_assegnazioni(altezze, estensioni, precedenti, k=CANDIDATI):
+    """Le k assegnazioni di costo minimo, come (costo, indice della nota per ogni strumento),
+    dalla migliore. Argomenti come per assegna."""
+    n_note = len(altezze)
+    costi = _costi(altezze, estensioni, precedenti)
+
+    # celle[j]: le k soluzioni migliori dei primi strumenti con l'ultimo sulla nota j, come
+    # (costo, nota dello strumento precedente, posizione della soluzione nella sua cella)
+    celle = [[(c + j * PESO_NOTA_PERSA, -1, -1)] for j, c in enumerate(costi[0])]
+    righe = [celle]
+    for riga in costi[1:]:
+        # prima: le k soluzioni migliori con l'ultimo strumento su una nota jp < j, senza le
+        # note perse dopo jp (come minimo_prima in assegna)
+        nuove, prima = [], []
+        for j, costo in enumerate(riga):
+            # Liste di al più 2k voci: sort e taglio costano meno di heapq.nsmallest
+            cella = celle[j]
+            candidate = [(c + (j - 1) * PESO_NOTA_PERSA + costo, jp, v) for c, jp, v in prima]
+            candidate += [(soluzione[0] + PESO_RADDOPPIO + costo, j, v) for v, soluzione in enumerate(cella)]
+            candidate.sort()
+            nuove.append(candidate[:k])
+            prima += [(soluzione[0] - j * PESO_NOTA_PERSA, j, v) for v, soluzione in enumerate(cella)]
+            prima.sort()
+            del prima[k:]
+        celle = nuove
+        righe.append(celle)
+
+    finali = sorted((soluzione[0] + (n_note - 1 - j) * PESO_NOTA_PERSA, j, v)
+                    for j, cella in enumerate(celle) for v, soluzione in enumerate(cella))[:k]
+    risultati = []
+    for costo, j, v in finali:
+        scelte = []
+        for celle in reversed(righe):
+            scelte.append(j)
+            _, j, v = celle[j][v]
+        risultati.append((costo, scelte[::-1]))
+    return risultati
+
+
+def assegna_misura(offsets, note, estensioni, liberi, precedenti, fascio=FASCIO, candidati=CANDIDATI):
+    """Assegnazione delle note scartate di tutta la misura: per ogni offset, la lista di
+    (strumento, indice della nota) (vuota se nessuno strumento è libero).
+
+    offsets: offset con note scartate, in ordine di tempo; note[t]: (ps, durata) delle note
+    all'offset t, dalla più acuta; estensioni: strumento -> strumenti.Estensione; liberi[t]:
+    strumenti senza note nel cassetto all'offset t, dal più acuto; precedenti: Precedenti del cassetto.
+    Con fascio=candidati=1 è l'assegnazione offset per offset, in ordine di tempo.
+    """
+    # Soluzione parziale: (costo, aggiunte, scelte). aggiunte: strumento -> (offset, ps suonato,
+    # fine) dell'ultima nota data dal Sarto; scelte: (scelte di questo offset, scelte di prima)
+    soluzioni = [(0.0, {}, None)]
+    for t, (off, note_qui, liberi_qui) in enumerate(zip(offsets, note, liberi)):
+        # All'ultimo offset non c'è più niente da cui guardare avanti: basta la migliore
+        k = candidati if t < len(offsets) - 1 else 1
+        altezze = [ps for ps, _ in note_qui]
+        dal_cassetto = {strum: precedenti.prima_di(strum, off) for strum in liberi_qui}
+        nuove = []
+        for costo, aggiunte, scelte in soluzioni:
+            # Gli strumenti ancora occupati da una nota che questa soluzione ha già dato loro
+            strumenti, ultime = [], []
+            for strum in liberi_qui:
+                aggiunta = aggiunte.get(strum)
+                if aggiunta is not None and aggiunta[2] > off: continue
+                nel_cassetto = dal_cassetto[strum]
+                strumenti.append(strum)
+                if nel_cassetto is not None and (aggiunta is None or nel_cassetto[0] > aggiunta[0]): ultime.append(nel_cassetto[1])
+                else: ultime.append(aggiunta[1] if aggiunta is not None else None)
+            if not strumenti:
+                nuove.append((costo, aggiunte, ([], scelte)))
+                continue
+            estensioni_qui = [estensioni[strum] for strum in strumenti]
+            for costo_qui, indici in migliori_assegnazioni(altezze, estensioni_qui, ultime, k):
+                nuove_aggiunte = dict(aggiunte)
+                for strum, estensione, i in zip(strumenti, estensioni_qui, indici):
+                    ps, durata = note_qui[i]
+                    aggiunta = aggiunte.get(strum)
+                    fine = off + durata if aggiunta is None else max(off + durata, aggiunta[2])
+                    nuove_aggiunte[strum] = (off, estensione.adatta(ps), fine)
+                nuove.append((costo + costo_qui, nuove_aggiunte, (list(zip(strumenti, indici)), scelte)))
+        # A parità di costo resta la soluzione generata prima (sort stabile)
+        nuove.sort(key=lambda soluzione: soluzione[0])
+        soluzioni = nuove[:fascio]
+
+    scelte, risultato = soluzioni[0][2], []
+    while scelte is not None:
+        risultato.append(scelte[0])
+        scelte = scelte[1]
+    return risultato[::-1]
+
+
+class Precedenti:
+    """Ultima nota di ogni strumento prima di un offset, tra quelle già nel cassetto (melodia,
+    pattern, accompagnamento); quelle aggiunte dal Sarto le segue assegna_misura.
+    L'altezza suonata (altezza(evento, strumento)) si calcola solo per le note richieste."""
+
+    __slots__ = ("_altezza", "_offset", "_eventi")
+
+    def __init__(self, eventi_per_strumento, altezza):
+        # eventi_per_strumento: strumento -> eventi già nel cassetto (con .offset)
+        self._altezza = altezza
+        self._offset, self._eventi = {}, {}
+        for strum, eventi in eventi_per_strumento.items():
+            eventi = sorted(eventi, key=lambda ev: ev.offset)
+            self._offset[strum] = [ev.offset for ev in eventi]
+            self._eventi[strum] = eventi
+
+    def prima_di(self, strum, offset):
+        # (offset, ps suonato) dell'ultima nota prima di offset, o None
+        i = bisect_left(self._offset.get(strum, ()), offset) - 1
+        return (self._offset[strum][i], self._altezza(self._eventi[strum][i], strum)) if i >= 0 else None
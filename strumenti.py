@@ -0,0 +1,112 @@
+"""Strumenti dell'orchestra: dati semplici, importabili senza music21 (l'interfaccia li usa a
+ogni rerun), e oggetti music21 di chiavi e strumenti, costruiti una volta sola per processo.
+
+La libreria si legge da un file JSON (strumenti.json accanto a questo modulo, oppure il file
+indicato da ORCHESTRATORE_STRUMENTI) con la lista degli strumenti, in ordine di partitura, e le
+priorità per i ruoli di melodia e basso. Per ogni strumento:
+- "nome", "famiglia" (gruppo nell'interfaccia), "min" e "max" (estensione reale, in ps);
+- "chiave" e "strumento": nomi delle classi music21 di chiave e strumento;
+- "trasposizione" facoltativa: semitoni dal suono scritto al suono reale (-2 per il Sib);
+- "predefinito" facoltativo: strumento già selezionato nell'interfaccia.
+"""
+import functools
+import json
+import os
+
+PERCORSO_PREDEFINITO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "strumenti.json")
+CAMPI_OBBLIGATORI = ("nome", "famiglia", "min", "max", "chiave", "strumento")
+
+
+def spostamento_ottave(ps, minimo, massimo):
+    # Ottave da aggiungere (o togliere) a ps per entrare nell'estensione
+    spostamento = 0
+    while ps < minimo:
+        ps += 12
+        spostamento += 1
+    while ps > massimo:
+        ps -= 12
+        spostamento -= 1
+    return spostamento
+
+
+class Estensione:
+    """Estensione di uno strumento con le tabelle precalcolate sulle 128 altezze MIDI: lo
+    spostamento d'ottava per entrare nell'estensione (ottave) e l'altezza che ne risulta
+    (suonate). Le tabelle sono dizionari con chiavi intere, che valgono anche per i ps float
+    interi di music21 (60.0 == 60); le altre altezze (microtoni, fuori da 0-127) si calcolano al volo."""
+
+    __slots__ = ("minimo", "massimo", "trasposizione", "ottave", "suonate")
+
+    def __init__(self, minimo, massimo, trasposizione=0):
+        self.minimo, self.massimo, self.trasposizione = minimo, massimo, trasposizione
+        self.ottave = {ps: spostamento_ottave(ps, minimo, massimo) for ps in range(128)}
+        self.suonate = {ps: ps + 12 * spostamento for ps, spostamento in self.ottave.items()}
+
+    def spostamento(self, ps):
+        spostamento = self.ottave.get(ps)
+        return spostamento if spostamento is not None else spostamento_ottave(ps, self.minimo, self.massimo)
+
+    def adatta(self, ps):
+        suonata = self.suonate.get(ps)
+        return suonata if suonata is not None else ps + 12 * spostamento_ottave(ps, self.minimo, self.massimo)
+
+
+def carica_strumenti(percorso):
+    """Legge e controlla una libreria di strumenti: (ordine di partitura, strumento -> dati,
+    priorità della melodia, priorità del basso). Gli strumenti assenti da una lista di priorità
+    vi si aggiungono in fondo: in ordine di partitura per la melodia, al contrario per il basso."""
+    with open(percorso, encoding="utf-8") as f:
+        dati = json.load(f)
+    ordine, strumenti = [], {}
+    for voce in dati.get("strumenti", ()):
+        mancanti = [campo for campo in CAMPI_OBBLIGATORI if campo not in voce]
+        if mancanti:
+            raise ValueError(f"{percorso}: campi mancanti per {voce.get('nome', 'uno strumento')}: {', '.join(mancanti)}")
+        nome = voce["nome"]
+        if nome in strumenti: raise ValueError(f"{percorso}: strumento ripetuto: {nome}")
+        if not 0 <= voce["min"] <= voce["max"] - 11 or voce["max"] > 127:
+            raise ValueError(f"{percorso}: estensione non valida per {nome} (almeno un'ottava, entro 0-127)")
+        ordine.append(nome)
+        strumenti[nome] = {"famiglia": voce["famiglia"], "min": voce["min"], "max": voce["max"], "chiave": voce["chiave"],
+                           "strumento": voce["strumento"], "trasposizione": voce.get("trasposizione", 0),
+                           "predefinito": voce.get("predefinito", False)}
+    if not ordine: raise ValueError(f"{percorso}: nessuno strumento definito")
+
+    priorita = dati.get("priorita", {})
+    liste = []
+    for ruolo, resto in (("melodia", ordine), ("basso", ordine[::-1])):
+        lista = list(priorita.get(ruolo, ()))
+        sconosciuti = [s for s in lista if s not in strumenti]
+        if sconosciuti:
+            raise ValueError(f"{percorso}: strumenti non definiti nella priorità {ruolo}: {', '.join(sconosciuti)}")
+        liste.append(lista + [s for s in resto if s not in lista])
+    return ordine, strumenti, liste[0], liste[1]
+
+
+# L'ordine da partitura (Legni, Ottoni, Archi), l'estensione (ps), i nomi delle classi music21
+# della chiave e dello strumento, e le priorità dei ruoli, come da file di configurazione
+ORDINE_PARTITURA, STRUMENTI, PRIORITA_MELODIA, PRIORITA_BASSO = carica_strumenti(
+    os.environ.get("ORCHESTRATORE_STRUMENTI", PERCORSO_PREDEFINITO))
+
+# Famiglie in ordine di partitura, ognuna con i suoi strumenti
+FAMIGLIE = {}
+for _nome in ORDINE_PARTITURA: FAMIGLIE.setdefault(STRUMENTI[_nome]["famiglia"], []).append(_nome)
+
+ESTENSIONI = {nome: Estensione(dati["min"], dati["max"], dati["trasposizione"]) for nome, dati in STRUMENTI.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def libreria_strumenti():
+    """Per ogni strumento: estensione ("min", "max", e le tabelle in "estensione") e prototipi
+    music21 di chiave ("clef") e strumento ("inst"), con la trasposizione della configurazione.
+    Costruita al primo uso e condivisa: i prototipi non vanno modificati."""
+    from music21 import clef, instrument, interval
+    libreria = {}
+    for nome, dati in STRUMENTI.items():
+        inst = getattr(instrument, dati["strumento"])()
+        attuale = inst.transposition.semitones if inst.transposition is not None else 0
+        if attuale != dati["trasposizione"]:
+            inst.transposition = interval.Interval(dati["trasposizione"]) if dati["trasposizione"] else None
+        libreria[nome] = {"min": dati["min"], "max": dati["max"], "estensione": ESTENSIONI[nome],
+                          "clef": getattr(clef, dati["chiave"])(), "inst": inst}
+    return libreria
@@ -0,0 +1,35 @@
+from music21 import articulations, note, tie
+
+from copie import ContatoreCopie, copia_nota
+
+
+def _nota(*articolazioni):
+    n = note.Note("E4")
+    n.articulations = list(articolazioni)
+    return n
+
+
+def test_le_copie_conservano_diteggiature_e_corde():
+    sorgenti = [_nota(articulations.Fingering(dito), articulations.StringIndication(dito + 1), articulations.Staccato())
+                for dito in (1, 3, 5)]
+    copie = [copia_nota(n) for n in sorgenti]
+    assert [n.articulations[0].fingerNumber for n in copie] == [1, 3, 5]
+    assert [n.articulations[1].number for n in copie] == [2, 4, 6]
+    # Le articolazioni senza valori propri restano condivise
+    assert copie[0].articulations[2] is copie[1].articulations[2] is copie[2].articulations[2]
+
+
+def test_diteggiature_uguali_in_posizioni_diverse():
+    sopra, sotto = articulations.Fingering(2), articulations.Fingering(2)
+    sopra.placement, sotto.placement = "above", "below"
+    assert [copia_nota(_nota(art)).articulations[0].placement for art in (sopra, sotto)] == ["above", "below"]
+
+
+def test_il_contatore_conta_anche_le_parti_della_nota():
+    n = _nota()
+    n.tie = tie.Tie("start")
+    with ContatoreCopie() as contatore:
+        copia = copia_nota(n)
+    # Altezza e legatura di valore
+    assert contatore.copie_profonde == 2
+    assert copia.tie is not n.tie and copia.pitch is not n.pitch
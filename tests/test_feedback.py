@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from feedback import CasellaUscita, Postino
+
+
+class ServerDiProva:
+    """Server HTTP locale che risponde con le risposte in coda (codice, intestazioni), poi 200,
+    e tiene i corpi JSON ricevuti."""
+
+    def __init__(self, risposte=()):
+        self.risposte = list(risposte)
+        self.ricevuti = []
+        server = self
+
+        class Gestore(BaseHTTPRequestHandler):
+            def do_POST(self):
+                corpo = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.ricevuti.append(corpo)
+                codice, intestazioni = server.risposte.pop(0) if server.risposte else (200, {})
+                self.send_response(codice)
+                for nome, valore in intestazioni.items(): self.send_header(nome, valore)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._http = ThreadingHTTPServer(("127.0.0.1", 0), Gestore)
+        self.url = f"http://127.0.0.1:{self._http.server_port}/sendMessage"
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+
+    def chiudi(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+
+@pytest.fixture
+def server():
+    servers = []
+    def crea(*risposte):
+        servers.append(ServerDiProva(risposte))
+        return servers[-1]
+    yield crea
+    for s in servers: s.chiudi()
+
+
+def _postino(casella, url, **kwargs):
+    return Postino(casella, url, lambda testo: {"text": testo}, attesa_base_s=0.0, **kwargs)
+
+
+def test_consegna_e_ritenta_dopo_un_errore(tmp_path, server):
+    srv = server((500, {}))
+    casella = CasellaUscita(str(tmp_path / "feedback.sqlite3"))
+    casella.aggiungi("Ottimo lavoro!")
+    postino = _postino(casella, srv.url)
+    try:
+        assert postino.consegna() == 0
+        assert casella.stato() == {"inviati": 0, "in_attesa": 1, "abbandonati": 0}
+        assert postino.consegna() == 1
+    finally:
+        postino.ferma()
+    assert srv.ricevuti == [{"text": "Ottimo lavoro!"}] * 2
+    assert casella.stato() == {"inviati": 1, "in_attesa": 0, "abbandonati": 0}
+
+
+def test_retry_after_di_un_429(tmp_path, server):
+    srv = server((429, {"Retry-After": "120"}))
+    casella = CasellaUscita(str(tmp_path / "feedback.sqlite3"))
+    casella.aggiungi("Troppi messaggi")
+    postino = _postino(casella, srv.url)
+    try:
+        prima = time.time()
+        assert postino.consegna() == 0
+        # Il prossimo tentativo è quello chiesto dal server, non quello del backoff
+        assert casella.da_inviare() == []
+        assert prima + 119 <= casella.prossimo_tentativo() <= time.time() + 121
+        assert len(casella.da_inviare(adesso=time.time() + 121)) == 1
+    finally:
+        postino.ferma()
+
+
+def test_i_messaggi_sopravvivono_al_riavvio(tmp_path, server):
+    percorso = str(tmp_path / "feedback.sqlite3")
+    srv = server((503, {}))
+    casella = CasellaUscita(percorso)
+    casella.aggiungi("primo")
+    casella.aggiungi("secondo")
+    postino = _postino(casella, srv.url)
+    assert postino.consegna() == 1  # il primo fallisce, il secondo passa
+    postino.ferma()
+    del casella, postino
+
+    # Un nuovo processo ritrova nella stessa casella il messaggio non consegnato
+    riaperta = CasellaUscita(percorso)
+    assert riaperta.stato() == {"inviati": 1, "in_attesa": 1, "abbandonati": 0}
+    assert [(testo, tentativi) for _, testo, tentativi in riaperta.da_inviare()] == [("primo", 1)]
+    postino = _postino(riaperta, srv.url)
+    try:
+        assert postino.consegna() == 1
+    finally:
+        postino.ferma()
+    assert [corpo["text"] for corpo in srv.ricevuti] == ["primo", "secondo", "primo"]
+
+
+def test_il_postino_resiste_agli_errori_della_casella(tmp_path, server):
+    srv = server()
+    casella = CasellaUscita(str(tmp_path / "feedback.sqlite3"))
+    originale, guasti = casella.prossimo_tentativo, [2]
+
+    def prossimo_tentativo():
+        if guasti[0]:
+            guasti[0] -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return originale()
+
+    casella.prossimo_tentativo = prossimo_tentativo
+    postino = _postino(casella, srv.url, attesa_max_s=0.05, intervallo_s=0.05).avvia()
+    try:
+        scadenza = time.time() + 10
+        while guasti[0] and time.time() < scadenza: time.sleep(0.01)
+        casella.aggiungi("dopo l'errore")
+        postino.sveglia()
+        while casella.stato()["inviati"] == 0 and time.time() < scadenza: time.sleep(0.01)
+        assert postino._thread.is_alive()
+    finally:
+        postino.ferma()
+    assert casella.stato()["inviati"] == 1
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from lavori import ANNULLATO, COMPLETATO, ERRORE, IN_CODA, SCADUTO, CodaLavori, LavoroAnnullato, segnala
+
+
+@pytest.fixture
+def coda():
+    coda = CodaLavori(max_concorrenti=1)
+    yield coda
+    coda.chiudi()
+
+
+def _aspetta(evento):
+    # Lavoro che resta in corso finché evento non è impostato, segnalando l'avanzamento
+    while not evento.wait(0.01): segnala("attesa")
+    return "fatto"
+
+
+def test_i_lavori_partono_in_ordine_di_invio(coda):
+    ordine = []
+    ids = [coda.invia(ordine.append, i) for i in range(5)]
+    for id_lavoro in ids: assert coda.attendi(id_lavoro, timeout=10)["stato"] == COMPLETATO
+    assert ordine == list(range(5))
+
+
+def test_limite_di_lavori_contemporanei():
+    coda = CodaLavori(max_concorrenti=2)
+    via = threading.Event()
+    try:
+        ids = [coda.invia(_aspetta, via) for _ in range(3)]
+        scadenza = time.time() + 10
+        while coda.attivi() < 2 and time.time() < scadenza: time.sleep(0.01)
+        assert (coda.attivi(), coda.in_coda()) == (2, 1)
+        via.set()
+        for id_lavoro in ids: assert coda.attendi(id_lavoro, timeout=10)["stato"] == COMPLETATO
+    finally:
+        coda.chiudi()
+
+
+def test_avanzamento_e_risultato(coda):
+    def lavoro():
+        segnala("lettura", 3, 10)
+        return 42
+    id_lavoro = coda.invia(lavoro)
+    stato = coda.attendi(id_lavoro, timeout=10)
+    assert (stato["stato"], stato["fase"], stato["fatte"], stato["totale"]) == (COMPLETATO, "lettura", 3, 10)
+    assert coda.risultato(id_lavoro) == 42
+
+
+def test_annullamento_di_un_lavoro_in_coda_e_di_uno_in_corso(coda):
+    via = threading.Event()
+    in_corso = coda.invia(_aspetta, via)
+    partiti = []
+    in_coda = coda.invia(partiti.append, "partito")
+    assert coda.stato(in_coda)["stato"] == IN_CODA
+    coda.annulla(in_coda)
+    coda.annulla(in_corso)
+    assert coda.attendi(in_corso, timeout=10)["stato"] == ANNULLATO
+    assert coda.stato(in_coda)["stato"] == ANNULLATO
+    assert partiti == []
+    with pytest.raises(LavoroAnnullato):
+        coda.risultato(in_corso)
+
+
+def test_tempo_massimo(coda):
+    id_lavoro = coda.invia(_aspetta, threading.Event(), timeout=0.1)
+    stato = coda.attendi(id_lavoro, timeout=10)
+    assert stato["stato"] == SCADUTO and "Tempo massimo" in stato["errore"]
+
+
+def test_errore_del_lavoro(coda):
+    def guasto():
+        raise ValueError("file illeggibile")
+    id_lavoro = coda.invia(guasto)
+    assert coda.attendi(id_lavoro, timeout=10)["stato"] == ERRORE
+    with pytest.raises(ValueError, match="file illeggibile"):
+        coda.risultato(id_lavoro)
+
+
+def test_segnala_fuori_da_un_lavoro_non_fa_niente():
+    segnala("fase", 1, 2)
@@ -0,0 +1,145 @@
+import gc
+import io
+import re
+import weakref
+import zipfile
+
+import pytest
+from music21 import corpus
+
+import motore
+from cache import CacheLRU
+from lavori import COMPLETATO, CodaLavori
+from partiture_sintetiche import genera_mxl
+
+ENSEMBLE = ["Flauto", "Violino I", "Violoncello"]
+
+
+def _xml(dati_mxl):
+    with zipfile.ZipFile(io.BytesIO(dati_mxl)) as z:
+        return b"".join(z.read(nome) for nome in z.namelist() if not nome.startswith("META-INF"))
+
+
+@pytest.fixture(scope="module")
+def maple_leaf_rag():
+    with open(corpus.getWork("joplin/maple_leaf_rag"), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("finestra", [None, 16])
+def test_pianoforte_originale_conserva_le_legature_di_portamento(maple_leaf_rag, finestra):
+    # Il pianoforte copiato nell'export ha tutte le legature di portamento del file letto,
+    # sia nell'esecuzione intera sia in quella a finestre
+    motore.svuota_cache()
+    uscita = motore.orchestra(maple_leaf_rag, ENSEMBLE, finestra=finestra)
+    assert _xml(uscita).count(b"<slur") == _xml(maple_leaf_rag).count(b"<slur") == 8
+
+
+@pytest.mark.parametrize("altezze, tipo", [
+    ((36, 48, 36, 48), "ottave"),
+    ((36, 43, 40, 43), "alberti"),
+    ((40, 47, 40, 47), "tremolo"),
+    ((36, 40, 43, 48), "arpeggio"),
+])
+def test_rileva_pattern_riconosce_le_figure(altezze, tipo):
+    croma = motore.TICK_PER_QUARTO // 2
+    offsets = [k * croma for k in range(8)]
+    assert motore.rileva_pattern(offsets, altezze * 2, croma) == [(0, 1, tipo, 1, 2, 3), (4, 5, tipo, 5, 6, 7)]
+
+
+def test_rileva_pattern_richiede_passi_regolari():
+    croma = motore.TICK_PER_QUARTO // 2
+    # La terza nota non cade su o1 + 2d: nessuna finestra regolare
+    assert motore.rileva_pattern([0, croma, 3 * croma, 4 * croma], [36, 43, 40, 43], croma) == []
+
+
+def _confrontabile(dati_mxl):
+    # Senza ciò che cambia a ogni esportazione: data di codifica e id generati
+    return re.sub(rb"<encoding-date>.*?</encoding-date>|<movement-title>.*?</movement-title>| id=\"[^\"]*\"", b"", _xml(dati_mxl))
+
+
+@pytest.fixture(scope="module")
+def brano_sintetico():
+    return genera_mxl(40, None, 2)
+
+
+def test_i_processi_avviati_da_un_thread_non_usano_fork():
+    coda = CodaLavori(max_concorrenti=1)
+    try:
+        id_lavoro = coda.invia(motore._contesto_processi)
+        coda.attendi(id_lavoro, timeout=30)
+        assert coda.risultato(id_lavoro).get_start_method() != "fork"
+    finally:
+        coda.chiudi()
+
+
+def test_orchestrazione_parallela_in_un_lavoro_come_la_seriale(brano_sintetico):
+    motore.svuota_cache()
+    seriale = motore.orchestra(brano_sintetico, ENSEMBLE)
+    motore.svuota_cache()
+    coda = CodaLavori(max_concorrenti=1)
+    try:
+        id_lavoro = coda.invia(motore.orchestra, brano_sintetico, ENSEMBLE, processi=2)
+        assert coda.attendi(id_lavoro, timeout=300)["stato"] == COMPLETATO
+        assert _confrontabile(coda.risultato(id_lavoro)) == _confrontabile(seriale)
+    finally:
+        coda.chiudi()
+
+
+@pytest.mark.parametrize("ensemble", [["Violino I"], ENSEMBLE, ["Flauto", "Oboe", "Clarinetto in Sib", "Fagotto", "Viola", "Violoncello"]])
+@pytest.mark.parametrize("keep_original", [True, False])
+def test_orchestrazione_parallela_come_la_seriale(brano_sintetico, ensemble, keep_original):
+    # Blocchi di poche misure: anche le misure di confine tra un blocco e l'altro contano
+    motore.svuota_cache()
+    seriale = motore.orchestra(brano_sintetico, ensemble, keep_original=keep_original)
+    motore.svuota_cache()
+    parallela = motore.orchestra(brano_sintetico, ensemble, keep_original=keep_original, processi=3)
+    assert _confrontabile(parallela) == _confrontabile(seriale)
+
+
+def test_le_parti_hanno_la_trasposizione_di_strumenti_json():
+    # Per music21 il Contrabassoon non traspone; in strumenti.json il Controfagotto suona
+    # un'ottava sotto, e la parte (e l'export) devono dirlo
+    assert motore.nuova_parte("Controfagotto").getInstrument().transposition.semitones == -12
+    assert motore.nuova_parte("Clarinetto in Sib").getInstrument().transposition.semitones == -2
+    assert motore.nuova_parte("Violino I").getInstrument().transposition is None
+
+    motore.svuota_cache()
+    uscita = _xml(motore.orchestra(genera_mxl(8, None, 0), ["Flauto", "Controfagotto"], keep_original=False))
+    assert re.findall(rb"<transpose>\s*<diatonic>0</diatonic>\s*<chromatic>0</chromatic>\s*<octave-change>-1</octave-change>\s*</transpose>", uscita)
+
+
+def test_la_cache_delle_partiture_pesa_la_partitura_letta(brano_sintetico):
+    # Il peso stima la partitura in memoria, centinaia di volte il file compresso
+    motore.svuota_cache()
+    partitura = motore.carica_partitura(brano_sintetico)
+    assert motore.peso_partitura(partitura) > 100 * len(brano_sintetico)
+
+
+def test_le_analisi_escono_dalla_cache_con_la_partitura(monkeypatch, brano_sintetico):
+    monkeypatch.setattr(motore, "_cache_partiture", CacheLRU(1))
+    motore.svuota_cache()
+    motore.orchestra(brano_sintetico, ENSEMBLE)
+    statistiche = {}
+    motore.orchestra(brano_sintetico, ["Violino I"], statistiche=statistiche)
+    assert statistiche["contatori"]["misure_da_cache"] == 40
+
+    # Un altro brano prende il posto del primo: partitura e analisi (che ne tengono gli
+    # elementi) non restano in memoria
+    lettura = motore.leggi_in_cache(brano_sintetico)
+    assert len(lettura.analisi) == 40
+    elemento = weakref.ref(lettura.analisi[0].tab_dx.elementi[0])
+    del lettura
+    motore.orchestra(genera_mxl(8, None, 5), ENSEMBLE)
+    gc.collect()
+    assert elemento() is None
+
+
+@pytest.mark.parametrize("ripetizione", ["prima lettura", "analisi dalla cache"])
+def test_le_fasi_sommano_al_tempo_totale(brano_sintetico, ripetizione):
+    motore.svuota_cache()
+    if ripetizione == "analisi dalla cache": motore.orchestra(brano_sintetico, ["Violino I"])
+    statistiche = {}
+    motore.orchestra(brano_sintetico, ENSEMBLE, statistiche=statistiche)
+    assert statistiche["fasi_s"]["analisi"] > 0
+    assert sum(statistiche["fasi_s"].values()) == pytest.approx(statistiche["totale_s"], rel=0.05)
@@ -0,0 +1,88 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from partiture_sintetiche import genera_mxl
+import raccolta
+from raccolta import NOME_RAPPORTO, FileScartato, espandi, file_da_zip, orchestra_raccolta
+
+ENSEMBLE = ["Violino I", "Violoncello"]
+
+
+def _zip(voci, compressione=zipfile.ZIP_STORED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compressione) as archivio:
+        for nome, dati in voci: archivio.writestr(nome, dati)
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="module")
+def brani():
+    return genera_mxl(8, None, 0), genera_mxl(8, None, 1)
+
+
+def test_file_da_zip_salta_cartelle_e_file_nascosti():
+    dati = _zip([("a.mxl", b"1"), ("cartella/", b""), ("cartella/b.xml", b"2"), (".nascosto.mxl", b"3"),
+                 ("__MACOSX/a.mxl", b"4"), ("note.txt", b"5")])
+    assert file_da_zip(dati) == [("a.mxl", b"1"), ("cartella/b.xml", b"2"), ("note.txt", b"5")]
+
+
+def test_zip_bomb_i_file_oltre_i_limiti_non_si_estraggono(monkeypatch):
+    # 16 MB di zeri, compressi in pochi KB: si guarda la dimensione dichiarata, senza leggerli
+    monkeypatch.setattr(raccolta, "MAX_BYTE_PER_FILE", 1024 * 1024)
+    bomba = _zip([("a.mxl", b"1" * 10), ("grande.mxl", bytes(16 * 1024 * 1024)), ("b.mxl", b"2" * 10)], zipfile.ZIP_DEFLATED)
+    assert len(bomba) < 100 * 1024
+    letti = file_da_zip(bomba)
+    assert [nome for nome, _ in letti] == ["a.mxl", "grande.mxl", "b.mxl"]
+    assert isinstance(letti[1][1], FileScartato) and "troppo grande" in str(letti[1][1])
+    assert (letti[0][1], letti[2][1]) == (b"1" * 10, b"2" * 10)
+
+
+def test_limiti_sul_numero_di_file_e_sul_totale_estratto(monkeypatch):
+    monkeypatch.setattr(raccolta, "MAX_FILE_PER_ZIP", 3)
+    letti = file_da_zip(_zip([(f"{i}.mxl", b"x") for i in range(5)]))
+    assert [isinstance(dati, FileScartato) for _, dati in letti] == [False, False, False, True, True]
+
+    # Il totale vale per tutti gli archivi caricati insieme
+    monkeypatch.setattr(raccolta, "MAX_BYTE_ESTRATTI", 25)
+    archivio = _zip([("a.mxl", b"x" * 10), ("b.mxl", b"x" * 10)])
+    stati = [isinstance(dati, FileScartato) for _, dati in espandi([("uno.zip", archivio), ("due.zip", archivio)])]
+    assert stati == [False, False, True, True]
+
+
+def test_i_file_oltre_i_limiti_sono_scartati_nel_rapporto(monkeypatch):
+    monkeypatch.setattr(raccolta, "MAX_BYTE_PER_FILE", 100)
+    _, rapporto = orchestra_raccolta([("archivio.zip", _zip([("enorme.mxl", bytes(1000))]))], ENSEMBLE, processi=1)
+    assert [(voce["file"], voce["stato"]) for voce in rapporto] == [("archivio.zip/enorme.mxl", "scartato")]
+
+
+def test_raccolta_con_zip_file_scartati_ed_errori(brani):
+    primo, secondo = brani
+    archivio = _zip([("uno.mxl", primo), ("sottocartella/due.mxl", secondo), ("leggimi.txt", b"testo")])
+    file = [("archivio.zip", archivio), ("rotto.mxl", b"non una partitura"), ("finto.zip", b"non uno zip"), ("tre.mxl", primo)]
+
+    uscita, rapporto = orchestra_raccolta(file, ENSEMBLE, processi=2)
+
+    # Una voce per brano, nell'ordine di ingresso; un brano che fallisce non ferma gli altri
+    assert [(voce["file"], voce["stato"]) for voce in rapporto] == [
+        ("archivio.zip/uno.mxl", "ok"), ("archivio.zip/sottocartella/due.mxl", "ok"), ("archivio.zip/leggimi.txt", "scartato"),
+        ("rotto.mxl", "errore"), ("finto.zip", "errore"), ("tre.mxl", "ok")]
+    with zipfile.ZipFile(io.BytesIO(uscita)) as z:
+        assert sorted(z.namelist()) == sorted(["archivio/uno_orchestrato.mxl", "archivio/sottocartella/due_orchestrato.mxl",
+                                               "tre_orchestrato.mxl", NOME_RAPPORTO])
+        riepilogo = json.loads(z.read(NOME_RAPPORTO))
+        assert riepilogo["brani"] == rapporto and riepilogo["ensemble"] == ENSEMBLE
+        for voce in rapporto:
+            if voce["stato"] == "ok": assert zipfile.is_zipfile(io.BytesIO(z.read(voce["uscita"])))
+
+
+def test_stessi_nomi_di_uscita_non_si_sovrascrivono(brani):
+    uscita, rapporto = orchestra_raccolta([("brano.mxl", brani[0]), ("brano.mxl", brani[1])], ENSEMBLE, processi=1)
+    assert [voce["uscita"] for voce in rapporto] == ["brano_orchestrato.mxl", "brano_orchestrato_2.mxl"]
+
+
+def test_formazione_non_valida():
+    with pytest.raises(ValueError):
+        orchestra_raccolta([("brano.mxl", b"")], ["Ottavino a pedali"])
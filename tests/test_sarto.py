@@ -0,0 +1,102 @@
+import itertools
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from sarto import PESO_NOTA_PERSA, PESO_RADDOPPIO, Precedenti, _costi, assegna, assegna_misura, migliori_assegnazioni
+from strumenti import ESTENSIONI
+
+ORDINATI = sorted(ESTENSIONI, key=lambda s: -(ESTENSIONI[s].minimo + ESTENSIONI[s].massimo))
+
+
+def _costo_offset(altezze, estensioni, ultime, indici):
+    costi = _costi(altezze, estensioni, ultime)
+    return (sum(costi[k][i] for k, i in enumerate(indici)) + PESO_RADDOPPIO * sum(a == b for a, b in zip(indici, indici[1:]))
+            + PESO_NOTA_PERSA * (len(altezze) - len(set(indici))))
+
+
+def _monotone(n_strumenti, n_note):
+    return list(itertools.combinations_with_replacement(range(n_note), n_strumenti))
+
+
+def _problema(caso_random, n_strumenti, n_note, n_offset):
+    # Strumenti veri dal più acuto, note nel cassetto prima e tra gli offset, durate che a volte
+    # tengono occupato lo strumento all'offset dopo
+    strumenti = [s for s in ORDINATI if s in set(caso_random.sample(ORDINATI, n_strumenti))]
+    offsets = sorted(caso_random.sample(range(1, 12), n_offset))
+    note = [[(ps, caso_random.choice((1, 2, 4))) for ps in sorted((caso_random.randint(30, 90) for _ in range(caso_random.randint(1, n_note))), reverse=True)]
+            for _ in offsets]
+    eventi = {s: [SimpleNamespace(offset=off, ps=caso_random.randint(36, 84)) for off in caso_random.sample(range(12), caso_random.randint(0, 2))]
+              for s in strumenti}
+    liberi = [[s for s in strumenti if caso_random.random() < 0.8] for _ in offsets]
+    return offsets, note, {s: ESTENSIONI[s] for s in strumenti}, liberi, Precedenti(eventi, lambda ev, s: ev.ps)
+
+
+def _costo_misura(offsets, note, estensioni, liberi, precedenti, assegnazioni):
+    # Costo di tutta la misura, con i salti dalle note che la soluzione stessa ha dato prima
+    aggiunte, totale = {}, 0.0
+    for off, note_qui, scelte in zip(offsets, note, assegnazioni):
+        if not scelte: continue
+        ultime = []
+        for strum, _ in scelte:
+            aggiunta, nel_cassetto = aggiunte.get(strum), precedenti.prima_di(strum, off)
+            if nel_cassetto is not None and (aggiunta is None or nel_cassetto[0] > aggiunta[0]): ultime.append(nel_cassetto[1])
+            else: ultime.append(aggiunta[1] if aggiunta is not None else None)
+        totale += _costo_offset([ps for ps, _ in note_qui], [estensioni[s] for s, _ in scelte], ultime, [i for _, i in scelte])
+        for strum, i in scelte:
+            ps, durata = note_qui[i]
+            fine = off + durata if strum not in aggiunte else max(off + durata, aggiunte[strum][2])
+            aggiunte[strum] = (off, estensioni[strum].adatta(ps), fine)
+    return totale
+
+
+def _forza_bruta(offsets, note, estensioni, liberi, precedenti):
+    # Costo minimo su tutte le soluzioni della misura: a ogni offset ogni assegnazione monotona
+    # degli strumenti liberi e non ancora occupati da una nota data prima
+    def ricorri(t, soluzione, fine):
+        if t == len(offsets): return _costo_misura(offsets, note, estensioni, liberi, precedenti, soluzione)
+        off = offsets[t]
+        strumenti = [s for s in liberi[t] if fine.get(s, -1) <= off]
+        if not strumenti: return ricorri(t + 1, soluzione + [[]], fine)
+        migliore = float("inf")
+        for indici in _monotone(len(strumenti), len(note[t])):
+            nuova_fine = dict(fine)
+            for s, i in zip(strumenti, indici): nuova_fine[s] = max(fine.get(s, -1), off + note[t][i][1])
+            migliore = min(migliore, ricorri(t + 1, soluzione + [list(zip(strumenti, indici))], nuova_fine))
+        return migliore
+    return ricorri(0, [], {})
+
+
+@pytest.mark.parametrize("seme", range(40))
+def test_assegna_misura_trova_il_costo_minimo_della_misura(seme):
+    problema = _problema(random.Random(seme), 3, 3, 3)
+    esatta = assegna_misura(*problema, fascio=10 ** 6, candidati=10 ** 6)
+    assert _costo_misura(*problema, esatta) == pytest.approx(_forza_bruta(*problema))
+
+
+def test_il_fascio_non_peggiora_la_soluzione_offset_per_offset():
+    caso_random = random.Random(0)
+    migliorati = 0
+    for _ in range(200):
+        problema = _problema(caso_random, 4, 3, 4)
+        offset_per_offset = _costo_misura(*problema, assegna_misura(*problema, fascio=1, candidati=1))
+        misura = _costo_misura(*problema, assegna_misura(*problema))
+        assert misura <= offset_per_offset + 1e-9
+        migliorati += misura < offset_per_offset
+    # Ci sono misure in cui guardare avanti cambia la scelta
+    assert migliorati > 0
+
+
+@pytest.mark.parametrize("seme", range(20))
+def test_migliori_assegnazioni_in_ordine_di_costo(seme):
+    caso_random = random.Random(seme)
+    estensioni = [ESTENSIONI[s] for s in ORDINATI if s in set(caso_random.sample(ORDINATI, 4))]
+    altezze = sorted((caso_random.randint(30, 90) for _ in range(3)), reverse=True)
+    ultime = [caso_random.choice((None, caso_random.randint(36, 84))) for _ in estensioni]
+    tutte = sorted(_costo_offset(altezze, estensioni, ultime, indici) for indici in _monotone(len(estensioni), len(altezze)))
+
+    migliori = migliori_assegnazioni(altezze, estensioni, ultime, 5)
+    assert [costo for costo, _ in migliori] == pytest.approx(tutte[:5])
+    for costo, indici in migliori: assert _costo_offset(altezze, estensioni, ultime, indici) == pytest.approx(costo)
+    assert migliori[0][1] == assegna(altezze, estensioni, ultime)